@@ -18,7 +18,7 @@ def get_readme():
     return ''
 
 # Use the docstring of the __init__ file to be the description
-DESC = " ".join(__import__('myshare').__doc__.splitlines()).strip()
+DESC = " ".join(__import__('socialshare').__doc__.splitlines()).strip()
 
 setup(
     name = "Python Social Share",
@@ -31,6 +31,9 @@ setup(
     packages = find_packages(),
     include_package_data = True,
     install_requires = read_file('requirements.txt'),
+    entry_points = {
+        'console_scripts': ['socialshare = socialshare.cli:main'],
+    },
     classifiers = [
         'License :: OSI Approved :: MIT License',
     ],
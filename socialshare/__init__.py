@@ -2,9 +2,22 @@
 socialshare -- module for sharing to multiple social networks at one time
 
 Step 1: Register your backends by calling register_share_backend
+Step 2: Build a SocialShare and call do_bulk_share
 """
 
+import uuid
+
 import backends
+import dedup
+from backends import register_share_backend, available_backends, ShareError
+from backends import get_share_backend
+from errors import RateLimited, CircuitOpen
+from pool import SharePool, ShareResult, timed_call, get_default_pool
+from stream import share_stream, read_jsonl, read_csv, Checkpoint
+from content import ShareContent, CONTENT_FIELDS
+from instrument import instrumentation, StatsCollector, SpanHook
+from coalesce import Coalescer
+from procpool import ProcessSharePool
 
 
 __version_info__ = {
@@ -30,6 +43,13 @@ def get_version():
 __version__ = get_version()
 
 
+# SocialShare attributes saved by to_dict
+SHARE_FIELDS = ('api_token', 'api_secret', 'consumer_token', 'consumer_secret',
+                'message', 'headline', 'excerpt', 'tweet', 'url', 'url_title',
+                'url_description', 'image_url', 'image_url_title',
+                'image_url_description', 'shares')
+
+
 class SocialShare(object):                                                                                                                                                               
     """Shares with an arbitrary list of networks and consumer keys. 
     
@@ -47,13 +67,15 @@ class SocialShare(object):
     shares -- list of share networks and keys to share with
               [{'network':'facebook','consumer_token':'token', 
                 'consumer_secret':'secret'},...]
+    content -- optional ShareContent to share instead of the content
+               arguments above.
     """
     
     def __init__(self, api_token, api_secret, consumer_token="", 
                  consumer_secret="", message="", headline="", excerpt="", 
                  tweet="", url="", url_title="", url_description ="", 
                  image_url="", image_url_title="", image_url_description="",
-                 shares=[]):
+                 shares=[], content=None):
         # shelf everything for future use
         self.api_token = api_token
         self.api_secret = api_secret
@@ -70,26 +92,206 @@ class SocialShare(object):
         self.image_url_title = image_url_title
         self.image_url_description = image_url_description        
         self.shares = shares
+        if content is not None:
+            for name in CONTENT_FIELDS:
+                setattr(self, name, getattr(content, name))
+        self._content = content
+
+    def get_content(self):
+        """Returns the content as a ShareContent, normalized once and shared
+        by every backend."""
+        content = self._content
+        if content is None or any(getattr(self, name) != getattr(content, name)
+                                  for name in CONTENT_FIELDS):
+            content = ShareContent(**dict((name, getattr(self, name))
+                                          for name in CONTENT_FIELDS))
+            self._content = content
+        return content
+
+    def to_dict(self):
+        """Returns the share as a JSON serializable dict."""
+        return dict((name, getattr(self, name)) for name in SHARE_FIELDS)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Builds a SocialShare from a dict made by to_dict."""
+        return cls(**dict((str(k), v) for k, v in data.items()))
+
+    def enqueue(self, queue):
+        """Stores the share in a job queue for a worker to do later.
+
+        Returns the job id. See socialshare.jobs.
+
+        Parameters:
+        queue -- a JobQueue, e.g. jobs.SQLiteJobQueue('/var/lib/shares.db')
+        """
+        return queue.put(self._job_payload())
+
+    def schedule(self, at, scheduler):
+        """Stores the share to be done at a set time.
+
+        Returns the schedule entry id, which scheduler.cancel takes. See
+        socialshare.schedule.
+
+        Parameters:
+        at -- seconds since the epoch or a datetime. Naive datetimes are in
+              local time; use timezone aware ones for an account's own
+              local time.
+        scheduler -- a schedule.Scheduler
+        """
+        return scheduler.add(at, self._job_payload())
+
+    def _job_payload(self):
+        # the key names this share for share_job, so a job that's run
+        # again after a timeout doesn't post twice from the same process
+        payload = self.to_dict()
+        payload['key'] = uuid.uuid4().hex
+        return payload
         
-    def do_bulk_share(self):
-        """Shares using all backends in self.shares."""
-        for share in self.shares:
-            c_t = share['consumer_token'] or self.consumer_token
-            c_s = share['consumer_secret'] or self.consumer_secret
-            class_ = getattr(backends, backends.available_backends[share['network']])
-            api = class_(self.api_token, self.api_secret, 
-                         consumer_token=c_t, consumer_secret=c_s,
-                         message=self.message,
-                         headline=self.headline, 
-                         excerpt=self.excerpt,
-                         tweet=self.tweet, 
-                         url=self.url, url_title=self.url_title, 
-                         url_description=self.url_description, 
-                         image_url=self.image_url, image_url_title=self.image_url_title, 
-                         image_url_description=self.image_url_description)
-            print backends.available_backends[share['network']], '\n', api
-            return api.share()
+    def do_bulk_share(self, max_workers=8, network_limits=None, pool=None,
+                      skip_duplicates=True, coalescer=None, mode='threads',
+                      key=None):
+        """Shares using all backends in self.shares at the same time.
+
+        Returns a list of ShareResult objects in the same order as
+        self.shares. A failing network does not stop the others.
+
+        Parameters:
+        max_workers -- most shares running at once.
+        network_limits -- optional dict of network: most shares running at
+                          once for that network. e.g. {'linkedin': 1}
+        pool -- optional SharePool to run on. max_workers and network_limits
+                are ignored when a pool is given.
+        skip_duplicates -- skip accounts that already got this content, see
+                           socialshare.dedup. Their results have status
+                           SKIPPED.
+        coalescer -- optional coalesce.Coalescer to buffer the shares in,
+                     to go out later as digests. Buffered shares have
+                     status PENDING.
+        mode -- 'threads' to share on a thread pool in this process, or
+                'process' to shard the shares over worker processes by
+                account (see socialshare.procpool). In process mode
+                max_workers is the number of threads per process, pool is
+                an optional ProcessSharePool and network_limits isn't used.
+        key -- optional idempotency key naming this bulk share, e.g. a job
+               id. Each account's share is sent with a key made from it, see
+               socialshare.retry. Defaults to a new key per call.
+        """
+        key = key or uuid.uuid4().hex
+        if mode == 'process':
+            if coalescer is not None:
+                raise ValueError("A coalescer can't be used in process mode.")
+            return self._process_bulk_share(max_workers, pool,
+                                            skip_duplicates, key)
+        if mode != 'threads':
+            raise ValueError("Unknown mode %s" % mode)
+        own_pool = pool is None
+        if own_pool:
+            pool = SharePool(max_workers=max_workers, limits=network_limits)
+        try:
+            content = self.get_content()
+            futures = [pool.submit(share['network'], self._share_one, share,
+                                   content, skip_duplicates, coalescer, key)
+                       for share in self.shares]
+            return [f.result() for f in futures]
+        finally:
+            if own_pool:
+                pool.shutdown()
+
+    def _process_bulk_share(self, threads, pool, skip_duplicates, key):
+        own_pool = pool is None
+        if own_pool:
+            pool = ProcessSharePool(threads=threads)
+        try:
+            content = self.get_content()
+            jobs = []
+            for share in self.shares:
+                share = dict(share)
+                share['consumer_token'] = (share.get('consumer_token') or
+                                           self.consumer_token)
+                share['consumer_secret'] = (share.get('consumer_secret') or
+                                            self.consumer_secret)
+                jobs.append((share, content, self.api_token, self.api_secret,
+                             skip_duplicates, key))
+            results = [None] * len(jobs)
+            for position, result in pool.map(jobs):
+                results[position] = result
+            return results
+        finally:
+            if own_pool:
+                pool.shutdown()
+
+    def _share_one(self, share, content, skip_duplicates=True,
+                   coalescer=None, key=None):
+        """Builds the backend for a single share entry and shares with it."""
+        c_t = share.get('consumer_token') or self.consumer_token
+        c_s = share.get('consumer_secret') or self.consumer_secret
+        if coalescer is not None:
+            return coalescer.add(share['network'], self.api_token,
+                                 self.api_secret, c_t, c_s, content,
+                                 skip_duplicates=skip_duplicates)
+        if skip_duplicates:
+            return dedup.dedup_index.call(
+                share['network'], c_t, content, self._do_share, share, c_t,
+                c_s, content, key)
+        return timed_call(share['network'], c_t, self._do_share, share, c_t,
+                          c_s, content, key)
+
+    def _do_share(self, share, c_t, c_s, content, key=None):
+        class_ = get_share_backend(share['network'])
+        api = class_(self.api_token, self.api_secret,
+                     consumer_token=c_t, consumer_secret=c_s,
+                     content=content)
+        return api.share(key=None if key is None else
+                         api.idempotency_key(key))
         
+    def do_bulk_unshare(self, posts, max_workers=8, network_limits=None,
+                        pool=None):
+        """Deletes posts from every network at the same time, e.g. once a
+        posting closes.
+
+        Returns a list of ShareResult objects in the same order as posts.
+        Posts that are already gone count as deleted.
+
+        Parameters:
+        posts -- list of posts to delete, like self.shares with the post ID
+                 the network gave back added:
+                 [{'network': 'twitter', 'consumer_token': 'token',
+                   'consumer_secret': 'secret', 'post_id': '1234'}, ...]
+                 results.ResultStore.posts(digest, self.shares) lists what a
+                 content went out as.
+        max_workers -- most deletes running at once.
+        network_limits -- optional dict of network: most deletes running at
+                          once for that network.
+        pool -- optional SharePool to run on. max_workers and network_limits
+                are ignored when a pool is given.
+        """
+        own_pool = pool is None
+        if own_pool:
+            pool = SharePool(max_workers=max_workers, limits=network_limits)
+        try:
+            content = self.get_content()
+            futures = [pool.submit(post['network'], self._unshare_one, post,
+                                   content)
+                       for post in posts]
+            return [f.result() for f in futures]
+        finally:
+            if own_pool:
+                pool.shutdown()
+
+    def _unshare_one(self, post, content):
+        c_t = post.get('consumer_token') or self.consumer_token
+        c_s = post.get('consumer_secret') or self.consumer_secret
+        return timed_call(post['network'], c_t, self._do_unshare, post, c_t,
+                          c_s, content)
+
+    def _do_unshare(self, post, c_t, c_s, content):
+        class_ = get_share_backend(post['network'])
+        api = class_(self.api_token, self.api_secret,
+                     consumer_token=c_t, consumer_secret=c_s,
+                     content=content)
+        return api.unshare(post['post_id'])
+
     def do_single_share(self, network, consumer_token, consumer_secret):
         """Shares using a single network
         
@@ -97,8 +299,74 @@ class SocialShare(object):
         network: A string containing a single valid social network
         consumer_token: user's Oauth consumer token
         consumer_secret: user's Oauth consumer secret
+
+        Returns the ShareResult for the share.
         """
         
         self.shares = [{'network':network, 'consumer_token':consumer_token,
                        'consumer_secret':consumer_secret}]
-        result = self.do_bulk_share()
\ No newline at end of file
+        return self.do_bulk_share()[0]
+
+
+def share_job(payload):
+    """Job handler for jobs.Worker. Shares a SocialShare.to_dict payload.
+
+    Raises ShareError if any network failed so the job is dead lettered.
+    If the only failures were networks with an open circuit breaker or over
+    their rate limit, raises CircuitOpen or RateLimited instead so the
+    worker or scheduler puts the job off until they may be back.
+
+    When the job is retried, networks that did go through are only skipped
+    if socialshare.dedup.dedup_index is shared by the workers, e.g. a
+    SQLiteDedupStore as "socialshare worker" sets up; the default in-memory
+    index only covers the process it's in.
+    """
+    payload = dict(payload)
+    key = payload.pop('key', None)
+    results = SocialShare.from_dict(payload).do_bulk_share(key=key)
+    failed = [r for r in results if not r.ok]
+    if failed and all(isinstance(r.exception, (CircuitOpen, RateLimited)) and
+                      r.exception.retry_after is not None for r in failed):
+        networks = ', '.join(sorted(set(r.network for r in failed)))
+        retry_after = max(r.exception.retry_after for r in failed)
+        if all(isinstance(r.exception, CircuitOpen) for r in failed):
+            raise CircuitOpen("Circuit open for %s." % networks,
+                              retry_after=retry_after)
+        raise RateLimited("Rate limited or circuit open for %s." % networks,
+                          retry_after=retry_after)
+    if failed:
+        raise ShareError("Share failed for %s." % ', '.join(
+            '%s (%s)' % (r.network, r.exception) for r in failed))
+    return results
+
+
+class AsyncSocialShare(SocialShare):
+    """SocialShare that doesn't block the caller.
+
+    do_bulk_share and do_single_share hand the shares to a SharePool and
+    return ShareFutures right away. Each future resolves to a ShareResult.
+    Use ShareFuture.add_done_callback to hook the results into an event loop.
+    """
+
+    def do_bulk_share(self, pool=None, skip_duplicates=True):
+        """Starts sharing with all backends in self.shares.
+
+        Returns a list of ShareFutures in the same order as self.shares.
+
+        Parameters:
+        pool -- optional SharePool to run on. Defaults to the shared pool.
+        skip_duplicates -- skip accounts that already got this content
+        """
+        pool = pool or get_default_pool()
+        content = self.get_content()
+        key = uuid.uuid4().hex
+        return [pool.submit(share['network'], self._share_one, share, content,
+                            skip_duplicates, None, key)
+                for share in self.shares]
+
+    def do_single_share(self, network, consumer_token, consumer_secret,
+                        pool=None):
+        """Starts a share using a single network. Returns a ShareFuture."""
+        self.shares = [{'network':network, 'consumer_token':consumer_token,
+                       'consumer_secret':consumer_secret}]
+        return self.do_bulk_share(pool=pool)[0]
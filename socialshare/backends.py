@@ -10,28 +10,95 @@ backends.py -- implements a more universal social api that abstracts away the
                About the debug backend: it writes to stdio. 
                
 """
-
-class ShareError(Exception):
-    """Used for social share fails."""
-    def __init__(self, msg):
-        self.msg=msg
-        return
-
-    def __str__(self):
-        return "ShareError", self.message or None
+import httplib
+import json
+import socket
+import sys
+from importlib import import_module
+
+import breaker
+import clients
+import dedup
+import instrument
+import media
+import ratelimit
+import render
+import retry
+import transport
+from content import ShareContent, CONTENT_FIELDS
+from errors import ShareError, RateLimited
+from pool import get_default_pool, timed_call, DeliveryReport, SharePool
+from pool import ShareResult, SKIPPED
+
+
+def _http_status(exc):
+    """Returns the HTTP status of the response an SDK error carries, if any."""
+    response = getattr(exc, 'response', None)
+    return (getattr(response, 'status', None) or
+            getattr(response, 'status_code', None))
+
+
+def _timed_out(exc):
+    """True if exc is a timeout, from the socket or an SDK's HTTP library
+    (e.g. requests' Timeout)."""
+    return (isinstance(exc, socket.timeout) or
+            type(exc).__name__.endswith('Timeout'))
+
+
+def _content_field(name):
+    def get(self):
+        return getattr(self.content, name)
+    def set(self, value):
+        self.content = self.content.replace(**{name: value})
+    return property(get, set)
 
 
 # initialize backends
 available_backends ={}
+# network -> backend class, filled in the first time a network is used
+_resolved_backends = {}
 
 
-def register_share_backend(network, class_name):
+def register_share_backend(network, backend):
     """Registers a new social sharing backend
     
     Parameters:
     network -- name of the social network in lowercase. Something like twitter.
-    class_name -- the class that implements the share api"""
-    available_backends[network] = class_name
+    backend -- the class that implements the share api. Either the class
+               itself, a class name from this module or a dotted import path
+               such as 'myapp.share.MyBackend'. Names and paths are not
+               imported until the network is first used."""
+    available_backends[network] = backend
+    _resolved_backends.pop(network, None)
+
+
+def get_share_backend(network):
+    """Returns the backend class registered for network.
+
+    The class is looked up once and cached, so only networks that are
+    actually used import their module.
+    """
+    try:
+        return _resolved_backends[network]
+    except KeyError:
+        pass
+    try:
+        backend = available_backends[network]
+    except KeyError:
+        raise ShareError("No backend registered for %s." % network)
+    if isinstance(backend, basestring):
+        if '.' in backend:
+            module_name, class_name = backend.rsplit('.', 1)
+            module = import_module(module_name)
+        else:
+            module, class_name = sys.modules[__name__], backend
+        try:
+            backend = getattr(module, class_name)
+        except AttributeError:
+            raise ShareError("Backend %s not found for %s." %
+                             (available_backends[network], network))
+    _resolved_backends[network] = backend
+    return backend
 
 register_share_backend('linkedin','LinkedInBackend')
 register_share_backend('twitter','TwitterBackend')
@@ -39,11 +106,30 @@ register_share_backend('facebook','FacebookBackend')
 
 class ShareBackend(object):
     """Base class for share backends."""
+
+    # name the backend is registered under, used to key pools and limits
+    network = None
+    # most recipients the network takes in one message. None means no limit.
+    message_batch_size = None
+    # most message batches sent at once by send_message
+    message_workers = 4
+    # (calls, seconds) quotas per consumer token, None for no limit
+    rate_limit = None
+    message_rate_limit = None
+    unshare_rate_limit = None
+    # most deletes for one account running at once in unshare_many
+    unshare_workers = 4
+    # Transport for this backend. None uses transport.default_transport.
+    transport = None
+    # upload content.image_url and attach it natively instead of linking
+    # it, on backends that implement _upload_media. See socialshare.media.
+    attach_media = False
     
     def __init__(self, api_token, api_secret, consumer_token="", 
                  consumer_secret="", message="", headline="", excerpt="", 
                  tweet="", url="", url_title="", url_description ="", 
-                 image_url="", image_url_title="", image_url_description=""):
+                 image_url="", image_url_title="", image_url_description="",
+                 content=None):
         """Constructor
 
         Parameters:
@@ -51,12 +137,17 @@ class ShareBackend(object):
         api_secret -- a valid oauth api secret. This is your app's secret.
         consumer_token -- optional consumer token.
         consumer_secret -- optional consumer secret.
+        content -- optional ShareContent. Used as is instead of the content
+                   arguments, so one instance can be shared by many backends.
         """
         self.api_token = api_token.strip()
         self.api_secret = api_secret.strip()
         self.consumer_token = consumer_token.strip()
         self.consumer_secret = consumer_secret.strip()
         self.to = []
+        if content is not None:
+            self.content = content
+            return
         # deal with message content if we have it
         self.set_content(message, headline=headline, excerpt=excerpt, 
                          tweet=tweet, url=url, url_title=url_title,
@@ -82,53 +173,360 @@ class ShareBackend(object):
         image_url_description -- description of the URL
         
         """
-        self.message = message.strip()
-        # truncate at 128 characters
-        self.headline = headline[0:128].strip()
-        # If there is no excerpt use the headline
-        if not hasattr(self, 'excerpt'):
-            excerpt = self.headline
-        # if there is no tweet defined... create one.
-        self.excerpt = excerpt.strip()
-        if not hasattr(self, 'tweet'):
-            tweet = headline [0:160]
-        # truncate tweet if it is too long        
-        self.tweet = tweet[0:160].strip()
-        self.url = u'%s' % url.strip()
-        self.url_title = url_title
-        self.url_description = url_description.strip()
-        self.image_url = u'%s' % image_url.strip()
-        self.image_url_title = image_url_title.strip()
-        self.image_url_description = image_url_description.strip()
+        self.content = ShareContent(message, headline=headline,
+                                    excerpt=excerpt, tweet=tweet, url=url,
+                                    url_title=url_title,
+                                    url_description=url_description,
+                                    image_url=image_url,
+                                    image_url_title=image_url_title,
+                                    image_url_description=image_url_description)
+
+    # content fields read through to self.content. Setting one swaps in a
+    # changed copy, so content shared with other backends isn't touched.
+    message = _content_field('message')
+    headline = _content_field('headline')
+    excerpt = _content_field('excerpt')
+    tweet = _content_field('tweet')
+    url = _content_field('url')
+    url_title = _content_field('url_title')
+    url_description = _content_field('url_description')
+    image_url = _content_field('image_url')
+    image_url_title = _content_field('image_url_title')
+    image_url_description = _content_field('image_url_description')
         
-    def share(self):
-        """ Executes social network share""" 
-        result = self._share()
+    def client_key(self):
+        """Key the backend's API client is cached under."""
+        return (self.network, self.api_token, self.api_secret,
+                self.consumer_token, self.consumer_secret,
+                self.get_transport())
+
+    def get_transport(self):
+        """Returns the Transport to use, or None to use the network's SDK."""
+        return self.transport or transport.default_transport
+
+    def _get_api(self):
+        """Returns a cached API client for these credentials.
+
+        Builds one with _create_api the first time an account is used.
+        """
+        return clients.client_cache.get(self.client_key(), self._create_api)
+
+    def _create_api(self):
+        """Builds the network's API client. Like the goggles, does nothing."""
+        return None
+
+    def payload(self, **options):
+        """Returns what the network is sent for self.content.
+
+        Rendered once per content and cached; see socialshare.render. A
+        backend subclassed under its own network name renders like the
+        backend it extends, unless a renderer is registered for its name.
+        """
+        for class_ in type(self).__mro__:
+            network = class_.__dict__.get('network')
+            if network in render.renderer.renderers:
+                return render.renderer.render(network, self.content,
+                                              **options)
+        raise ShareError("No renderer for %s." % self.network)
+
+    def media_ids(self):
+        """Returns the IDs of the content's image uploaded to this account,
+        uploading it the first time.
+
+        Empty unless attach_media is set, the content has an image_url and
+        the backend can upload media.
+        """
+        if not self.attach_media or not self.content.image_url:
+            return []
+        cache = media.media_cache
+        with cache.source(self.content.image_url) as source:
+            media_id = cache.media_id(self.network, self.consumer_token,
+                                      source, self._upload_media)
+        return [media_id] if media_id is not None else []
+
+    def _upload_media(self, source):
+        """Uploads a fetched media.MediaSource and returns its media ID.
+        Like the goggles, does nothing."""
+        return None
+
+    def idempotency_key(self, *extra):
+        """Key identifying this content going to this account. Give extra
+        parts, such as a job id, to name one logical share; see
+        socialshare.retry."""
+        return retry.idempotency_key(self.network, self.consumer_token,
+                                     self.api_token, self.content.digest,
+                                     *extra)
+
+    def is_retryable(self, exc):
+        """True if exc is a transient error worth retrying.
+
+        Connection problems, server errors and rate limiting are retried.
+        Other ShareErrors, which backends raise when the network turned the
+        call down, are not.
+        """
+        status = _http_status(exc)
+        if status is not None:
+            return status >= 500 or status == 429
+        if isinstance(exc, ShareError):
+            return False
+        return isinstance(exc, (IOError, httplib.HTTPException))
+
+    def is_rate_limited(self, exc):
+        """True if exc says this account is over the network's rate limit.
+
+        Such errors are retried but don't count against the network's
+        circuit breaker, since one account's quota says nothing about the
+        network.
+        """
+        return _http_status(exc) == 429
+
+    def _retryable_unkeyed(self, exc):
+        """is_retryable for shares and messages sent without a key. A post
+        that timed out may have gone through, and Facebook and LinkedIn don't
+        turn duplicates down, so timeouts aren't retried."""
+        return not _timed_out(exc) and self.is_retryable(exc)
+
+    def share(self, key=None):
+        """ Executes social network share
+
+        Transient errors are retried. Timeouts are only retried when key is
+        given, as the post may have gone through.
+
+        Parameters:
+        key -- optional idempotency key. If a share with the same key went
+               through, its result is returned without calling the network.
+        """ 
+        return self._call_once('share', key, self._share_paced)
+
+    def _share_paced(self, call):
+        with call.stage('wait'):
+            ratelimit.rate_limiter.wait((self.network, self.consumer_token),
+                                        self.rate_limit)
+        with call.stage('api'):
+            return self._share()
+
+    def _call_once(self, operation, key, fn, args=(), recipients=None,
+                   post_id=None):
+        """Calls fn(call, *args) with retries unless key already went
+        through, and reports the call to the instrumentation hooks. A key of
+        None always calls fn.
+
+        post_id is the post the call is about, for calls on existing posts.
+        Otherwise it's taken from the network's response.
+
+        Raises CircuitOpen without calling fn while the network's circuit
+        breaker is open.
+        """
+        instrumentation = instrument.instrumentation
+        call = instrumentation.start(self.network, operation,
+                                     self.consumer_token, self.content.digest,
+                                     recipients)
+        done, result = (False, None) if key is None else retry.ledger.get(key)
+        if done:
+            instrumentation.finish(call, instrument.CACHED, result)
+            return result
+        is_retryable = self.is_retryable
+        if key is None and operation in ('share', 'message'):
+            is_retryable = self._retryable_unkeyed
+        circuit = breaker.breakers.get(self.network)
+        try:
+            circuit.before_call()
+            try:
+                result = retry.retry_policy.call(fn, is_retryable, call,
+                                                 *args)
+            except RateLimited:
+                circuit.release()
+                raise
+            except Exception, e:
+                if self.is_rate_limited(e):
+                    circuit.release()
+                elif self.is_retryable(e):
+                    circuit.record_failure()
+                else:
+                    # the network answered, it just said no
+                    circuit.record_success()
+                raise
+        except Exception, e:
+            instrumentation.finish(call, instrument.FAILED, exception=e)
+            raise
+        circuit.record_success()
+        if key is not None:
+            retry.ledger.record(key, result)
+        if post_id is None:
+            post_id = self.post_id(result)
+        instrumentation.finish(call, instrument.SUCCESS, result,
+                               post_id=post_id)
         return result
 
-    def send_message(self):
+    def post_id(self, result):
+        """Returns the ID of the post in a network response, or None."""
+        if isinstance(result, dict):
+            post_id = result.get('id_str') or result.get('id')
+        else:
+            post_id = (getattr(result, 'id_str', None) or
+                       getattr(result, 'id', None))
+        return None if post_id is None else unicode(post_id)
+
+    def send_message(self, pool=None, skip_duplicates=True, key=None):
         """Sends message using social network. 
 
+        self.to is split into batches of message_batch_size recipients and
+        the batches are sent at the same time. A failed batch doesn't stop
+        the others. Returns a DeliveryReport with a ShareResult per recipient.
+
         parameters:
-        to -- list of recipients in format expected by social network
+        pool -- optional SharePool to send the batches on.
+        skip_duplicates -- skip recipients that already got this content, see
+                           socialshare.dedup. Their results have status
+                           SKIPPED.
+        key -- optional idempotency key. Batches that went through with the
+               same key aren't sent again. Batches that time out are only
+               retried when key is given.
         """
         # Make sure we have recipients. If not, blow up.
         if self.to == []:
             raise ShareError("No recipients to send to.")
-        result = self._send_message()
-        return result
+        index = dedup.dedup_index
+        keys = [index.key(self.network, self.consumer_token, self.content,
+                          'message', recipient) if skip_duplicates else None
+                for recipient in self.to]
+        pending = [i for i, key in enumerate(keys)
+                   if key is None or not index.seen(key)]
+        size = self.message_batch_size or len(pending) or 1
+        batches = [pending[i:i + size] for i in range(0, len(pending), size)]
+        outcomes = self._send_batches(
+            [[self.to[i] for i in batch] for batch in batches], pool, key)
+        results = {}
+        for batch, outcome in zip(batches, outcomes):
+            for i in batch:
+                results[i] = outcome
+                if outcome.ok and keys[i] is not None:
+                    index.add(keys[i])
+        report = DeliveryReport()
+        for i, recipient in enumerate(self.to):
+            report.add(recipient, results.get(i) or
+                       ShareResult(self.network, self.consumer_token,
+                                   status=SKIPPED, latency=0))
+        return report
+
+    def _send_batches(self, batches, pool=None, key=None):
+        """Sends batches of recipients, at the same time if there are
+        several. Returns a ShareResult per batch."""
+        send = lambda recipients: self._send_one(recipients, key)
+        if len(batches) < 2:
+            return [send(batch) for batch in batches]
+        if pool is not None:
+            return [f.result() for f in pool.map(self.network, send, batches)]
+        workers = min(len(batches), self.message_workers)
+        with SharePool(max_workers=workers) as pool:
+            futures = pool.map(self.network, send, batches)
+            return [f.result() for f in futures]
+
+    def _send_one(self, recipients, key=None):
+        if key is not None:
+            key = retry.idempotency_key(self.network, self.consumer_token,
+                                        key, 'message', *recipients)
+        return timed_call(self.network, self.consumer_token, self._call_once,
+                          'message', key, self._send_paced, (recipients,),
+                          recipients)
+
+    def _send_paced(self, call, recipients):
+        with call.stage('wait'):
+            ratelimit.rate_limiter.wait(
+                (self.network, self.consumer_token, 'message'),
+                self.message_rate_limit)
+        with call.stage('api'):
+            return self._send_batch(recipients)
+
+    def unshare(self, post_id):
+        """Deletes a post this account made, by the ID the network gave
+        back when it was shared (see post_id).
+
+        Transient errors are retried, and a post that's already gone counts
+        as deleted. Returns the network's response.
+        """
+        key = retry.idempotency_key(self.network, self.consumer_token,
+                                    self.api_token, 'unshare', post_id)
+        return self._call_once('unshare', key, self._unshare_paced,
+                               (post_id,), post_id=post_id)
+
+    def _unshare_paced(self, call, post_id):
+        with call.stage('wait'):
+            ratelimit.rate_limiter.wait(
+                (self.network, self.consumer_token, 'unshare'),
+                self.unshare_rate_limit)
+        with call.stage('api'):
+            try:
+                return self._unshare(post_id)
+            except Exception, e:
+                if _http_status(e) == 404:
+                    return None
+                raise
+
+    def unshare_many(self, post_ids, pool=None):
+        """Deletes many posts this account made, unshare_workers at a time.
+
+        A failed delete doesn't stop the others. Returns a DeliveryReport
+        with a ShareResult per post ID.
+
+        parameters:
+        pool -- optional SharePool to run on.
+        """
+        post_ids = list(post_ids)
+        if pool is not None:
+            futures = pool.map(self.network, self._unshare_one, post_ids)
+            outcomes = [f.result() for f in futures]
+        else:
+            workers = min(len(post_ids), self.unshare_workers) or 1
+            with SharePool(max_workers=workers) as pool:
+                futures = pool.map(self.network, self._unshare_one, post_ids)
+                outcomes = [f.result() for f in futures]
+        report = DeliveryReport()
+        for post_id, outcome in zip(post_ids, outcomes):
+            report.add(post_id, outcome)
+        return report
+
+    def _unshare_one(self, post_id):
+        return timed_call(self.network, self.consumer_token, self.unshare,
+                          post_id)
         
-    def _send_message(self):
-        """Sends message: Like the goggles, does nothing."""
+    def ashare(self, pool=None):
+        """Executes social network share without blocking.
+
+        Returns a ShareFuture. Backends with their own non-blocking client
+        can override this; by default share() runs on a SharePool.
+
+        Parameters:
+        pool -- optional SharePool to run on. Defaults to the shared pool.
+        """
+        pool = pool or get_default_pool()
+        return pool.submit(self.network, self.share)
+
+    def asend_message(self, pool=None):
+        """Sends message without blocking. Returns a ShareFuture.
+
+        Parameters:
+        pool -- optional SharePool to run on. Defaults to the shared pool.
+        """
+        pool = pool or get_default_pool()
+        return pool.submit(self.network, self.send_message)
+
+    def _send_batch(self, recipients):
+        """Sends message to one batch of recipients: Like the goggles, does
+        nothing."""
         pass
 
     def _share(self):
         """Shares. Like the goggles, does nothing."""
         pass
+
+    def _unshare(self, post_id):
+        """Deletes a post. Like the goggles, does nothing."""
+        pass
     
     
 class DebugBackend(ShareBackend):
-    """Implements backend for testing. _share and _send_message return message.
+    """Implements backend for testing. _share and _send_batch return message.
     
     you can also set print 
     
@@ -141,7 +539,8 @@ class DebugBackend(ShareBackend):
     Backend Specific Parameters:
     print_message: True writes to STDIO. False doesn't print
     """
-    
+    network = 'debug'
+
     def __init__(self, *args, **kwargs):
         super(DebugBackend, self).__init__(*args, **kwargs)
 
@@ -161,21 +560,21 @@ class DebugBackend(ShareBackend):
              self.image_url]
         return m
 
-    def _send_message(self, print_message=False):
+    def _send_batch(self, recipients, print_message=False):
         """sends message"""
         if print_message:
             print "consumer token  ", self.consumer_token
             print "consumer secret ", self.consumer_secret
-            for t in self.to:
+            for t in recipients:
                 print "to:        ", t
-            print "subject:   ",self.subject
+            print "subject:   ",self.headline
             print "message:   ",self.message or None
             print "url:       ",self.url or None
             print "image_url: ",self.image_url or None        
         m = [self.api_token, self.api_secret, self.consumer_secret,
                      self.consumer_token, self.headline, self.excerpt, self.message, 
                      self.url, self.tweet, self.url_title, self.url_description, 
-                     self.image_url,self.to]
+                     self.image_url, recipients]
         return m        
 
 class LinkedInBackend(ShareBackend):
@@ -189,20 +588,37 @@ class LinkedInBackend(ShareBackend):
     LinkedIn Specific Settings:
     visibility -- "connections_only", "anyone" (default) 
     """
+    network = 'linkedin'
+    # LinkedIn truncates messages at 10 recipients
+    message_batch_size = 10
+    # LinkedIn throttles per member per day
+    rate_limit = (100, 24 * 60 * 60)
+    message_rate_limit = (100, 24 * 60 * 60)
+
     def __init__(self, *args, **kwargs):
         super(LinkedInBackend, self).__init__( *args, **kwargs)
         # Handle custom parameters for backend
         self.callback_url = kwargs.get('callback_url') or ''
         self.visibility = kwargs.get('visibility') or 'anyone'
-        # instantiate a linkedin API. 
+        self.api = self._get_api()
+
+    def _create_api(self):
+        """Instantiates a linkedin API."""
+        transport_ = self.get_transport()
+        if transport_ is not None:
+            return transport.LinkedInClient(transport_, self.api_token,
+                                            self.api_secret,
+                                            self.consumer_token,
+                                            self.consumer_secret)
         from linkedin import linkedin
         # First instantiate the api object.
-        self.api = linkedin.LinkedIn(api_key=self.api_token, 
+        api = linkedin.LinkedIn(api_key=self.api_token, 
             api_secret=self.api_secret, callback_url='http://localhost.com')
         # Force api to use a stored token/secret instead of getting one.
         # (Due to the way Python-LinkedIN is put together)
-        self.api._access_token = self.consumer_token
-        self.api._access_token_secret = self.consumer_secret
+        api._access_token = self.consumer_token
+        api._access_token_secret = self.consumer_secret
+        return api
 
     def _share(self, connections_only=True):
         """Shares a URL via LinkedIn's API. No web browser required."""
@@ -212,29 +628,43 @@ class LinkedInBackend(ShareBackend):
         else:
             visibility = 'everyone'
             
-        result = self.api.share_update(comment=self.message, 
-                                       title=self.headline,
-                                       submitted_url=self.url, 
-                                       submitted_image_url=self.image_url,
-                                       description=self.excerpt, 
-                                       visibility=visibility)         
+        result = self.api.share_update(visibility=visibility,
+                                       **self.payload())
         # python-linkedin doesn't do exceptions so we have to check for errors.
         if result == False:
             raise ShareError, self.api.get_error()
+        return result
+
+    def post_id(self, result):
+        """LinkedIn names shares by their update key."""
+        if isinstance(result, dict):
+            return result.get('updateKey')
+        return None
+
+    def _unshare(self, post_id):
+        """Deletes a share by its update key. python-linkedin can't delete
+        shares, so this needs a transport."""
+        if not hasattr(self.api, 'delete_share'):
+            raise ShareError("Deleting LinkedIn shares needs a transport.")
+        result = self.api.delete_share(post_id)
+        if result == False:
+            raise ShareError, self.api.get_error()
+        return result
 
-    def _send_message(self):
+    def _send_batch(self, recipients):
         """Implements python-linkedin send message.
 
-        Note: to is a list of LinkedIn IDs and is truncated at 10 recipients.
+        Note: recipients is a list of up to 10 LinkedIn IDs.
         """
 
         # send the message with LI API
-        result = self.api.send_message(subject=self.subject, 
+        result = self.api.send_message(subject=self.headline, 
                                        message=self.message, 
-                                       ids=self.to)
+                                       ids=recipients)
         # python-linkedin doesn't do exceptions so we have to check for errors.
         if result == False:
             raise ShareError, self.api.get_error()
+        return result
 
 
 class TwitterBackend(ShareBackend):
@@ -249,91 +679,167 @@ class TwitterBackend(ShareBackend):
     Twitter Specific Settings:
     use_tco -- True or False, use Twitter's t.co shortner.
     """
+    network = 'twitter'
+    # direct messages go to one user at a time
+    message_batch_size = 1
+    message_workers = 8
+    # statuses/update and direct message quotas per user
+    rate_limit = (300, 3 * 60 * 60)
+    message_rate_limit = (1000, 24 * 60 * 60)
+
     def __init__(self, *args, **kwargs):
-        super(TwitterBackend, self).__init__(*args, **kwargs)
         # handle twitter custom parameters
-        self.use_tco= kwargs.get('use_tco') or True
-        # create a tweepy API
+        self.use_tco = kwargs.pop('use_tco', True)
+        super(TwitterBackend, self).__init__(*args, **kwargs)
+        self.api = self._get_api()
+
+    def _create_api(self):
+        """Creates a tweepy API."""
+        transport_ = self.get_transport()
+        if transport_ is not None:
+            return transport.TwitterClient(transport_, self.consumer_token,
+                                           self.consumer_secret,
+                                           self.api_token, self.api_secret)
         from tweepy import API, OAuthHandler
         auth = OAuthHandler(self.consumer_token, self.consumer_secret)
         auth.set_access_token(self.api_token, self.api_secret)
         # Set up API
-        self.api = API(auth)
-
-    def send_message(self, use_tco = 'true'):
+        return API(auth)
+
+    def _upload_media(self, source):
+        """Uploads media with the chunked upload API, or tweepy's
+        media_upload when there's no transport."""
+        if hasattr(self.api, 'upload_media'):
+            return self.api.upload_media(source)
+        if hasattr(self.api, 'media_upload'):
+            return self.api.media_upload(source.path).media_id
+        return None
+
+    def send_message(self, pool=None, skip_duplicates=True, key=None,
+                     use_tco=None):
         """Processes and sends direct message.
         
         parameters:
-        
-        use_tco -- use the t.co url shortner
+        pool -- optional SharePool to send on.
+        skip_duplicates -- skip recipients that already got this content
+        key -- optional idempotency key
+        use_tco -- use the t.co url shortner. Defaults to the backend setting.
         """
-        self.subject = subject.strip()
-        self.message = message.strip()
-        self.url = url.strip()       
-        # Use url t.co url shortner?
-        if self.tweet != '':
-            self.tweet = _clean_tweet(use_tco=use_tco or False)    
-        _send_message()
+        if use_tco is not None:
+            self.use_tco = use_tco
+        return super(TwitterBackend, self).send_message(
+            pool=pool, skip_duplicates=skip_duplicates, key=key)
     
-    def _send_message(self):
+    def _send_batch(self, recipients):
         """Implemets tweepy send direct message.
 
-        Note: to is a list of Twitter IDs or Twitter usernames.
+        Note: recipients are Twitter IDs or Twitter usernames.
               Twitter usernames can change, Twitter IDs do not.
         """
-        # Loop throught the to's
-        from tweepy.error import TweepError
-        for t in self.to:
-            self.api.send_direct_message(user=t, text=self.tweet)
-
-
-    def _clean_tweet(self, use_tco=True):
-        """Creates tweets by truncating subject at appropriate length.
-        
-        Length is calculated using the length of a t.co URL or the provided URL
-        depending the use_tco parameter. 
-        """
-        
-        if use_tco:
-            length = 160 - 19
-            tweet = u'%s %s' % self.subject[0:length], self.url
-        else:
-            length = 160-len(self.url)-1
-            tweet = u'%s %s' % self.subject[0:length], self.url
-        return tweet
+        text = self.payload(use_tco=self.use_tco)
+        return [self.api.send_direct_message(user=t, text=text)
+                for t in recipients]
 
     def _share(self):
         """Implements "sharing" on twitter which is exactly like tweeting.
         
         Note: Tweeting is the same as "updating your status".
         """
-        result = self.api.update_status(status=self.tweet)
+        status = self.payload(use_tco=self.use_tco)
+        media_ids = self.media_ids()
+        try:
+            if media_ids:
+                return self.api.update_status(status=status,
+                                              media_ids=media_ids)
+            return self.api.update_status(status=status)
+        except Exception, e:
+            # Twitter refuses duplicate statuses, so an earlier attempt
+            # already posted this one.
+            if 'duplicate' in str(e).lower():
+                return None
+            raise
+
+    def _unshare(self, post_id):
+        """Deletes a tweet."""
+        return self.api.destroy_status(id=post_id)
+
+
+# Graph API errors for unknown, service, too many calls, user request limit
+# and application limit
+FACEBOOK_TRANSIENT_CODES = (1, 2, 4, 17, 341)
+# Graph API errors for too many calls, user request limit, page request
+# limit and application limit, and the same for a single call type
+FACEBOOK_RATE_LIMIT_CODES = (4, 17, 32, 341, 613)
 
 
 class FacebookBackend(ShareBackend):
     """Implements Facebook backend"""
+    network = 'facebook'
+    message_batch_size = 50
+    # Graph API calls per user per hour
+    rate_limit = (200, 60 * 60)
+    message_rate_limit = (200, 60 * 60)
+    unshare_rate_limit = (200, 60 * 60)
+
     def __init__(self, *args, **kwargs):
         super(FacebookBackend, self).__init__(*args, **kwargs)
-        # Create a Facebook social graph API using facepy.     
+        self.api = self._get_api()
+
+    def _create_api(self):
+        """Creates a Facebook social graph API using facepy."""
+        transport_ = self.get_transport()
+        if transport_ is not None:
+            return transport.FacebookClient(transport_, self.consumer_token)
         from facepy import GraphAPI
-        self.api = GraphAPI()
-        self.api.oauth_token = self.consumer_token
+        api = GraphAPI()
+        api.oauth_token = self.consumer_token
+        return api
 
     def _share(self):
         """Implements sharing on Facebook by making wall posts."""
         # send the message
         # TODO add support for icons to posts and messages
-        response = self.api.post(path='me/feed',
-                                 message=self.excerpt,
-                                 picture=self.image_url or None,
-                                 caption = self.image_url_title, 
-                                 link = self.url or None,
-                                 name=self.url_title,
-                                 description=self.url_description)
+        payload = self.payload()
+        media_ids = self.media_ids()
+        if media_ids:
+            payload = dict(payload, picture=None, attached_media=json.dumps(
+                [{'media_fbid': i} for i in media_ids]))
+        response = self.api.post(path='me/feed', **payload)
         if response is None:
             raise ShareError, "Facebook post to feed failed."
-
-    def _send_message(self):
+        return response
+
+    def _unshare(self, post_id):
+        """Deletes a wall post."""
+        response = self.api.delete(path=post_id)
+        if response is False or response is None:
+            raise ShareError, "Facebook delete of %s failed." % post_id
+        return response
+
+    def _upload_media(self, source):
+        """Uploads the image as an unpublished photo to attach to posts."""
+        if hasattr(self.api, 'upload_photo'):
+            return self.api.upload_photo(source)
+        with source.open() as f:
+            response = self.api.post(path='me/photos', source=f,
+                                     published=False)
+        return response['id']
+
+    def is_retryable(self, exc):
+        """Retries connection errors and Graph API's transient error codes."""
+        code = getattr(exc, 'code', None)
+        if code is not None:
+            return code in FACEBOOK_TRANSIENT_CODES
+        return super(FacebookBackend, self).is_retryable(exc)
+
+    def is_rate_limited(self, exc):
+        """Graph API rate limits come as error codes."""
+        code = getattr(exc, 'code', None)
+        if code is not None:
+            return code in FACEBOOK_RATE_LIMIT_CODES
+        return super(FacebookBackend, self).is_rate_limited(exc)
+
+    def _send_batch(self, recipients):
         """Implements send a message to a facebook user"""
         
         # Facebook accepts an array of name/id objects.
@@ -341,8 +847,9 @@ class FacebookBackend(ShareBackend):
                                  message = self.message,
                                  picture=self.image_url or None,
                                  link = self.url or None,
-                                 to=self.to)
+                                 to=recipients)
         if response is None:
             raise ShareError, "Facebook outbox Failure"
+        return response
 
 
@@ -0,0 +1,272 @@
+"""
+benchmarks.py -- measures share fan-out throughput and per-share overhead.
+
+                 Runs shares against DebugBackend and a LatencyBackend that
+                 sleeps like a network would, over a matrix of fan-out widths,
+                 content sizes and concurrency modes, and reports shares/sec,
+                 p50/p99 latency and objects allocated per share. Results can
+                 be saved as a baseline and later runs compared against it:
+
+                     python -m socialshare.benchmarks --save
+                     python -m socialshare.benchmarks --compare
+
+                 Each scenario runs --repeat times and reports the median
+                 of every metric. --compare exits 1 if any scenario's
+                 throughput drops more than --tolerance below the baseline
+                 and it takes at least --min-delta seconds longer, so a
+                 millisecond of scheduling noise on a one-share run isn't
+                 a regression.
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+
+import dedup
+import retry
+from backends import DebugBackend, register_share_backend
+from content import ShareContent
+from pool import SharePool
+from stream import share_stream
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks', 'baseline.json')
+
+WIDTHS = (1, 10, 100, 1000)
+# runs of each scenario; reported metrics are the medians
+REPEAT = 5
+# least extra seconds a run must take to count as a regression
+MIN_DELTA = 0.005
+MODES = ('serial', 'threads', 'async', 'stream', 'process')
+CONTENT_SIZES = {
+    'short': dict(headline='Corgi wrangler wanted',
+                  url='http://example.com/jobs/1'),
+    'long': dict(headline='Senior corgi wrangler ' * 8,
+                 message='Must love corgis. ' * 200,
+                 excerpt='Corgis need wrangling. ' * 20,
+                 url='http://example.com/jobs/1?' + 'q=corgi&' * 20,
+                 url_title='Corgi wrangler', url_description='x' * 500,
+                 image_url='http://example.com/corgi.png'),
+}
+
+
+class LatencyBackend(DebugBackend):
+    """DebugBackend that takes about latency seconds per share, +/- jitter."""
+    network = 'bench'
+    latency = 0.002
+    jitter = 0.5
+
+    def _share(self):
+        delay = self.latency * (1 + random.uniform(-self.jitter, self.jitter))
+        time.sleep(max(0, delay))
+        return super(LatencyBackend, self)._share()
+
+
+def percentile(values, pct):
+    """Returns the pct percentile of values by nearest rank."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+
+def _median(runs):
+    """Returns the median of each metric over runs, a list of dicts."""
+    return dict((key, percentile([run[key] for run in runs
+                                  if run[key] is not None], 50))
+                for key in runs[0])
+
+
+def _shares(width):
+    return [{'network': 'bench', 'consumer_token': 'account%i' % i,
+             'consumer_secret': 'secret'} for i in range(width)]
+
+
+def run_fanout(mode, width, size, workers=32):
+    """Shares one posting to width accounts. Returns (results, seconds)."""
+    start = time.time()
+    if mode == 'stream':
+        records = [dict(CONTENT_SIZES[size])]
+        results = list(share_stream(records, _shares(width), 'token',
+                                    'secret', max_workers=workers))
+        return results, time.time() - start
+    import socialshare
+    share = socialshare.SocialShare('token', 'secret', shares=_shares(width),
+                                    **CONTENT_SIZES[size])
+    if mode == 'serial':
+        results = share.do_bulk_share(max_workers=1)
+    elif mode == 'threads':
+        results = share.do_bulk_share(max_workers=workers)
+    elif mode == 'async':
+        async_share = socialshare.AsyncSocialShare.from_dict(share.to_dict())
+        with SharePool(max_workers=workers) as pool:
+            futures = async_share.do_bulk_share(pool=pool)
+            results = [f.result() for f in futures]
+    elif mode == 'process':
+        results = share.do_bulk_share(max_workers=workers, mode='process')
+    else:
+        raise ValueError("Unknown mode %s" % mode)
+    return results, time.time() - start
+
+
+def measure(fn, n):
+    """Runs fn() and returns (value, seconds, objects allocated per item).
+
+    Objects are counted with the collector off while fn's result is still
+    referenced, so they are the objects each item leaves behind.
+    """
+    retry.ledger.clear()
+    dedup.dedup_index.clear()
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        start = time.time()
+        value = fn()
+        elapsed = time.time() - start
+        objects = (len(gc.get_objects()) - before) / float(n)
+    finally:
+        gc.enable()
+    return value, elapsed, objects
+
+
+def bench_fanout(mode, width, size, latency, repeat=REPEAT):
+    LatencyBackend.latency = latency
+    runs = []
+    for attempt in range(repeat):
+        (results, elapsed), _, objects = measure(
+            lambda: run_fanout(mode, width, size), width)
+        latencies = [r.latency for r in results]
+        failed = len([r for r in results if not r.ok])
+        runs.append({'shares_per_sec': width / elapsed if elapsed else None,
+                     'shares_seconds': elapsed,
+                     'p50_ms': percentile(latencies, 50) * 1000,
+                     'p99_ms': percentile(latencies, 99) * 1000,
+                     'objects_per_share': objects,
+                     'failed': failed})
+    return _median(runs)
+
+
+def bench_construct(size, n=2000, repeat=REPEAT):
+    """Per-share overhead of building a backend, with shared ShareContent
+    and with content keyword arguments."""
+    fields = CONTENT_SIZES[size]
+    content = ShareContent(**fields)
+    runs = []
+    for attempt in range(repeat):
+        out = {}
+        for name, build in (
+                ('content', lambda: [DebugBackend('t', 's', consumer_token='c',
+                                                  content=content)
+                                     for i in xrange(n)]),
+                ('kwargs', lambda: [DebugBackend('t', 's', consumer_token='c',
+                                                 **fields)
+                                    for i in xrange(n)])):
+            value, elapsed, objects = measure(build, n)
+            out['%s_per_sec' % name] = n / elapsed if elapsed else None
+            out['%s_seconds' % name] = elapsed
+            out['%s_objects' % name] = objects
+        runs.append(out)
+    return _median(runs)
+
+
+def run(widths=WIDTHS, modes=MODES, sizes=('short', 'long'), latency=0.002,
+        repeat=REPEAT, out=sys.stdout):
+    """Runs every scenario repeat times. Returns {scenario name: median
+    metrics}."""
+    register_share_backend('bench', LatencyBackend)
+    results = {}
+    for size in sizes:
+        name = 'construct/%s' % size
+        results[name] = bench_construct(size, repeat=repeat)
+        _report(name, results[name], out)
+        for mode in modes:
+            for width in widths:
+                if mode == 'serial' and width * latency > 5:
+                    continue
+                name = 'fanout/%s/%s/%i' % (mode, size, width)
+                results[name] = bench_fanout(mode, width, size, latency,
+                                             repeat)
+                _report(name, results[name], out)
+    return results
+
+
+def _report(name, metrics, out):
+    if out is None:
+        return
+    out.write('%-32s %s\n' % (name, '  '.join(
+        '%s=%.4g' % (k, v) for k, v in sorted(metrics.items())
+        if v is not None)))
+
+
+def compare(results, baseline, tolerance=0.2, min_delta=MIN_DELTA,
+            out=sys.stdout):
+    """Prints throughput changes against baseline. Returns the names of
+    scenarios where a throughput (an X_per_sec metric) dropped by more than
+    tolerance and its run time (X_seconds) grew by at least min_delta."""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        for key, value in sorted(results[name].items()):
+            if not key.endswith('_per_sec') or not baseline[name].get(key):
+                continue
+            seconds_key = key[:-len('_per_sec')] + '_seconds'
+            seconds = results[name].get(seconds_key)
+            base_seconds = baseline[name].get(seconds_key)
+            noise = (seconds is not None and base_seconds is not None and
+                     seconds - base_seconds < min_delta)
+            change = value / baseline[name][key] - 1
+            if out is not None:
+                out.write('%-32s %-18s %+.1f%%\n' %
+                          (name, key, change * 100))
+            if change < -tolerance and not noise:
+                regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--widths', type=int, nargs='+', default=WIDTHS)
+    parser.add_argument('--modes', nargs='+', default=MODES, choices=MODES)
+    parser.add_argument('--sizes', nargs='+', default=['short', 'long'],
+                        choices=sorted(CONTENT_SIZES))
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='seconds each simulated share takes')
+    parser.add_argument('--repeat', type=int, default=REPEAT,
+                        help='runs of each scenario (default %i)' % REPEAT)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the baseline')
+    parser.add_argument('--compare', action='store_true',
+                        help='compare the results with the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed throughput drop, 0.2 is 20%%')
+    parser.add_argument('--min-delta', type=float, default=MIN_DELTA,
+                        help='least extra seconds a run must take to count '
+                             'as slower (default %g)' % MIN_DELTA)
+    args = parser.parse_args(argv)
+    results = run(args.widths, args.modes, args.sizes, args.latency,
+                  args.repeat)
+    status = 0
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance,
+                              args.min_delta)
+        if regressions:
+            sys.stdout.write('Slower than baseline: %s\n' %
+                             ', '.join(sorted(set(regressions))))
+            status = 1
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
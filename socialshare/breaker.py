@@ -0,0 +1,152 @@
+"""
+breaker.py -- circuit breakers that stop calling networks that are down.
+
+              Each network gets a CircuitBreaker. After failure_threshold
+              transient failures in a row (timeouts, connection errors, 5xx)
+              the breaker opens and shares for that network fail right
+              away with CircuitOpen instead of tying up a worker until they
+              time out. After reset_timeout seconds it lets a few trial
+              calls through (half open); a success closes it again and a
+              failure opens it for another reset_timeout. Other networks are
+              not affected. Rate limit errors (429) are about one account,
+              not the network, so they don't count.
+
+                  breaker.breakers.configure('linkedin', failure_threshold=3,
+                                             reset_timeout=120)
+"""
+import threading
+import time
+
+from errors import CircuitOpen
+
+# breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """Tracks the health of one network.
+
+    Parameters:
+    name -- what the breaker guards, used in error messages
+    failure_threshold -- transient failures in a row that open the breaker
+    reset_timeout -- seconds the breaker stays open before a trial call
+    half_open_calls -- trial calls allowed at once while half open
+    clock -- optional time function, for testing
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30,
+                 half_open_calls=1, clock=time.time):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened = None
+        self._trials = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if (self._state == OPEN and
+                self.clock() - self._opened >= self.reset_timeout):
+            self._state = HALF_OPEN
+            self._trials = 0
+        return self._state
+
+    def before_call(self):
+        """Raises CircuitOpen unless a call may go through now."""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and self._trials < self.half_open_calls:
+                self._trials += 1
+                return
+            retry_after = max(0, self._opened + self.reset_timeout -
+                              self.clock())
+        raise CircuitOpen("Circuit for %s is open." % self.name,
+                          retry_after=retry_after)
+
+    def record_success(self):
+        """The network answered. Closes the breaker."""
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._trials = 0
+
+    def record_failure(self):
+        """The network failed transiently."""
+        with self._lock:
+            self._failures += 1
+            if (self._current_state() == HALF_OPEN or
+                    self._failures >= self.failure_threshold):
+                self._state = OPEN
+                self._opened = self.clock()
+                self._trials = 0
+
+    def release(self):
+        """A call let through ended without telling anything about the
+        network, e.g. it was rate limited before being sent."""
+        with self._lock:
+            if self._state == HALF_OPEN and self._trials:
+                self._trials -= 1
+
+    def reset(self):
+        self.record_success()
+
+    def __repr__(self):
+        return '<CircuitBreaker %s %s>' % (self.name, self.state)
+
+
+class BreakerRegistry(object):
+    """A CircuitBreaker per network, made the first time it's needed.
+
+    Parameters:
+    defaults -- CircuitBreaker keyword arguments used for every network
+    """
+
+    def __init__(self, **defaults):
+        self.defaults = defaults
+        self.settings = {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def configure(self, network, **settings):
+        """Sets CircuitBreaker keyword arguments for network. Replaces the
+        network's breaker, closing it."""
+        with self._lock:
+            self.settings[network] = settings
+            self._breakers.pop(network, None)
+
+    def get(self, network):
+        with self._lock:
+            breaker = self._breakers.get(network)
+            if breaker is None:
+                settings = dict(self.defaults)
+                settings.update(self.settings.get(network, {}))
+                breaker = CircuitBreaker(network, **settings)
+                self._breakers[network] = breaker
+            return breaker
+
+    def states(self):
+        """Returns {network: state} for every breaker made so far."""
+        with self._lock:
+            breakers = self._breakers.items()
+        return dict((network, b.state) for network, b in breakers)
+
+    def reset(self):
+        """Closes every breaker."""
+        with self._lock:
+            self._breakers.clear()
+
+
+# used by all backends
+breakers = BreakerRegistry()
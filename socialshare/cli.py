@@ -0,0 +1,304 @@
+"""
+cli.py -- the socialshare command.
+
+          socialshare worker --db shares.db --workers 8
+              drains a SQLite share queue filled by SocialShare.enqueue()
+
+          socialshare scheduler --db schedule.db --queue shares.db
+              hands shares stored by SocialShare.schedule() to the queue
+              (or shares them itself without --queue) when they are due
+
+          socialshare share postings.jsonl --accounts accounts.csv \
+                  --checkpoint backfill.db --workers 16
+              shares every record of a JSON lines or CSV file with every
+              account, printing progress as it goes. Run it again with the
+              same --checkpoint to pick up after an interruption.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+
+import backends
+import dedup
+import jobs
+import ratelimit
+import schedule
+import stream
+from pool import FAILED, SKIPPED
+
+# longest a share sleeps on a rate limit in the worker. A share that would
+# wait longer is put off until the quota is back instead of holding a thread.
+MAX_RATE_WAIT = 60
+# the same for the scheduler sharing due shares itself, one at a time
+SCHEDULER_RATE_WAIT = 5
+
+
+def register_backends(specs):
+    """Registers NETWORK=BACKEND strings given on the command line."""
+    for spec in specs or []:
+        network, sep, backend = spec.partition('=')
+        if not sep:
+            raise SystemExit("--backend expects NETWORK=BACKEND, got %s" % spec)
+        backends.register_share_backend(network, backend)
+
+
+def worker(args):
+    """Runs a Worker against a SQLite job queue."""
+    import socialshare
+    register_backends(args.backend)
+    # so a retried job skips the networks its last attempt got through to
+    dedup.dedup_index = dedup.DedupIndex(dedup.SQLiteDedupStore(args.db))
+    ratelimit.rate_limiter.max_wait = args.max_rate_wait
+    queue = jobs.SQLiteJobQueue(args.db, max_attempts=args.max_attempts)
+    w = jobs.Worker(queue, socialshare.share_job, workers=args.workers,
+                    timeout=args.timeout, poll_interval=args.poll_interval)
+    w.run(stop_when_empty=args.once)
+    return 0
+
+
+def scheduler(args):
+    """Runs a Scheduler against a SQLite schedule."""
+    import socialshare
+    register_backends(args.backend)
+    if args.queue:
+        handler = jobs.SQLiteJobQueue(args.queue).put
+    else:
+        # shares run on the scheduler's thread, so one waiting on a rate
+        # limit would hold up every other due share
+        ratelimit.rate_limiter.max_wait = args.max_rate_wait
+        handler = socialshare.share_job
+    s = schedule.Scheduler(schedule.SQLiteScheduleStore(args.db), handler,
+                           max_rate=args.max_rate,
+                           poll_interval=args.poll_interval)
+    if args.once:
+        s.run_pending()
+    else:
+        try:
+            s.run()
+        except KeyboardInterrupt:
+            s.stop()
+    return 0
+
+
+def read_records(path):
+    """Reads a .csv file with read_csv and anything else as JSON lines."""
+    if path.lower().endswith('.csv'):
+        return stream.read_csv(path)
+    return stream.read_jsonl(path)
+
+
+def parse_limits(specs):
+    """Returns {network: n} from NETWORK=N strings."""
+    limits = {}
+    for spec in specs or []:
+        network, sep, n = spec.partition('=')
+        if not sep or not n.isdigit():
+            raise SystemExit("--limit expects NETWORK=N, got %s" % spec)
+        limits[network] = int(n)
+    return limits
+
+
+class Progress(object):
+    """Counts share results and writes throughput and error stats.
+
+    Parameters:
+    out -- file the stats are written to. Defaults to stderr.
+    interval -- least seconds between progress lines, 0 for none
+    clock -- optional time function, for testing
+    """
+
+    def __init__(self, out=None, interval=2.0, clock=time.time):
+        self.out = out or sys.stderr
+        self.interval = interval
+        self.clock = clock
+        self.started = self._last = clock()
+        self.total = 0
+        self.statuses = defaultdict(int)
+        self.failed = defaultdict(int)
+        self.errors = defaultdict(int)
+
+    def update(self, result):
+        self.total += 1
+        self.statuses[result.status] += 1
+        if result.status == FAILED:
+            self.failed[result.network] += 1
+            self.errors[(result.network, type(result.exception).__name__,
+                         str(result.exception)[:100])] += 1
+        if self.interval and self.clock() - self._last >= self.interval:
+            self._last = self.clock()
+            self.write()
+
+    def line(self):
+        elapsed = max(self.clock() - self.started, 1e-9)
+        line = '%i shares in %.0fs (%.1f/s), %i failed, %i skipped' % (
+            self.total, elapsed, self.total / elapsed,
+            self.statuses[FAILED], self.statuses[SKIPPED])
+        if self.failed:
+            line += ' [%s]' % ', '.join('%s %i' % item for item in
+                                        sorted(self.failed.items()))
+        return line
+
+    def write(self):
+        self.out.write(self.line() + '\n')
+        self.out.flush()
+
+    def summary(self, errors=5):
+        """Writes the final stats and the most common errors."""
+        self.write()
+        top = sorted(self.errors.items(), key=lambda item: -item[1])
+        for (network, name, message), count in top[:errors]:
+            self.out.write('  %i x %s %s: %s\n' % (count, network, name,
+                                                    message))
+        self.out.flush()
+
+
+def share(args):
+    """Shares a file of content records with a file of accounts."""
+    register_backends(args.backend)
+    shares = list(read_records(args.accounts)) if args.accounts else []
+    records = read_records(args.content)
+    if args.dry_run:
+        records = _dry_run(records, shares)
+    checkpoint = None
+    if args.checkpoint and not args.dry_run:
+        checkpoint = stream.Checkpoint(args.checkpoint,
+                                       os.path.abspath(args.content))
+        if checkpoint.position:
+            logging.info("Resuming after record %i.", checkpoint.position)
+        records = checkpoint.resume(records, shares)
+        if not args.share_duplicates:
+            # so records shared just before an interruption are skipped
+            dedup.dedup_index = dedup.DedupIndex(
+                dedup.SQLiteDedupStore(args.checkpoint))
+    progress = Progress(interval=args.progress)
+    results = stream.share_stream(
+        records, shares, args.api_token, args.api_secret,
+        max_workers=args.workers, max_in_flight=args.max_in_flight,
+        network_limits=parse_limits(args.limit),
+        skip_duplicates=not args.share_duplicates)
+    interrupted = False
+    try:
+        for result in results:
+            progress.update(result)
+            if checkpoint is not None:
+                checkpoint.finished(result)
+    except KeyboardInterrupt:
+        interrupted = True
+        results.close()
+    if checkpoint is not None:
+        checkpoint.save()
+    progress.summary()
+    if interrupted:
+        return 130
+    return 1 if progress.failed else 0
+
+
+def _dry_run(records, shares):
+    """Yields records, first registering DebugBackend for each network they
+    would be shared to."""
+    seen = set()
+    for record in records:
+        for s in record.get('shares') or shares:
+            if s['network'] not in seen:
+                seen.add(s['network'])
+                backends.register_share_backend(s['network'],
+                                                'DebugBackend')
+        yield record
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='socialshare',
+        description='Share to multiple social networks at one time.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log debugging information')
+    parser.add_argument('--backend', action='append', metavar='NETWORK=BACKEND',
+                        help='register a backend class or dotted path for a '
+                             'network, e.g. debug=DebugBackend')
+    commands = parser.add_subparsers(title='commands')
+
+    p = commands.add_parser('worker', help='drain a share job queue')
+    p.add_argument('--db', required=True,
+                   help='SQLite file the jobs are queued in')
+    p.add_argument('-w', '--workers', type=int, default=4,
+                   help='number of worker threads (default 4)')
+    p.add_argument('--timeout', type=float, default=300,
+                   help='seconds a job stays reserved (default 300)')
+    p.add_argument('--max-attempts', type=int, default=3,
+                   help='times a job is handed out before it is dead '
+                        'lettered (default 3)')
+    p.add_argument('--max-rate-wait', type=float, default=MAX_RATE_WAIT,
+                   help='longest a share waits on a rate limit before its '
+                        'job is put off (default %i)' % MAX_RATE_WAIT)
+    p.add_argument('--poll-interval', type=float, default=1.0,
+                   help='seconds to wait when the queue is empty (default 1)')
+    p.add_argument('--once', action='store_true',
+                   help='exit once the queue is empty')
+    p.set_defaults(func=worker)
+
+    p = commands.add_parser('scheduler', help='hand out scheduled shares')
+    p.add_argument('--db', required=True,
+                   help='SQLite file the shares are scheduled in')
+    p.add_argument('--queue',
+                   help='SQLite job queue to put due shares in for workers. '
+                        'Without it due shares are shared right away.')
+    p.add_argument('--max-rate', type=float,
+                   help='most shares handed out per second')
+    p.add_argument('--max-rate-wait', type=float,
+                   default=SCHEDULER_RATE_WAIT,
+                   help='without --queue, longest a share waits on a rate '
+                        'limit before it is put off (default %i)' %
+                        SCHEDULER_RATE_WAIT)
+    p.add_argument('--poll-interval', type=float, default=1.0,
+                   help='longest wait between checks (default 1)')
+    p.add_argument('--once', action='store_true',
+                   help='hand out the shares due now and exit')
+    p.set_defaults(func=scheduler)
+
+    p = commands.add_parser('share', help='share a file of content records')
+    p.add_argument('content',
+                   help='JSON lines or CSV file of content records (message, '
+                        'headline, url, ...). JSON records can list their '
+                        'own shares.')
+    p.add_argument('--accounts',
+                   help='JSON lines or CSV file of network, consumer_token '
+                        'and consumer_secret to share each record with')
+    p.add_argument('--api-token',
+                   default=os.environ.get('SOCIALSHARE_API_TOKEN', ''),
+                   help="your app's token (default $SOCIALSHARE_API_TOKEN)")
+    p.add_argument('--api-secret',
+                   default=os.environ.get('SOCIALSHARE_API_SECRET', ''),
+                   help="your app's secret (default $SOCIALSHARE_API_SECRET)")
+    p.add_argument('-w', '--workers', type=int, default=8,
+                   help='most shares running at once (default 8)')
+    p.add_argument('--max-in-flight', type=int, default=100,
+                   help='most shares queued or running (default 100)')
+    p.add_argument('--limit', action='append', metavar='NETWORK=N',
+                   help='most shares running at once for a network')
+    p.add_argument('--dry-run', action='store_true',
+                   help='share through DebugBackend instead of the networks. '
+                        'Dry runs are not checkpointed.')
+    p.add_argument('--checkpoint',
+                   help='SQLite file progress is kept in. Running again with '
+                        'it resumes where the last run stopped.')
+    p.add_argument('--share-duplicates', action='store_true',
+                   help='share content again to accounts that already got it')
+    p.add_argument('--progress', type=float, default=2.0,
+                   help='seconds between progress lines, 0 for none '
+                        '(default 2)')
+    p.set_defaults(func=share)
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
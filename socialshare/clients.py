@@ -0,0 +1,77 @@
+"""
+clients.py -- keeps authenticated API clients around between shares.
+
+              Building a tweepy, facepy or python-linkedin client costs object
+              construction and a fresh HTTP session. Backends look their
+              client up here by network and credentials so repeated shares
+              for the same account reuse it. The least recently used client
+              is dropped once the cache is full.
+"""
+import threading
+from collections import OrderedDict
+
+# most clients kept by the shared cache
+DEFAULT_MAX_SIZE = 256
+
+
+class ClientCache(object):
+    """Thread safe LRU cache of API clients.
+
+    Parameters:
+    max_size -- most clients kept. The least recently used one is dropped
+                when a new client would go over.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.max_size = max_size
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, factory):
+        """Returns the client for key, calling factory() to build it if needed.
+
+        Parameters:
+        key -- hashable key, normally (network, api_token, consumer_token, ...)
+        factory -- callable that builds a new client
+        """
+        with self._lock:
+            try:
+                client = self._clients.pop(key)
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._clients[key] = client
+                return client
+        # build outside the lock so a slow SDK doesn't stall other accounts
+        client = factory()
+        with self._lock:
+            # another thread may have built one meanwhile; keep the first
+            client = self._clients.pop(key, client)
+            self._clients[key] = client
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+        return client
+
+    def discard(self, key):
+        """Drops the client for key, e.g. after its credentials are revoked."""
+        with self._lock:
+            self._clients.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+
+    def __len__(self):
+        return len(self._clients)
+
+    def __contains__(self, key):
+        return key in self._clients
+
+
+# shared by all backends
+client_cache = ClientCache()
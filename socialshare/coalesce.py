@@ -0,0 +1,164 @@
+"""
+coalesce.py -- turns bursts of shares to one account into digest posts.
+
+               Busy accounts can get dozens of postings an hour. A Coalescer
+               sits in front of the backends and buffers shares per network
+               and account. Once an account's buffer has max_items postings,
+               or its oldest posting has waited window seconds, the buffer
+               goes out as one digest post (a headline list and a link to a
+               landing page) through the backend's usual share().
+
+                   coalescer = Coalescer(window=15 * 60, max_items=10,
+                                         landing_url='http://example.com/jobs')
+                   share.do_bulk_share(coalescer=coalescer)
+                   ...
+                   coalescer.flush_due()   # every minute or so
+
+               Buffers are kept in memory; call flush() before shutting down.
+"""
+import threading
+import time
+
+import dedup
+from backends import get_share_backend
+from content import ShareContent
+from pool import ShareResult, PENDING, SKIPPED, timed_call
+from results import account_key
+
+# headline of a digest post, formatted with the number of postings
+DEFAULT_TITLE = u'%(count)i new postings'
+
+
+def digest_content(contents, url="", title=DEFAULT_TITLE):
+    """Returns ShareContent listing the headlines of contents.
+
+    Parameters:
+    contents -- list of ShareContent
+    url -- landing page the digest links to
+    title -- headline, formatted with count
+    """
+    headline = title % {'count': len(contents)}
+    headlines = [c.headline for c in contents if c.headline]
+    return ShareContent(message=u'\n'.join(u'- %s' % h for h in headlines),
+                        headline=headline,
+                        excerpt=u'%s: %s' % (headline, u', '.join(headlines)),
+                        tweet=u'%s: %s' % (headline, u'; '.join(headlines)),
+                        url=url)
+
+
+class _Buffer(object):
+    def __init__(self, started):
+        self.started = started
+        self.contents = []
+
+
+class Coalescer(object):
+    """Buffers shares per network and account and sends them as digests.
+
+    Parameters:
+    window -- most seconds a posting waits before its buffer is sent
+    max_items -- postings that send a buffer right away
+    landing_url -- URL digests link to. Either a string, in which
+                   {network} and {account} are filled in, or a function
+                   called with (network, account, contents) returning the
+                   URL. account is results.account_key's fingerprint of the
+                   account, never its consumer token, as the URL is public.
+    title -- digest headline, formatted with count
+    skip_duplicates -- don't buffer postings the account already got, and
+                       record the postings in a digest as sent, see
+                       socialshare.dedup
+    clock -- optional time function, for testing
+    """
+
+    def __init__(self, window=60 * 60, max_items=10, landing_url="",
+                 title=DEFAULT_TITLE, skip_duplicates=True, clock=time.time):
+        self.window = window
+        self.max_items = max_items
+        self.landing_url = landing_url
+        self.title = title
+        self.skip_duplicates = skip_duplicates
+        self.clock = clock
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def add(self, network, api_token, api_secret, consumer_token,
+            consumer_secret, content, skip_duplicates=None):
+        """Buffers content for an account.
+
+        Returns a PENDING ShareResult while the content waits, the digest's
+        ShareResult if this filled the buffer, or a SKIPPED ShareResult if
+        the account already got the content.
+
+        Parameters:
+        skip_duplicates -- skip content the account already got. Defaults
+                           to the coalescer's skip_duplicates.
+        """
+        if skip_duplicates is None:
+            skip_duplicates = self.skip_duplicates
+        if skip_duplicates and dedup.dedup_index.seen(
+                dedup.dedup_index.key(network, consumer_token, content)):
+            return ShareResult(network, consumer_token, status=SKIPPED,
+                               latency=0)
+        key = (network, api_token, api_secret, consumer_token,
+               consumer_secret)
+        with self._lock:
+            buf = self._buffers.get(key)
+            if buf is None:
+                buf = self._buffers[key] = _Buffer(self.clock())
+            if content not in buf.contents:
+                buf.contents.append(content)
+            if len(buf.contents) < self.max_items:
+                return ShareResult(network, consumer_token, status=PENDING)
+            del self._buffers[key]
+        return self._send(key, buf.contents)
+
+    def flush_due(self):
+        """Sends every buffer whose oldest posting has waited window seconds.
+        Returns their ShareResults."""
+        cutoff = self.clock() - self.window
+        return self._flush(lambda buf: buf.started <= cutoff)
+
+    def flush(self):
+        """Sends every buffer. Returns their ShareResults."""
+        return self._flush(lambda buf: True)
+
+    def pending(self):
+        """Returns {(network, consumer_token): postings waiting}."""
+        with self._lock:
+            return dict(((k[0], k[3]), len(buf.contents))
+                        for k, buf in self._buffers.items())
+
+    def _flush(self, due):
+        with self._lock:
+            ready = [(k, buf) for k, buf in self._buffers.items()
+                     if due(buf)]
+            for key, buf in ready:
+                del self._buffers[key]
+        return [self._send(key, buf.contents) for key, buf in ready]
+
+    def _send(self, key, contents):
+        network, consumer_token = key[0], key[3]
+        if len(contents) == 1:
+            content = contents[0]
+        else:
+            url = self.landing_url
+            account = account_key(network, consumer_token)
+            if callable(url):
+                url = url(network, account, contents)
+            elif url:
+                url = url.format(network=network, account=account)
+            content = digest_content(contents, url, self.title)
+        result = timed_call(network, consumer_token, self._share, key,
+                            content)
+        if result.ok and self.skip_duplicates:
+            for c in contents:
+                dedup.dedup_index.add(
+                    dedup.dedup_index.key(network, consumer_token, c))
+        return result
+
+    def _share(self, key, content):
+        network, api_token, api_secret, consumer_token, consumer_secret = key
+        class_ = get_share_backend(network)
+        api = class_(api_token, api_secret, consumer_token=consumer_token,
+                     consumer_secret=consumer_secret, content=content)
+        return api.share()
@@ -0,0 +1,113 @@
+"""
+content.py -- the content being shared.
+
+              ShareContent is normalized once (stripped and truncated) and is
+              immutable, so a single instance can be handed to every backend
+              in a fan-out and used as a cache key.
+"""
+import hashlib
+
+# content keyword arguments every backend takes
+CONTENT_FIELDS = ('message', 'headline', 'excerpt', 'tweet', 'url',
+                  'url_title', 'url_description', 'image_url',
+                  'image_url_title', 'image_url_description')
+
+
+class ShareContent(object):
+    """Immutable, normalized share content.
+
+    Parameters:
+    message -- the message.
+    headline -- the headline or subject for the message, truncated at 128
+    excerpt -- the excerpt or short version of the message. Defaults to the
+               headline.
+    tweet -- short 160 character max message. Defaults to the headline.
+    url -- the url being shared
+    url_title -- the title of the url
+    url_description -- description of the URL
+    image_url -- url of picture to share
+    image_url_title -- the title of the image
+    image_url_description -- the description of the image
+    """
+    __slots__ = CONTENT_FIELDS + ('_digest',)
+
+    def __init__(self, message="", headline="", excerpt="", tweet="", url="",
+                 url_title="", url_description="", image_url="",
+                 image_url_title="", image_url_description=""):
+        set_ = object.__setattr__
+        set_(self, 'message', (message or '').strip())
+        # truncate at 128 characters
+        headline = (headline or '')[0:128].strip()
+        set_(self, 'headline', headline)
+        # If there is no excerpt use the headline
+        set_(self, 'excerpt', (excerpt or headline).strip())
+        # if there is no tweet defined... create one, truncated at 160.
+        set_(self, 'tweet', (tweet or headline)[0:160].strip())
+        set_(self, 'url', u'%s' % (url or '').strip())
+        set_(self, 'url_title', url_title or '')
+        set_(self, 'url_description', (url_description or '').strip())
+        set_(self, 'image_url', u'%s' % (image_url or '').strip())
+        set_(self, 'image_url_title', (image_url_title or '').strip())
+        set_(self, 'image_url_description',
+             (image_url_description or '').strip())
+        set_(self, '_digest', None)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Builds content from a dict, ignoring keys that aren't fields."""
+        return cls(**dict((str(k), data[k]) for k in CONTENT_FIELDS
+                          if k in data))
+
+    def to_dict(self):
+        return dict((k, getattr(self, k)) for k in CONTENT_FIELDS)
+
+    def replace(self, **fields):
+        """Returns a copy with some fields changed."""
+        data = self.to_dict()
+        data.update(fields)
+        return ShareContent(**data)
+
+    @property
+    def digest(self):
+        """SHA-1 hex digest of the content, for cache and dedup keys."""
+        if self._digest is None:
+            h = hashlib.sha1()
+            for k in CONTENT_FIELDS:
+                value = getattr(self, k)
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                elif not isinstance(value, str):
+                    value = repr(value)
+                h.update(value)
+                h.update('\0')
+            object.__setattr__(self, '_digest', h.hexdigest())
+        return self._digest
+
+    def _values(self):
+        return tuple(getattr(self, k) for k in CONTENT_FIELDS)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ShareContent is immutable.")
+
+    def __delattr__(self, name):
+        raise AttributeError("ShareContent is immutable.")
+
+    def __eq__(self, other):
+        if not isinstance(other, ShareContent):
+            return NotImplemented
+        return self._values() == other._values()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __reduce__(self):
+        return (ShareContent, self._values())
+
+    def __repr__(self):
+        return '<ShareContent %r>' % self.headline
@@ -0,0 +1,168 @@
+"""
+dedup.py -- skips sharing content an account already got.
+
+            Postings are often submitted again (feeds reprocessed, upstream
+            retries). do_bulk_share, share_stream and send_message look each
+            (network, consumer token, content digest) up in a DedupIndex
+            before building a backend, and skip the ones that went through
+            within the last ttl seconds, so they cost no API calls or rate
+            limit budget. The digest is taken from the normalized
+            ShareContent, so whitespace differences don't count.
+
+            Keys live in a DedupStore. MemoryDedupStore keeps them in
+            process; SQLiteDedupStore keeps them across restarts and shares
+            them between processes on one box:
+
+                dedup.dedup_index = DedupIndex(SQLiteDedupStore(path))
+"""
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from pool import ShareResult, SKIPPED, timed_call
+from retry import idempotency_key
+
+# how long a share counts as a duplicate, in seconds
+DEFAULT_TTL = 7 * 24 * 60 * 60
+
+
+class DedupStore(object):
+    """Where dedup keys are kept. Subclasses implement all three methods."""
+
+    def contains(self, key, now):
+        """True if key was added and hasn't expired by now."""
+        raise NotImplementedError
+
+    def add(self, key, expires):
+        """Stores key until the time expires."""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryDedupStore(DedupStore):
+    """Keeps keys in this process.
+
+    Parameters:
+    max_size -- most keys kept; the oldest are dropped first.
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def contains(self, key, now):
+        with self._lock:
+            expires = self._keys.get(key)
+            if expires is None:
+                return False
+            if expires <= now:
+                del self._keys[key]
+                return False
+            return True
+
+    def add(self, key, expires):
+        with self._lock:
+            self._keys.pop(key, None)
+            self._keys[key] = expires
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+
+class SQLiteDedupStore(DedupStore):
+    """Keeps keys in a SQLite file.
+
+    Parameters:
+    path -- the database file. Every process must use the same one.
+    purge_every -- expired keys are deleted once every this many adds
+    """
+
+    def __init__(self, path, purge_every=1000):
+        self.path = path
+        self.purge_every = purge_every
+        self._adds = 0
+        self._local = threading.local()
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS dedup '
+            '(key TEXT PRIMARY KEY, expires REAL NOT NULL)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def contains(self, key, now):
+        row = self._connection().execute(
+            'SELECT 1 FROM dedup WHERE key = ? AND expires > ?',
+            (key, now)).fetchone()
+        return row is not None
+
+    def add(self, key, expires):
+        conn = self._connection()
+        conn.execute('INSERT OR REPLACE INTO dedup VALUES (?, ?)',
+                     (key, expires))
+        self._adds += 1
+        if self._adds % self.purge_every == 0:
+            conn.execute('DELETE FROM dedup WHERE expires <= ?',
+                         (time.time(),))
+
+    def clear(self):
+        self._connection().execute('DELETE FROM dedup')
+
+
+class DedupIndex(object):
+    """Remembers which content went to which account.
+
+    Parameters:
+    store -- DedupStore holding the keys. Defaults to in memory.
+    ttl -- seconds a share counts as a duplicate
+    clock -- optional time function, for testing
+    """
+
+    def __init__(self, store=None, ttl=DEFAULT_TTL, clock=time.time):
+        self.store = store or MemoryDedupStore()
+        self.ttl = ttl
+        self.clock = clock
+
+    def key(self, network, consumer_token, content, *extra):
+        """Key for content going to consumer_token on network. extra tells
+        apart different sends of the same content, e.g. message recipients.
+        """
+        return idempotency_key('dedup', network, consumer_token,
+                               content.digest, *extra)
+
+    def seen(self, key):
+        return self.store.contains(key, self.clock())
+
+    def add(self, key):
+        self.store.add(key, self.clock() + self.ttl)
+
+    def clear(self):
+        self.store.clear()
+
+    def call(self, network, consumer_token, content, fn, *args):
+        """Like pool.timed_call, but returns a SKIPPED ShareResult without
+        calling fn if content already went to consumer_token on network.
+        Successful calls are added to the index."""
+        key = self.key(network, consumer_token, content)
+        if self.seen(key):
+            return ShareResult(network, consumer_token, status=SKIPPED,
+                               latency=0)
+        result = timed_call(network, consumer_token, fn, *args)
+        if result.ok:
+            self.add(key)
+        return result
+
+
+# used by SocialShare, share_stream and ShareBackend.send_message
+dedup_index = DedupIndex()
@@ -0,0 +1,40 @@
+"""
+errors.py -- exceptions raised by socialshare.
+"""
+
+
+class ShareError(Exception):
+    """Used for social share fails."""
+    def __init__(self, msg):
+        self.msg=msg
+        return
+
+    def __str__(self):
+        return str(self.msg)
+
+
+class RateLimited(ShareError):
+    """Raised when a call would have to wait longer than allowed for its
+    network's rate limit.
+
+    retry_after is the number of seconds after which the call may go
+    through.
+    """
+    def __init__(self, msg, retry_after=None):
+        super(RateLimited, self).__init__(msg)
+        self.retry_after = retry_after
+
+
+class CircuitOpen(ShareError):
+    """Raised instead of calling a network whose circuit breaker is open.
+
+    retry_after is the number of seconds until the breaker lets a trial call
+    through.
+    """
+    def __init__(self, msg, retry_after=None):
+        super(CircuitOpen, self).__init__(msg)
+        self.retry_after = retry_after
+
+
+class ShareCancelled(ShareError):
+    """Raised by a ShareFuture whose job was cancelled before it started."""
@@ -0,0 +1,248 @@
+"""
+fakeserver.py -- an in-process stand-in for the Twitter, Facebook and
+                 LinkedIn APIs.
+
+                 Serves the endpoints the transport clients use on a local
+                 port, with optional latency and errors, and records every
+                 request. Point a Transport at it to test throughput and
+                 latency without network access:
+
+                     with FakeSocialServer(latency=0.05) as server:
+                         transport.default_transport = transport.Transport(
+                             base_urls=server.base_urls)
+                         ...
+"""
+import cgi
+import json
+import random
+import socket
+import sys
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+from urlparse import urlsplit, parse_qs
+
+NETWORKS = ('twitter', 'facebook', 'linkedin')
+
+
+class FakeRequest(object):
+    """A request the fake server received."""
+
+    def __init__(self, network, method, path, params, headers):
+        self.network = network
+        self.method = method
+        self.path = path
+        self.params = params
+        self.headers = headers
+
+    def __repr__(self):
+        return '<FakeRequest %s %s %s>' % (self.network, self.method,
+                                           self.path)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients that time out hang up before the fake answers
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive, so transport connection reuse can be measured
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def do_DELETE(self):
+        self._handle()
+
+    def _handle(self):
+        fake = self.server.fake
+        parts = urlsplit(self.path)
+        network, _, path = parts.path.lstrip('/').partition('/')
+        path = '/' + path
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            params = json.loads(body) if body else {}
+        elif content_type.startswith('multipart/form-data'):
+            form = cgi.FieldStorage(
+                fp=StringIO(body), headers=self.headers,
+                environ={'REQUEST_METHOD': 'POST',
+                         'CONTENT_TYPE': content_type})
+            params = dict((k, form.getfirst(k)) for k in form.keys())
+        else:
+            params = dict((k, v[0]) for k, v in
+                          parse_qs(body or parts.query).items())
+        request = FakeRequest(network, self.command, path, params,
+                              dict(self.headers.items()))
+        status, data = fake.respond(request)
+        payload = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class FakeSocialServer(object):
+    """Fake social network APIs on 127.0.0.1.
+
+    Parameters:
+    latency -- seconds each request takes, or a function returning them
+    error_rate -- fraction of requests answered with error_status
+    error_status -- HTTP status for injected errors
+    seed -- optional random seed, for repeatable error injection
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, error_status=503,
+                 seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.requests = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._statuses = set()
+        # (network, post id) of posts that haven't been deleted
+        self.posts = set()
+        # media id: bytes uploaded
+        self.media = {}
+        self._next_id = 1
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://%s:%s' % (host, port)
+
+    @property
+    def base_urls(self):
+        """Transport base_urls sending every network here."""
+        return dict((n, '%s/%s' % (self.url, n)) for n in NETWORKS)
+
+    def start(self):
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.fake = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def respond(self, request):
+        """Returns (status, JSON data) for a request."""
+        latency = self.latency() if callable(self.latency) else self.latency
+        if latency:
+            time.sleep(latency)
+        with self._lock:
+            self.requests.append(request)
+            if self.error_rate and self._random.random() < self.error_rate:
+                return self.error_status, {'error': 'injected failure'}
+            post_id = self._next_id
+            self._next_id += 1
+            if request.network not in NETWORKS:
+                return 404, {'error': 'unknown network'}
+            return getattr(self, '_' + request.network)(request, post_id)
+
+    def _twitter(self, request, post_id):
+        if request.path == '/1.1/statuses/update.json':
+            status = request.params.get('status')
+            key = (request.headers.get('authorization', '').split(
+                'oauth_token="')[-1].split('"')[0], status)
+            if key in self._statuses:
+                return 403, {'errors': [{'code': 187,
+                                         'message': 'Status is a duplicate.'}]}
+            self._statuses.add(key)
+            self.posts.add(('twitter', str(post_id)))
+            return 200, {'id': post_id, 'id_str': str(post_id),
+                         'text': status}
+        if request.path.startswith('/1.1/statuses/destroy/'):
+            tweet_id = request.path.rsplit('/', 1)[-1][:-len('.json')]
+            if ('twitter', tweet_id) not in self.posts:
+                return 404, {'errors': [{'code': 144, 'message':
+                                         'No status found with that ID.'}]}
+            self.posts.remove(('twitter', tweet_id))
+            return 200, {'id': int(tweet_id), 'id_str': tweet_id}
+        if request.path == '/1.1/media/upload.json':
+            return self._twitter_upload(request, post_id)
+        if request.path == '/1.1/direct_messages/new.json':
+            return 200, {'id': post_id, 'id_str': str(post_id),
+                         'text': request.params.get('text')}
+        return 404, {'errors': [{'code': 34, 'message': 'Not found'}]}
+
+    def _twitter_upload(self, request, post_id):
+        command = request.params.get('command')
+        media_id = request.params.get('media_id')
+        if command == 'INIT':
+            self.media[str(post_id)] = ''
+            return 202, {'media_id': post_id, 'media_id_string': str(post_id)}
+        if media_id not in self.media:
+            return 400, {'errors': [{'code': 324,
+                                     'message': 'Invalid media id.'}]}
+        if command == 'APPEND':
+            self.media[media_id] += request.params.get('media') or ''
+            return 200, {}
+        return 201, {'media_id': int(media_id), 'media_id_string': media_id,
+                     'size': len(self.media[media_id])}
+
+    def _facebook(self, request, post_id):
+        if request.path == '/me/photos':
+            photo_id = 'photo_%s' % post_id
+            self.media[photo_id] = request.params.get('source') or ''
+            return 200, {'id': photo_id}
+        if request.path in ('/me/feed', '/me/outbox'):
+            if not request.params.get('access_token'):
+                return 400, {'error': {'type': 'OAuthException', 'code': 190,
+                                       'message': 'No access token'}}
+            if request.path == '/me/feed':
+                self.posts.add(('facebook', 'me_%s' % post_id))
+            return 200, {'id': 'me_%s' % post_id}
+        if request.method == 'DELETE':
+            key = ('facebook', request.path.lstrip('/'))
+            if key not in self.posts:
+                return 404, {'error': {'message': 'Unknown object',
+                                       'code': 100}}
+            self.posts.remove(key)
+            return 200, {'success': True}
+        return 404, {'error': {'message': 'Unknown path', 'code': 803}}
+
+    def _linkedin(self, request, post_id):
+        if request.path == '/v1/people/~/shares':
+            self.posts.add(('linkedin', 'UPDATE-%s' % post_id))
+            return 201, {'updateKey': 'UPDATE-%s' % post_id,
+                         'updateUrl': 'http://www.linkedin.com/updates'
+                                      '?topic=%s' % post_id}
+        if request.path == '/v1/people/~/mailbox':
+            return 201, {}
+        if (request.method == 'DELETE' and
+                request.path.startswith('/v1/people/~/shares/')):
+            key = ('linkedin', request.path.rsplit('/', 1)[-1])
+            if key not in self.posts:
+                return 404, {'message': 'Unknown share', 'status': 404}
+            self.posts.remove(key)
+            return 200, {}
+        return 404, {'message': 'Unknown path', 'status': 404}
@@ -0,0 +1,271 @@
+"""
+instrument.py -- hooks into every share and message a backend sends.
+
+                 Each ShareBackend.share() and each message batch is reported
+                 to the hooks added to instrumentation as a Call: which
+                 network and account it went to, how it ended, and where the
+                 time went. "wait" is time spent on the rate limiter, "api"
+                 is time spent in the network's SDK or REST client and
+                 overhead is everything else (retry backoff, rendering and
+                 our own code).
+
+                     stats = instrument.StatsCollector()
+                     instrument.instrumentation.add_hook(stats)
+                     ...
+                     stats.snapshot()
+
+                 SpanHook opens an OpenTelemetry style span per call. With no
+                 hooks added, calls are not timed at all.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# Call outcomes
+SUCCESS = 'success'
+FAILED = 'failed'
+# the ledger already had a result, so the network wasn't called
+CACHED = 'cached'
+
+
+class _Stage(object):
+    """Adds the time spent in a with block to a Call's stage."""
+
+    def __init__(self, call, name):
+        self.call = call
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        elapsed = time.time() - self.start
+        stages = self.call.stages
+        stages[self.name] = stages.get(self.name, 0) + elapsed
+        if self.name == 'api':
+            self.call.attempts += 1
+            self.call.tries.append((elapsed, exc_value))
+
+
+class Call(object):
+    """A share or message batch as seen by hooks.
+
+    Attributes:
+    network -- the network it went to
+    operation -- 'share', 'message' or 'unshare'
+    consumer_token -- the account it went to
+    digest -- ShareContent.digest of what was sent
+    recipients -- list of message recipients, None for shares
+    started -- time.time() when it started
+    elapsed -- seconds it took, once finished
+    stages -- dict of stage name: seconds, e.g. {'wait': .., 'api': ..}
+    attempts -- times the network was called, retries included
+    tries -- (seconds, exception or None) for each time the network was
+             called, in order
+    outcome -- SUCCESS, FAILED or CACHED, once finished
+    result -- what the backend returned
+    post_id -- ID of the post on the network, if it gave one back
+    exception -- the exception it failed with, if any
+    context -- dict for hooks to keep their own state in
+    """
+
+    def __init__(self, network, operation, consumer_token="", digest=None,
+                 recipients=None):
+        self.network = network
+        self.operation = operation
+        self.consumer_token = consumer_token
+        self.digest = digest
+        self.recipients = recipients
+        self.started = time.time()
+        self.elapsed = None
+        self.stages = {}
+        self.attempts = 0
+        self.tries = []
+        self.outcome = None
+        self.result = None
+        self.post_id = None
+        self.exception = None
+        self.context = {}
+
+    def stage(self, name):
+        """Returns a context manager timing a stage of the call."""
+        return _Stage(self, name)
+
+    @property
+    def overhead(self):
+        """Seconds not spent in any stage."""
+        if self.elapsed is None:
+            return None
+        return max(0, self.elapsed - sum(self.stages.values()))
+
+    def __repr__(self):
+        return '<Call %s %s %s>' % (self.network, self.operation,
+                                    self.outcome or 'running')
+
+
+class _NullStage(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+class _NullCall(object):
+    """Stands in for a Call when there are no hooks, so backends needn't
+    check."""
+    _stage = _NullStage()
+
+    def stage(self, name):
+        return self._stage
+
+
+NULL_CALL = _NullCall()
+
+
+class Hook(object):
+    """Base class for instrumentation hooks.
+
+    Hooks are called on the thread doing the share and should be quick.
+    Exceptions they raise are logged and otherwise ignored.
+    """
+
+    def before(self, call):
+        """Called when call starts."""
+        pass
+
+    def after(self, call):
+        """Called when call has finished, with its outcome set."""
+        pass
+
+
+class Instrumentation(object):
+    """Hands Calls to hooks."""
+
+    def __init__(self):
+        self.hooks = ()
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        with self._lock:
+            self.hooks = self.hooks + (hook,)
+
+    def remove_hook(self, hook):
+        with self._lock:
+            self.hooks = tuple(h for h in self.hooks if h is not hook)
+
+    def start(self, network, operation, consumer_token="", digest=None,
+              recipients=None):
+        """Returns a started Call, or NULL_CALL if there are no hooks."""
+        hooks = self.hooks
+        if not hooks:
+            return NULL_CALL
+        call = Call(network, operation, consumer_token, digest, recipients)
+        for hook in hooks:
+            try:
+                hook.before(call)
+            except Exception:
+                log.exception("Instrumentation hook %r failed.", hook)
+        return call
+
+    def finish(self, call, outcome, result=None, exception=None,
+               post_id=None):
+        """Ends call and hands it to the hooks, last added first."""
+        if call is NULL_CALL:
+            return
+        call.elapsed = time.time() - call.started
+        call.outcome = outcome
+        call.result = result
+        call.post_id = post_id
+        call.exception = exception
+        for hook in reversed(self.hooks):
+            try:
+                hook.after(call)
+            except Exception:
+                log.exception("Instrumentation hook %r failed.", hook)
+
+
+class StatsCollector(Hook):
+    """Keeps counts and timings in memory, per network and operation."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # (network, operation, outcome): count
+            self.counters = defaultdict(int)
+            # (network, operation, stage): [count, total, max]
+            self.timings = {}
+
+    def after(self, call):
+        times = [('total', call.elapsed), ('overhead', call.overhead)]
+        times.extend(call.stages.items())
+        with self._lock:
+            self.counters[(call.network, call.operation, call.outcome)] += 1
+            for stage, seconds in times:
+                key = (call.network, call.operation, stage)
+                timing = self.timings.get(key)
+                if timing is None:
+                    timing = self.timings[key] = [0, 0.0, 0.0]
+                timing[0] += 1
+                timing[1] += seconds
+                timing[2] = max(timing[2], seconds)
+
+    def snapshot(self):
+        """Returns the stats as a dict of plain values:
+
+        {'counters': {'twitter.share.success': 12, ...},
+         'timings': {'twitter.share.api': {'count': 12, 'total': 3.1,
+                                           'mean': .26, 'max': .9}, ...}}
+        """
+        with self._lock:
+            counters = dict(('.'.join(k), v) for k, v in self.counters.items())
+            timings = {}
+            for key, (count, total, max_) in self.timings.items():
+                timings['.'.join(key)] = {'count': count, 'total': total,
+                                          'mean': total / count,
+                                          'max': max_}
+        return {'counters': counters, 'timings': timings}
+
+
+class SpanHook(Hook):
+    """Opens a span per call.
+
+    Parameters:
+    tracer -- an object with start_span(name) returning spans with
+              set_attribute(key, value) and end(), like an OpenTelemetry
+              tracer. Defaults to opentelemetry's global tracer.
+    """
+
+    def __init__(self, tracer=None):
+        if tracer is None:
+            from opentelemetry import trace
+            tracer = trace.get_tracer(__name__)
+        self.tracer = tracer
+
+    def before(self, call):
+        span = self.tracer.start_span('socialshare.%s' % call.operation)
+        span.set_attribute('socialshare.network', call.network)
+        call.context[self] = span
+
+    def after(self, call):
+        span = call.context.pop(self, None)
+        if span is None:
+            return
+        span.set_attribute('socialshare.outcome', call.outcome)
+        span.set_attribute('socialshare.attempts', call.attempts)
+        for stage, seconds in call.stages.items():
+            span.set_attribute('socialshare.%s_seconds' % stage, seconds)
+        if call.exception is not None and hasattr(span, 'record_exception'):
+            span.record_exception(call.exception)
+        span.end()
+
+
+# used by all backends
+instrumentation = Instrumentation()
@@ -0,0 +1,308 @@
+"""
+jobs.py -- durable share queue and the workers that drain it.
+
+           SocialShare.enqueue() stores a share job in a JobQueue and returns
+           right away; a Worker (run with "socialshare worker") pulls jobs
+           off and shares them. A job is invisible to other workers while one
+           has it reserved, and the worker renews the reservation for as
+           long as the job runs. It is deleted when acknowledged and moved
+           to the dead letter list when it fails. If a worker dies mid-job,
+           the job is handed out again once its reservation runs out.
+
+           SQLiteJobQueue keeps jobs in a local SQLite file. Other brokers
+           can be used by implementing the JobQueue methods.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+import traceback
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DEFERRED = 'deferred'
+DEAD = 'dead'
+
+
+class Job(object):
+    """A reserved job.
+
+    Attributes:
+    id -- the queue's id for the job
+    payload -- the job's data, as passed to put()
+    attempts -- how many times the job has been handed out, this one included
+    """
+
+    def __init__(self, id, payload, attempts=1):
+        self.id = id
+        self.payload = payload
+        self.attempts = attempts
+
+    def __repr__(self):
+        return '<Job %s attempt %i>' % (self.id, self.attempts)
+
+
+class JobQueue(object):
+    """Interface for share job queues."""
+
+    def put(self, payload):
+        """Stores a JSON serializable payload. Returns the job id."""
+        raise NotImplementedError
+
+    def reserve(self, timeout=300):
+        """Hands out the oldest waiting job as a Job, or None if there isn't
+        one. Other workers won't see it for timeout seconds."""
+        raise NotImplementedError
+
+    def ack(self, job_id):
+        """Removes a finished job."""
+        raise NotImplementedError
+
+    def extend(self, job_id, timeout):
+        """Keeps a reserved job from other workers for timeout seconds from
+        now."""
+        raise NotImplementedError
+
+    def fail(self, job_id, error):
+        """Moves a failed job to the dead letter list."""
+        raise NotImplementedError
+
+    def defer(self, job_id, delay):
+        """Hands a reserved job out again after delay seconds, without
+        counting this attempt."""
+        raise NotImplementedError
+
+    def in_flight(self):
+        """Returns the reserved Jobs, not counting deferred ones."""
+        raise NotImplementedError
+
+    def deferred(self):
+        """Returns the deferred Jobs that are waiting to be handed out
+        again."""
+        raise NotImplementedError
+
+    def dead(self):
+        """Returns (Job, error) for every job in the dead letter list."""
+        raise NotImplementedError
+
+    def retry_dead(self, job_id):
+        """Puts a dead job back in the queue."""
+        raise NotImplementedError
+
+
+class SQLiteJobQueue(JobQueue):
+    """JobQueue kept in a SQLite file. Safe to share between processes.
+
+    Parameters:
+    path -- the database file.
+    max_attempts -- times a job is handed out before a job whose workers keep
+                    dying is moved to the dead letter list.
+    """
+
+    def __init__(self, path, max_attempts=3):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                     'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                     'payload TEXT NOT NULL, '
+                     'state TEXT NOT NULL, '
+                     'attempts INTEGER NOT NULL DEFAULT 0, '
+                     'reserved_until REAL, '
+                     'error TEXT, '
+                     'created REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_state '
+                     'ON jobs (state, id)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def put(self, payload):
+        cursor = self._connection().execute(
+            'INSERT INTO jobs (payload, state, created) VALUES (?, ?, ?)',
+            (json.dumps(payload), QUEUED, time.time()))
+        return cursor.lastrowid
+
+    def reserve(self, timeout=300):
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # jobs whose worker died and used up their attempts
+            conn.execute('UPDATE jobs SET state = ?, error = ? '
+                         'WHERE state = ? AND reserved_until < ? '
+                         'AND attempts >= ?',
+                         (DEAD, 'Reservation expired too many times.',
+                          RUNNING, now, self.max_attempts))
+            row = conn.execute('SELECT id, payload, attempts FROM jobs '
+                               'WHERE state = ? '
+                               'OR (state IN (?, ?) AND reserved_until < ?) '
+                               'ORDER BY id LIMIT 1',
+                               (QUEUED, RUNNING, DEFERRED, now)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            conn.execute('UPDATE jobs SET state = ?, reserved_until = ?, '
+                         'attempts = attempts + 1 WHERE id = ?',
+                         (RUNNING, now + timeout, row[0]))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return Job(row[0], json.loads(row[1]), row[2] + 1)
+
+    def ack(self, job_id):
+        self._connection().execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def extend(self, job_id, timeout):
+        self._connection().execute(
+            'UPDATE jobs SET reserved_until = ? WHERE id = ? AND state = ?',
+            (time.time() + timeout, job_id, RUNNING))
+
+    def fail(self, job_id, error):
+        self._connection().execute(
+            'UPDATE jobs SET state = ?, error = ?, reserved_until = NULL '
+            'WHERE id = ?', (DEAD, error, job_id))
+
+    def defer(self, job_id, delay):
+        self._connection().execute(
+            'UPDATE jobs SET state = ?, reserved_until = ?, '
+            'attempts = attempts - 1 WHERE id = ? AND state = ?',
+            (DEFERRED, time.time() + delay, job_id, RUNNING))
+
+    def in_flight(self):
+        rows = self._connection().execute(
+            'SELECT id, payload, attempts FROM jobs WHERE state = ? '
+            'AND reserved_until >= ? ORDER BY id', (RUNNING, time.time()))
+        return [Job(r[0], json.loads(r[1]), r[2]) for r in rows]
+
+    def deferred(self):
+        rows = self._connection().execute(
+            'SELECT id, payload, attempts FROM jobs WHERE state = ? '
+            'ORDER BY id', (DEFERRED,))
+        return [Job(r[0], json.loads(r[1]), r[2]) for r in rows]
+
+    def dead(self):
+        rows = self._connection().execute(
+            'SELECT id, payload, attempts, error FROM jobs WHERE state = ? '
+            'ORDER BY id', (DEAD,))
+        return [(Job(r[0], json.loads(r[1]), r[2]), r[3]) for r in rows]
+
+    def retry_dead(self, job_id):
+        self._connection().execute(
+            'UPDATE jobs SET state = ?, attempts = 0, error = NULL '
+            'WHERE id = ? AND state = ?', (QUEUED, job_id, DEAD))
+
+    def __len__(self):
+        row = self._connection().execute(
+            'SELECT COUNT(*) FROM jobs WHERE state != ?', (DEAD,)).fetchone()
+        return row[0]
+
+
+class Worker(object):
+    """Drains a JobQueue with a number of threads.
+
+    Parameters:
+    queue -- the JobQueue to drain
+    handler -- called with each job's payload. Raising fails the job, unless
+               the exception has a retry_after attribute (like CircuitOpen):
+               then the job is deferred by that many seconds.
+    workers -- number of threads
+    timeout -- seconds a job stays reserved. Running jobs are renewed every
+               timeout / 3 seconds, so it only has to outlast a worker that
+               died.
+    poll_interval -- seconds an idle thread waits before checking again
+    """
+
+    def __init__(self, queue, handler, workers=4, timeout=300,
+                 poll_interval=1.0):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def run(self, stop_when_empty=False):
+        """Works until stop() is called, or the queue is empty if
+        stop_when_empty is True."""
+        self._stop.clear()
+        threads = [threading.Thread(target=self._work, args=(stop_when_empty,))
+                   for i in range(self.workers)]
+        stopped = threading.Event()
+        renewer = threading.Thread(target=self._renew, args=(stopped,))
+        for t in threads + [renewer]:
+            t.daemon = True
+            t.start()
+        try:
+            # join with a timeout so KeyboardInterrupt still gets through
+            while any(t.is_alive() for t in threads):
+                for t in threads:
+                    t.join(0.5)
+        except KeyboardInterrupt:
+            self.stop()
+            for t in threads:
+                t.join()
+        finally:
+            stopped.set()
+            renewer.join()
+
+    def stop(self):
+        """Lets running jobs finish and stops taking new ones."""
+        self._stop.set()
+
+    def _work(self, stop_when_empty):
+        while not self._stop.is_set():
+            job = self.queue.reserve(timeout=self.timeout)
+            if job is None:
+                if stop_when_empty:
+                    return
+                self._stop.wait(self.poll_interval)
+                continue
+            self.process(job)
+
+    def _renew(self, stopped):
+        # a share can run longer than the reservation, e.g. waiting on a
+        # rate limit, and mustn't be handed to a second worker meanwhile
+        while not stopped.wait(self.timeout / 3.0):
+            with self._lock:
+                running = list(self._running)
+            for job_id in running:
+                try:
+                    self.queue.extend(job_id, self.timeout)
+                except Exception:
+                    log.exception("Couldn't renew share job %s.", job_id)
+
+    def process(self, job):
+        """Runs one job and acknowledges or fails it."""
+        with self._lock:
+            self._running.add(job.id)
+        try:
+            self.handler(job.payload)
+        except Exception, e:
+            retry_after = getattr(e, 'retry_after', None)
+            if retry_after is not None:
+                log.info("Share job %s deferred %ss: %s", job.id,
+                         retry_after, e)
+                self.queue.defer(job.id, retry_after)
+                return
+            log.exception("Share job %s failed.", job.id)
+            self.queue.fail(job.id, traceback.format_exc())
+        else:
+            self.queue.ack(job.id)
+        finally:
+            with self._lock:
+                self._running.discard(job.id)
@@ -0,0 +1,467 @@
+"""
+media.py -- uploads images once and reuses the uploaded media.
+
+            Backends normally just link content.image_url and let the network
+            fetch it. Backends with attach_media set upload the image and
+            attach it to the post natively instead. Images are downloaded in
+            chunks, never whole into memory, and hashed on the way.
+            media_cache remembers each upload's media ID by network, account
+            and image hash, so a posting shared to many accounts is
+            downloaded once and uploaded once per account, however many
+            times it is shared.
+
+                TwitterBackend.attach_media = True
+
+            image_url is usually user supplied, so only http and https URLs
+            are fetched, and only from hosts with public addresses; private,
+            loopback and link local addresses are turned down, redirects
+            included. media_hosts limits downloads to a list of hosts
+            instead. Local images are read from file:// URLs, and only from
+            under media_root:
+
+                media.media_hosts = ['images.example.com', '.cdn.example.com']
+                media.media_root = '/srv/images'
+"""
+import hashlib
+import mimetypes
+import os
+import socket
+import tempfile
+import threading
+import time
+import urllib
+import urllib2
+import uuid
+from collections import OrderedDict
+from urlparse import urlsplit
+
+from errors import ShareError
+
+# bytes read, hashed and uploaded at a time
+CHUNK_SIZE = 1024 * 1024
+# seconds to wait for an image download
+DOWNLOAD_TIMEOUT = 30
+# largest image fetched, in bytes
+MAX_MEDIA_SIZE = 15 * 1024 * 1024
+# directory file:// image URLs may be read from. None allows no local files.
+media_root = None
+# hosts http(s) images may be fetched from; a leading dot allows subdomains.
+# None allows any host with a public address.
+media_hosts = None
+
+# (family, network, prefix length) of addresses images aren't fetched from:
+# this host, private, shared, loopback, link local, multicast and reserved
+_BLOCKED_NETWORKS = [(socket.AF_INET, '0.0.0.0', 8),
+                     (socket.AF_INET, '10.0.0.0', 8),
+                     (socket.AF_INET, '100.64.0.0', 10),
+                     (socket.AF_INET, '127.0.0.0', 8),
+                     (socket.AF_INET, '169.254.0.0', 16),
+                     (socket.AF_INET, '172.16.0.0', 12),
+                     (socket.AF_INET, '192.0.0.0', 24),
+                     (socket.AF_INET, '192.168.0.0', 16),
+                     (socket.AF_INET, '198.18.0.0', 15),
+                     (socket.AF_INET, '224.0.0.0', 3),
+                     (socket.AF_INET6, '::', 127),
+                     (socket.AF_INET6, 'fc00::', 7),
+                     (socket.AF_INET6, 'fe80::', 10),
+                     (socket.AF_INET6, 'ff00::', 8)]
+
+
+def _scheme(location):
+    if '://' not in location:
+        return None
+    return location.split('://', 1)[0].lower()
+
+
+def _local_path(location, root):
+    """Returns the path a file:// URL points to, if it's under root."""
+    if root is None:
+        raise ShareError("Local media isn't allowed; set media.media_root.")
+    path = os.path.realpath(urllib.url2pathname(urlsplit(location).path))
+    root = os.path.join(os.path.realpath(root), '')
+    if not path.startswith(root):
+        raise ShareError("%s isn't under the media root." % location)
+    return path
+
+
+def _address_value(family, address):
+    return int(socket.inet_pton(family, address).encode('hex'), 16)
+
+
+def _blocked_address(family, address):
+    """True if address is in one of _BLOCKED_NETWORKS."""
+    value = _address_value(family, address.split('%')[0])
+    if family == socket.AF_INET6 and value >> 32 == 0xffff:
+        # an IPv4 address mapped into IPv6
+        family, value = socket.AF_INET, value & 0xffffffff
+    bits = 32 if family == socket.AF_INET else 128
+    for net_family, network, prefix in _BLOCKED_NETWORKS:
+        if net_family != family:
+            continue
+        shift = bits - prefix
+        if value >> shift == _address_value(family, network) >> shift:
+            return True
+    return False
+
+
+def _check_url(location):
+    """Raises ShareError unless images may be downloaded from location's
+    host, see media_hosts."""
+    parts = urlsplit(location)
+    host = (parts.hostname or '').lower()
+    if not host:
+        raise ShareError("%s has no host." % location)
+    if media_hosts is not None:
+        for allowed in media_hosts:
+            allowed = allowed.lower()
+            if host == allowed.lstrip('.') or (allowed.startswith('.') and
+                                               host.endswith(allowed)):
+                return
+        raise ShareError("%s isn't in media.media_hosts." % host)
+    try:
+        addresses = socket.getaddrinfo(host, parts.port, 0,
+                                       socket.SOCK_STREAM)
+    except socket.gaierror, e:
+        raise ShareError("Can't resolve %s: %s" % (host, e))
+    for family, type_, proto, name, sockaddr in addresses:
+        if _blocked_address(family, sockaddr[0]):
+            raise ShareError("%s has a private or reserved address; list it "
+                             "in media.media_hosts to allow it." % host)
+
+
+class _CheckedRedirectHandler(urllib2.HTTPRedirectHandler):
+    # a public URL mustn't be able to bounce the download somewhere private
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if _scheme(newurl) not in ('http', 'https'):
+            raise ShareError("Media redirected to %s." % newurl)
+        _check_url(newurl)
+        return urllib2.HTTPRedirectHandler.redirect_request(
+            self, req, fp, code, msg, headers, newurl)
+
+
+_opener = urllib2.build_opener(_CheckedRedirectHandler)
+
+
+class MediaSource(object):
+    """An image at an http(s) URL, or at a file:// URL under the media root.
+
+    fetch() hashes it and, for http(s) URLs, downloads it to a temporary
+    file. The attributes below are set by fetch().
+
+    Parameters:
+    location -- the URL
+    chunk_size -- bytes read at a time
+    max_size -- largest image accepted, in bytes
+    root -- directory file:// URLs may point into. Defaults to media_root.
+
+    Attributes:
+    path -- local file holding the bytes
+    size -- length in bytes
+    digest -- SHA-1 hex digest of the bytes
+    media_type -- MIME type, e.g. 'image/png'
+    """
+
+    def __init__(self, location, chunk_size=CHUNK_SIZE,
+                 max_size=MAX_MEDIA_SIZE, root=None):
+        self.location = location
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.root = root
+        self.path = None
+        self.size = None
+        self.digest = None
+        self.media_type = None
+        self._temporary = False
+        # callers using the file, see acquire()
+        self._users = 0
+        self._closing = False
+        self._lock = threading.Lock()
+
+    @property
+    def filename(self):
+        return os.path.basename(self.location.split('?')[0]) or 'media'
+
+    def fetch(self):
+        """Reads the image through once. Returns self.
+
+        Raises ShareError for locations that aren't http(s) URLs on an
+        allowed host or file:// URLs under the media root, and for images
+        over max_size.
+        """
+        if self.digest is not None:
+            return self
+        digest = hashlib.sha1()
+        size = 0
+        scheme = _scheme(self.location)
+        if scheme in ('http', 'https'):
+            _check_url(self.location)
+            response = _opener.open(self.location, timeout=DOWNLOAD_TIMEOUT)
+            self.media_type = response.info().gettype()
+            fd, path = tempfile.mkstemp(prefix='socialshare-media-')
+            try:
+                length = response.info().getheader('Content-Length')
+                if length and length.isdigit():
+                    self._check_size(int(length))
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in iter(lambda: response.read(self.chunk_size),
+                                      ''):
+                        digest.update(chunk)
+                        size += len(chunk)
+                        self._check_size(size)
+                        f.write(chunk)
+            except Exception:
+                os.remove(path)
+                raise
+            finally:
+                response.close()
+            self.path = path
+            self._temporary = True
+        elif scheme == 'file':
+            root = self.root if self.root is not None else media_root
+            self.path = _local_path(self.location, root)
+            self._check_size(os.path.getsize(self.path))
+            for chunk in self.chunks():
+                digest.update(chunk)
+                size += len(chunk)
+        else:
+            raise ShareError("Can't fetch media from %s; use an http(s) URL "
+                             "or a file:// URL." % self.location)
+        if not self.media_type or self.media_type == 'text/plain':
+            self.media_type = (mimetypes.guess_type(self.filename)[0] or
+                               'application/octet-stream')
+        self.size = size
+        self.digest = digest.hexdigest()
+        return self
+
+    def _check_size(self, size):
+        if self.max_size is not None and size > self.max_size:
+            raise ShareError("%s is over %i bytes." % (self.location,
+                                                       self.max_size))
+
+    def open(self):
+        return open(self.path, 'rb')
+
+    def chunks(self):
+        """Yields the bytes chunk_size at a time."""
+        with self.open() as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), ''):
+                yield chunk
+
+    def acquire(self):
+        """Marks the file in use, so close() leaves it until release().
+        Returns self."""
+        with self._lock:
+            self._users += 1
+        return self
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            if self._users or not self._closing:
+                return
+        self._remove()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def close(self):
+        """Removes the downloaded copy of a URL, once nobody is using it."""
+        with self._lock:
+            self._closing = True
+            if self._users:
+                return
+        self._remove()
+
+    def _remove(self):
+        if self._temporary and self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = None
+        self.digest = None
+
+    def __repr__(self):
+        return '<MediaSource %s>' % self.location
+
+
+class MultipartBody(object):
+    """A multipart/form-data request body read lazily, so files are sent
+    from disk a block at a time. Give it to Transport.request as body.
+
+    Parameters:
+    fields -- list of (name, value) form fields
+    files -- list of (name, filename, media type, data) files, where data
+             is a fetched MediaSource or a string
+    """
+
+    def __init__(self, fields=(), files=()):
+        self.boundary = uuid.uuid4().hex
+        self._parts = []
+        for name, value in fields:
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            self._parts.append('--%s\r\nContent-Disposition: form-data; '
+                               'name="%s"\r\n\r\n%s\r\n' %
+                               (self.boundary, name, value))
+        for name, filename, media_type, data in files:
+            if isinstance(filename, unicode):
+                filename = filename.encode('utf-8')
+            self._parts.append('--%s\r\nContent-Disposition: form-data; '
+                               'name="%s"; filename="%s"\r\n'
+                               'Content-Type: %s\r\n\r\n' %
+                               (self.boundary, name, filename, media_type))
+            self._parts.append(data)
+            self._parts.append('\r\n')
+        self._parts.append('--%s--\r\n' % self.boundary)
+        self._length = sum(p.size if isinstance(p, MediaSource) else len(p)
+                           for p in self._parts)
+        self.seek(0)
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def __len__(self):
+        return self._length
+
+    def seek(self, offset):
+        """Starts over. Only seek(0) is supported."""
+        if offset:
+            raise ValueError("MultipartBody can only seek to 0.")
+        self._index = 0
+        self._current = None
+
+    def read(self, size=-1):
+        out = []
+        while self._index < len(self._parts) and size != 0:
+            part = self._parts[self._index]
+            if self._current is None:
+                if isinstance(part, MediaSource):
+                    self._current = part.open()
+                else:
+                    self._current = _StringReader(part)
+            data = self._current.read(size)
+            if not data:
+                self._current.close()
+                self._current = None
+                self._index += 1
+                continue
+            out.append(data)
+            if size > 0:
+                size -= len(data)
+        return ''.join(out)
+
+
+class _StringReader(object):
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, size=-1):
+        end = len(self.data) if size < 0 else self.pos + size
+        data = self.data[self.pos:end]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+class MediaCache(object):
+    """Fetched MediaSources by location and uploaded media IDs by network,
+    account and digest. Concurrent callers wanting the same entry wait for
+    one fetch or upload instead of each doing their own. Sources dropped from
+    the cache keep their file until the callers using them release them.
+
+    Parameters:
+    max_size -- most sources and most media IDs kept
+    max_bytes -- most bytes of sources kept. Downloads stay on disk while
+                 they are cached.
+    ttl -- seconds an entry is kept. Twitter media IDs expire after a day.
+    clock -- optional time function, for testing
+    """
+
+    def __init__(self, max_size=1024, max_bytes=512 * 1024 * 1024,
+                 ttl=23 * 60 * 60, clock=time.time):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self._sources = OrderedDict()
+        self._source_bytes = 0
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+        # striped locks, so one slow upload doesn't hold up the others
+        self._stripes = [threading.Lock() for i in range(32)]
+
+    def source(self, location):
+        """Returns the fetched MediaSource for location, acquired. Release
+        it when done, e.g. by using it as a context manager:
+
+            with media_cache.source(location) as source:
+                ...
+        """
+        return self._get(self._sources, location,
+                         lambda: MediaSource(location).fetch(), acquire=True)
+
+    def media_id(self, network, consumer_token, source, upload):
+        """Returns the media ID for source on an account, calling
+        upload(source) the first time."""
+        return self._get(self._ids, (network, consumer_token, source.digest),
+                         lambda: upload(source))
+
+    def clear(self):
+        with self._lock:
+            sources = self._sources.values()
+            self._sources.clear()
+            self._source_bytes = 0
+            self._ids.clear()
+        for value, expires in sources:
+            value.close()
+
+    def _lookup(self, entries, key, acquire):
+        with self._lock:
+            entry = entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= self.clock():
+                del entries[key]
+                self._dropped(entry[0])
+                return None
+            if acquire:
+                entry[0].acquire()
+            return entry[0]
+
+    def _get(self, entries, key, factory, acquire=False):
+        value = self._lookup(entries, key, acquire)
+        if value is not None:
+            return value
+        with self._stripes[hash(key) % len(self._stripes)]:
+            value = self._lookup(entries, key, acquire)
+            if value is not None:
+                return value
+            value = factory()
+            if value is None:
+                return None
+            with self._lock:
+                if acquire:
+                    value.acquire()
+                entries[key] = (value, self.clock() + self.ttl)
+                if isinstance(value, MediaSource):
+                    self._source_bytes += value.size
+                while (len(entries) > self.max_size or
+                       self._source_bytes > self.max_bytes and
+                       entries is self._sources):
+                    self._dropped(entries.popitem(last=False)[1][0])
+        return value
+
+    def _dropped(self, value):
+        # callers hold self._lock
+        if isinstance(value, MediaSource):
+            self._source_bytes -= value.size
+            value.close()
+
+
+# used by all backends
+media_cache = MediaCache()
@@ -0,0 +1,332 @@
+"""
+pool.py -- a small bounded thread pool for fanning shares out to several
+           networks at once.
+
+           Work is submitted with a key (normally the network name). The pool
+           never runs more than max_workers jobs at a time, and never more
+           than limits[key] jobs for a single key. Jobs over a key's cap wait
+           in a per-key line instead of tying up a worker thread.
+"""
+import logging
+import sys
+import threading
+import time
+from collections import deque
+from Queue import Queue, Empty
+
+from errors import ShareCancelled
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# ShareResult statuses
+PENDING = 'pending'
+SUCCESS = 'success'
+FAILED = 'failed'
+# already shared, so not sent again. See socialshare.dedup.
+SKIPPED = 'skipped'
+
+# size of the shared pool behind ShareBackend.ashare and AsyncSocialShare
+DEFAULT_WORKERS = 16
+
+
+class ShareResult(object):
+    """Outcome of a single share or message.
+
+    Attributes:
+    network -- the network the share was sent to
+    consumer_token -- the consumer token the share was sent as
+    status -- PENDING, SUCCESS, FAILED or SKIPPED
+    result -- whatever the backend returned
+    exception -- the exception raised by the backend, if any
+    latency -- wall clock seconds spent in the backend
+    record -- the content record the share came from, for streamed shares
+    position -- index of that record in the stream
+    """
+
+    record = None
+    position = None
+
+    def __init__(self, network, consumer_token="", status=PENDING,
+                 result=None, exception=None, latency=None):
+        self.network = network
+        self.consumer_token = consumer_token
+        self.status = status
+        self.result = result
+        self.exception = exception
+        self.latency = latency
+
+    @property
+    def ok(self):
+        return self.status in (SUCCESS, SKIPPED)
+
+    def __repr__(self):
+        return '<ShareResult %s %s %s>' % (self.network, self.status,
+                                           self.exception or '')
+
+
+class DeliveryReport(object):
+    """Per-recipient outcome of a send_message call.
+
+    Recipients can be in any format the network expects (Facebook takes
+    dicts), so they are kept as (recipient, ShareResult) pairs in send order.
+    """
+
+    def __init__(self):
+        self.results = []
+
+    def add(self, recipient, result):
+        self.results.append((recipient, result))
+
+    def get(self, recipient):
+        """Returns the ShareResult for recipient or None."""
+        for r, result in self.results:
+            if r == recipient:
+                return result
+        return None
+
+    @property
+    def delivered(self):
+        return [r for r, result in self.results if result.ok]
+
+    @property
+    def failed(self):
+        return [r for r, result in self.results if not result.ok]
+
+    @property
+    def ok(self):
+        return all(result.ok for r, result in self.results)
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+    def __repr__(self):
+        return '<DeliveryReport %i delivered %i failed>' % (
+            len(self.delivered), len(self.failed))
+
+
+class ShareFuture(object):
+    """Handle on a job submitted to a SharePool."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exc_info = None
+        self._started = False
+        self._cancelled = False
+
+    def done(self):
+        return self._done.is_set()
+
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        """Cancels the job if it hasn't started; result() then raises
+        ShareCancelled. Returns True if the job won't run."""
+        with self._lock:
+            if self._started or self._done.is_set():
+                return self._cancelled
+            self._cancelled = True
+        exc = ShareCancelled("Share cancelled before it started.")
+        self.set_exception((ShareCancelled, exc, None))
+        return True
+
+    def _start(self):
+        # True if the job may run, False if it was cancelled
+        with self._lock:
+            if self._cancelled:
+                return False
+            self._started = True
+            return True
+
+    def result(self, timeout=None):
+        """Waits for the job and returns its result, re-raising its error."""
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out waiting for share.")
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """Waits for the job and returns its exception or None."""
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out waiting for share.")
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, fn):
+        """Calls fn(future) once the job finishes, or now if it already has."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                log.exception("Share future callback failed.")
+
+
+class SharePool(object):
+    """Bounded thread pool with per-key concurrency caps.
+
+    Parameters:
+    max_workers -- most jobs running at once over all keys.
+    limits -- optional dict of key: most jobs running at once for that key.
+              e.g. {'twitter': 2, 'linkedin': 1}
+    key_limit -- optional cap for keys not in limits. With 1, jobs with the
+                 same key run one after another in the order submitted.
+    """
+
+    def __init__(self, max_workers=8, limits=None, key_limit=None):
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+        self.max_workers = max_workers
+        self.limits = dict(limits or {})
+        self.key_limit = key_limit
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._active = {}
+        self._waiting = {}
+        self._shutdown = False
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) on the pool. Returns a ShareFuture."""
+        future = ShareFuture()
+        job = (key, future, fn, args, kwargs)
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit to a pool that is shut down.")
+            limit = self.limits.get(key, self.key_limit)
+            active = self._active.get(key, 0)
+            if limit is not None and active >= limit:
+                self._waiting.setdefault(key, deque()).append(job)
+                return future
+            self._active[key] = active + 1
+            self._start_worker()
+        self._queue.put(job)
+        return future
+
+    def map(self, key, fn, items):
+        """Runs fn(item) for every item and returns the futures in order."""
+        return [self.submit(key, fn, item) for item in items]
+
+    def shutdown(self, wait=True, cancel=False):
+        """Stops the workers once queued jobs are done.
+
+        Parameters:
+        wait -- wait for the workers to finish
+        cancel -- cancel the jobs that haven't started instead of running
+                  them. Jobs already running still finish.
+        """
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            threads = list(self._threads)
+            jobs = []
+            if cancel:
+                for waiting in self._waiting.values():
+                    jobs.extend(waiting)
+                    waiting.clear()
+        while cancel:
+            try:
+                jobs.append(self._queue.get_nowait())
+            except Empty:
+                break
+        for key, future, fn, args, kwargs in jobs:
+            future.cancel()
+        for t in threads:
+            self._queue.put(None)
+        if wait:
+            for t in threads:
+                t.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def _start_worker(self):
+        # callers hold self._lock
+        if len(self._threads) >= self.max_workers:
+            return
+        t = threading.Thread(target=self._work)
+        t.daemon = True
+        t.start()
+        self._threads.append(t)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            while job is not None:
+                key, future, fn, args, kwargs = job
+                if future._start():
+                    try:
+                        result = fn(*args, **kwargs)
+                    except Exception:
+                        future.set_exception(sys.exc_info())
+                    else:
+                        future.set_result(result)
+                job = self._release(key)
+
+    def _release(self, key):
+        """Hands back the next job waiting on key, or frees key's slot."""
+        with self._lock:
+            waiting = self._waiting.get(key)
+            if waiting:
+                return waiting.popleft()
+            self._active[key] -= 1
+            return None
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool():
+    """Returns the shared SharePool used by the non-blocking APIs."""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = SharePool(max_workers=DEFAULT_WORKERS)
+        return _default_pool
+
+
+def timed_call(network, consumer_token, fn, *args, **kwargs):
+    """Calls fn and wraps the outcome in a ShareResult. Never raises."""
+    outcome = ShareResult(network, consumer_token)
+    start = time.time()
+    try:
+        outcome.result = fn(*args, **kwargs)
+        outcome.status = SUCCESS
+    except Exception, e:
+        outcome.exception = e
+        outcome.status = FAILED
+    outcome.latency = time.time() - start
+    return outcome
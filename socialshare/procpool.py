@@ -0,0 +1,200 @@
+"""
+procpool.py -- spreads bulk shares over worker processes.
+
+               One process runs out of CPU rendering payloads and running
+               SDK code long before the networks run out of capacity.
+               ProcessSharePool starts a worker process per core and sends
+               each share to a process picked by its (network, consumer
+               token). Every share for an account goes to the same process,
+               where it runs after the account's earlier shares, and that
+               process keeps the account's API client warm. Inside a process
+               shares run on a SharePool of threads.
+
+                   with ProcessSharePool(processes=8) as pool:
+                       share.do_bulk_share(mode='process', pool=pool)
+
+               Results are sent back to the parent as each share finishes.
+               Backends must be registered before the pool starts; the
+               processes are forked and see the registry as it was then.
+               Ledgers, dedup indexes and rate limits kept in memory are per
+               process; use their SQLite stores to share them.
+"""
+import logging
+import multiprocessing
+import pickle
+import zlib
+from Queue import Empty
+
+from errors import ShareError
+from pool import SharePool, ShareResult, FAILED
+from stream import share_to
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+def _portable(result):
+    """Makes sure a ShareResult can be pickled back to the parent."""
+    try:
+        pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        try:
+            pickle.dumps(result.exception, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            result.exception = ShareError(repr(result.exception))
+        try:
+            pickle.dumps(result.result, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            result.result = repr(result.result)
+    return result
+
+
+def _work(inbox, outbox, threads):
+    """Worker process loop. Shares jobs from inbox and puts (job id,
+    ShareResult) on outbox."""
+    pool = SharePool(max_workers=threads, key_limit=1)
+    def done(job_id, key):
+        # the parent waits for a result for every job, so one has to go back
+        # even if the share raised
+        def callback(future):
+            try:
+                result = future.result()
+            except Exception, e:
+                log.exception("Share job %s raised.", job_id)
+                result = ShareResult(key[0], key[1], FAILED, exception=e)
+            outbox.put((job_id, _portable(result)))
+        return callback
+    try:
+        while True:
+            job = inbox.get()
+            if job is None:
+                break
+            (job_id, share, content, api_token, api_secret, skip,
+             share_key) = job
+            key = (share['network'], share.get('consumer_token') or '')
+            future = pool.submit(key, share_to, share, content, api_token,
+                                 api_secret, skip, share_key)
+            future.add_done_callback(done(job_id, key))
+    finally:
+        pool.shutdown()
+
+
+class ProcessSharePool(object):
+    """Worker processes that shares are sharded over by account.
+
+    Meant to be driven by one caller at a time, through
+    SocialShare.do_bulk_share(mode='process') or share_stream(mode='process').
+
+    Parameters:
+    processes -- number of worker processes. Defaults to the number of CPUs.
+    threads -- shares running at once in each process
+    """
+
+    def __init__(self, processes=None, threads=8):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.threads = threads
+        self._workers = []
+        self._results = None
+        self._in_flight = {}
+        self._next_id = 0
+
+    def start(self):
+        if self._workers:
+            return self
+        self._results = multiprocessing.Queue()
+        self._workers = [self._spawn() for i in range(self.processes)]
+        return self
+
+    def _spawn(self):
+        inbox = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_work, args=(inbox, self._results, self.threads))
+        process.daemon = True
+        process.start()
+        return process, inbox
+
+    def shard(self, network, consumer_token):
+        """Returns the index of the process that shares for an account."""
+        key = '\0'.join(p.encode('utf-8') if isinstance(p, unicode) else p
+                        for p in (network, consumer_token))
+        return (zlib.crc32(key) & 0xffffffff) % self.processes
+
+    def submit(self, share, content, api_token, api_secret,
+               skip_duplicates=True, key=None):
+        """Sends one share to its account's process. Returns a job id to
+        match with the results. key is the share's idempotency key, see
+        stream.share_to."""
+        self.start()
+        job_id = self._next_id
+        self._next_id += 1
+        index = self.shard(share['network'],
+                           share.get('consumer_token') or '')
+        self._in_flight[job_id] = (index, share)
+        self._workers[index][1].put((job_id, share, content, api_token,
+                                     api_secret, skip_duplicates, key))
+        return job_id
+
+    def results(self, poll_interval=1.0):
+        """Yields (job id, ShareResult) as submitted shares finish, until
+        none are left.
+
+        If a worker process dies, its unfinished shares fail and it is
+        replaced.
+        """
+        while self._in_flight:
+            try:
+                job_id, result = self._results.get(timeout=poll_interval)
+            except Empty:
+                for failed in self._replace_dead():
+                    yield failed
+                continue
+            if self._in_flight.pop(job_id, None) is not None:
+                yield job_id, result
+
+    def _replace_dead(self):
+        failed = []
+        for index, (process, inbox) in enumerate(self._workers):
+            if process.is_alive():
+                continue
+            log.error("Share worker process %s exited with %s.",
+                      process.pid, process.exitcode)
+            self._workers[index] = self._spawn()
+            for job_id, (i, share) in self._in_flight.items():
+                if i == index:
+                    del self._in_flight[job_id]
+                    failed.append((job_id, ShareResult(
+                        share['network'], share.get('consumer_token') or '',
+                        status=FAILED,
+                        exception=ShareError("Share worker process died."))))
+        return failed
+
+    def map(self, jobs, max_in_flight=1000):
+        """Submits (share, content, api_token, api_secret, skip_duplicates,
+        key) jobs and yields (position, ShareResult) as they finish, with no more
+        than max_in_flight jobs outstanding."""
+        positions = {}
+        for position, job in enumerate(jobs):
+            while len(self._in_flight) >= max_in_flight:
+                job_id, result = self._next_result()
+                yield positions.pop(job_id), result
+            positions[self.submit(*job)] = position
+        for job_id, result in self.results():
+            yield positions.pop(job_id), result
+
+    def _next_result(self):
+        for item in self.results():
+            return item
+
+    def shutdown(self):
+        """Lets the processes finish what they have and stops them."""
+        for process, inbox in self._workers:
+            inbox.put(None)
+        for process, inbox in self._workers:
+            process.join()
+        self._workers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.shutdown()
@@ -0,0 +1,186 @@
+"""
+ratelimit.py -- paces calls to stay under each network's rate limits.
+
+                Every (network, consumer token) pair gets a token bucket
+                sized from the backend's quota. A call takes a token and
+                sleeps until one is available, so a burst of shares is spread
+                out instead of being throttled by the network.
+
+                Buckets live in a RateLimitStore. MemoryRateLimitStore keeps
+                them in process; SQLiteRateLimitStore shares them between
+                processes on one box. Anything implementing reserve() (Redis,
+                memcached, ...) can be plugged in the same way:
+
+                    ratelimit.rate_limiter = RateLimiter(store=MyStore())
+"""
+import sqlite3
+import threading
+import time
+
+from errors import RateLimited
+
+
+class TokenBucket(object):
+    """Token bucket that hands out reservations.
+
+    A reservation always takes its tokens, even if that leaves the bucket
+    owing some, and returns how long the caller has to wait before using
+    them. Concurrent callers are lined up one after another that way.
+
+    Parameters:
+    rate -- tokens added per second
+    capacity -- most tokens the bucket holds, i.e. the largest burst
+    clock -- optional time function, for testing
+    """
+
+    def __init__(self, rate, capacity, clock=time.time):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.stamp = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, n=1, max_wait=None):
+        """Takes n tokens. Returns seconds to wait before using them.
+
+        Returns None without taking anything if the wait would be longer
+        than max_wait.
+        """
+        with self._lock:
+            now = self.clock()
+            tokens = min(self.capacity,
+                         self.tokens + (now - self.stamp) * self.rate)
+            wait = max(0.0, (n - tokens) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                return None
+            self.tokens = tokens - n
+            self.stamp = now
+            return wait
+
+
+class RateLimitStore(object):
+    """Where token buckets are kept. Subclasses implement reserve."""
+
+    def reserve(self, key, rate, capacity, n=1, max_wait=None):
+        """Takes n tokens from the bucket for key.
+
+        Returns seconds to wait before using them, or None if that would be
+        longer than max_wait (in which case nothing is taken).
+
+        Parameters:
+        key -- tuple identifying the bucket, e.g. ('twitter', 'token')
+        rate -- tokens added per second
+        capacity -- most tokens the bucket holds
+        """
+        raise NotImplementedError
+
+
+class MemoryRateLimitStore(RateLimitStore):
+    """Keeps buckets in this process."""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, key, rate, capacity, n=1, max_wait=None):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(rate, capacity, clock=self.clock)
+                self._buckets[key] = bucket
+        return bucket.reserve(n, max_wait=max_wait)
+
+
+class SQLiteRateLimitStore(RateLimitStore):
+    """Keeps buckets in a SQLite file so several worker processes share them.
+
+    Parameters:
+    path -- the database file. Every process must use the same one.
+    """
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self._local = threading.local()
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS buckets '
+            '(key TEXT PRIMARY KEY, tokens REAL, stamp REAL)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def reserve(self, key, rate, capacity, n=1, max_wait=None):
+        conn = self._connection()
+        key = '|'.join(key)
+        rate = float(rate)
+        # IMMEDIATE takes the write lock up front so two processes can't
+        # both read the same token count
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = self.clock()
+            row = conn.execute('SELECT tokens, stamp FROM buckets '
+                               'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                tokens = float(capacity)
+            else:
+                tokens = min(capacity, row[0] + (now - row[1]) * rate)
+            wait = max(0.0, (n - tokens) / rate)
+            if max_wait is not None and wait > max_wait:
+                conn.execute('ROLLBACK')
+                return None
+            conn.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)',
+                         (key, tokens - n, now))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
+
+
+class RateLimiter(object):
+    """Blocks calls until their network's rate limit allows them.
+
+    Parameters:
+    store -- RateLimitStore holding the buckets. Defaults to in memory.
+    max_wait -- longest a call will sleep. Calls that would wait longer
+                raise RateLimited. None waits as long as it takes.
+    sleep -- optional sleep function, for testing
+    """
+
+    def __init__(self, store=None, max_wait=None, sleep=time.sleep):
+        self.store = store or MemoryRateLimitStore()
+        self.max_wait = max_wait
+        self.sleep = sleep
+
+    def wait(self, key, limit, n=1):
+        """Waits for n calls' worth of quota.
+
+        Parameters:
+        key -- tuple identifying the bucket, e.g. ('twitter', 'token')
+        limit -- (calls, seconds) quota, or None for no limit
+        """
+        if not limit:
+            return 0.0
+        calls, period = limit
+        delay = self.store.reserve(key, float(calls) / period, calls, n=n,
+                                   max_wait=self.max_wait)
+        if delay is None:
+            # the wait is over max_wait and at least one call's worth
+            raise RateLimited("Rate limit for %s would need a wait over %ss." %
+                               (key[0], self.max_wait),
+                              retry_after=max(self.max_wait,
+                                              float(period) / calls))
+        if delay > 0:
+            self.sleep(delay)
+        return delay
+
+
+# used by all backends
+rate_limiter = RateLimiter()
@@ -0,0 +1,183 @@
+"""
+render.py -- turns ShareContent into what each network is sent.
+
+             Rendering a payload (fitting a tweet and its link into Twitter's
+             weighted length, trimming LinkedIn's fields, ...) is done once
+             per content and network and kept in a bounded LRU keyed by the
+             content's digest. Sharing one posting to 500 accounts renders it
+             once.
+"""
+import re
+import threading
+from collections import OrderedDict
+
+from errors import ShareError
+
+# Twitter counts text by weight: most Latin, punctuation and symbol code
+# points weigh 1, everything else (CJK, emoji, ...) weighs 2. Links are
+# wrapped in t.co and always count as TCO_URL_LENGTH.
+TWEET_MAX_LENGTH = 280
+TCO_URL_LENGTH = 23
+_LIGHT_RANGES = ((0, 4351), (8192, 8205), (8208, 8223), (8242, 8247))
+_URL_RE = re.compile(r'https?://\S+', re.UNICODE)
+
+# LinkedIn share field limits
+LINKEDIN_COMMENT_LENGTH = 700
+LINKEDIN_TITLE_LENGTH = 200
+LINKEDIN_DESCRIPTION_LENGTH = 256
+
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+
+def char_weight(char):
+    code = ord(char)
+    for low, high in _LIGHT_RANGES:
+        if low <= code <= high:
+            return 1
+    return 2
+
+
+def tweet_length(text, url_length=TCO_URL_LENGTH):
+    """Returns text's length as Twitter counts it.
+
+    Parameters:
+    url_length -- length every link counts as, or None to count links by
+                  their own length.
+    """
+    text = _text(text)
+    length = 0
+    pos = 0
+    for match in _URL_RE.finditer(text):
+        length += sum(char_weight(c) for c in text[pos:match.start()])
+        if url_length is None:
+            length += len(match.group())
+        else:
+            length += url_length
+        pos = match.end()
+    return length + sum(char_weight(c) for c in text[pos:])
+
+
+def truncate_weighted(text, limit, url_length=TCO_URL_LENGTH):
+    """Cuts text down to at most limit by Twitter's weighted count. Links
+    are kept whole or cut out entirely, never broken.
+
+    Parameters:
+    url_length -- length every link counts as, or None to count links by
+                  their own length.
+    """
+    text = _text(text)
+    length = 0
+    pos = 0
+    for match in _URL_RE.finditer(text):
+        for i in range(pos, match.start()):
+            length += char_weight(text[i])
+            if length > limit:
+                return text[:i].rstrip()
+        if url_length is None:
+            length += len(match.group())
+        else:
+            length += url_length
+        if length > limit:
+            return text[:match.start()].rstrip()
+        pos = match.end()
+    for i in range(pos, len(text)):
+        length += char_weight(text[i])
+        if length > limit:
+            return text[:i].rstrip()
+    return text
+
+
+def render_tweet(content, use_tco=True):
+    """Returns the tweet text: content.tweet followed by content.url, cut to
+    fit TWEET_MAX_LENGTH. The link is never cut: if the tweet already has it
+    but is too long, it's taken out and put back at the end.
+
+    Parameters:
+    use_tco -- count the link as a t.co link instead of by its own length
+    """
+    tweet = _text(content.tweet)
+    url = _text(content.url)
+    url_length = TCO_URL_LENGTH if use_tco else None
+    if url and url in tweet:
+        if tweet_length(tweet, url_length) <= TWEET_MAX_LENGTH:
+            return tweet
+        tweet = u' '.join(tweet.replace(url, u' ').split())
+    if not url:
+        return truncate_weighted(tweet, TWEET_MAX_LENGTH, url_length)
+    room = TWEET_MAX_LENGTH - (url_length or len(url)) - 1
+    return u'%s %s' % (truncate_weighted(tweet, room, url_length), url)
+
+
+def render_linkedin(content):
+    """Returns python-linkedin share_update arguments."""
+    return {'comment': content.message[0:LINKEDIN_COMMENT_LENGTH],
+            'title': content.headline[0:LINKEDIN_TITLE_LENGTH],
+            'submitted_url': content.url,
+            'submitted_image_url': content.image_url,
+            'description': content.excerpt[0:LINKEDIN_DESCRIPTION_LENGTH]}
+
+
+def render_facebook(content):
+    """Returns Graph API me/feed link post fields."""
+    return {'message': content.excerpt,
+            'picture': content.image_url or None,
+            'caption': content.image_url_title,
+            'link': content.url or None,
+            'name': content.url_title,
+            'description': content.url_description}
+
+
+class Renderer(object):
+    """Renders payloads and keeps the most recent ones.
+
+    Parameters:
+    max_size -- most payloads kept
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.renderers = {'twitter': render_tweet,
+                          'linkedin': render_linkedin,
+                          'facebook': render_facebook}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, network, fn):
+        """Sets fn(content, **options) as the renderer for network."""
+        self.renderers[network] = fn
+
+    def render(self, network, content, **options):
+        """Returns network's payload for content, rendering it if needed.
+
+        Payloads are shared between callers and must not be changed. Raises
+        ShareError if no renderer is registered for network.
+        """
+        if network not in self.renderers:
+            raise ShareError("No renderer for %s." % network)
+        key = (network, content.digest, tuple(sorted(options.items())))
+        with self._lock:
+            try:
+                payload = self._cache.pop(key)
+            except KeyError:
+                pass
+            else:
+                self._cache[key] = payload
+                return payload
+        payload = self.renderers[network](content, **options)
+        with self._lock:
+            self._cache[key] = payload
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return payload
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+# used by all backends
+renderer = Renderer()
@@ -0,0 +1,304 @@
+"""
+results.py -- keeps a record of every share and message sent.
+
+              A ResultRecorder is an instrumentation hook that writes a
+              ShareRecord for each share and message batch a backend sends:
+              network, account, content digest, the post ID the network
+              gave back, when it went out, how it ended and how long it
+              took. Records are buffered and appended to a ResultStore in
+              batches, so recording costs one write per batch_size shares
+              instead of one per share.
+
+                  store = results.SQLiteResultStore(path)
+                  recorder = results.ResultRecorder(store)
+                  instrument.instrumentation.add_hook(recorder)
+                  ...
+                  recorder.flush()
+                  store.for_content(content.digest)
+
+              Records are never updated or deleted. Shares answered from the
+              idempotency ledger didn't reach the network and aren't
+              recorded. Buffers are kept in memory; call flush() before
+              shutting down.
+
+              Consumer tokens are credentials, so records keep a
+              fingerprint of the account (account_key) instead, the way
+              dedup and idempotency keys do.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import instrument
+import retry
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+def account_key(network, consumer_token):
+    """Returns the fingerprint records keep for an account."""
+    return retry.idempotency_key('account', network, consumer_token or '')
+
+
+class ShareRecord(object):
+    """One share, message batch or unshare.
+
+    Attributes:
+    network -- the network it went to
+    account -- account_key of the account it went to
+    digest -- ShareContent.digest of what was sent
+    operation -- 'share', 'message' or 'unshare'
+    status -- instrument.SUCCESS or instrument.FAILED
+    post_id -- ID of the post on the network, if it gave one back
+    recipients -- list of message recipients, None for shares
+    error -- repr of the exception it failed with, if any
+    created -- time.time() when it started
+    latency -- seconds it took
+    """
+
+    def __init__(self, network, account, digest, operation, status,
+                 post_id=None, recipients=None, error=None, created=None,
+                 latency=None):
+        self.network = network
+        self.account = account
+        self.digest = digest
+        self.operation = operation
+        self.status = status
+        self.post_id = post_id
+        self.recipients = recipients
+        self.error = error
+        self.created = created
+        self.latency = latency
+
+    @classmethod
+    def from_call(cls, call):
+        """Builds a record from a finished instrument.Call."""
+        error = None
+        if call.exception is not None:
+            error = repr(call.exception)
+        account = account_key(call.network, call.consumer_token)
+        return cls(call.network, account, call.digest, call.operation,
+                   call.outcome, post_id=call.post_id,
+                   recipients=call.recipients, error=error,
+                   created=call.started, latency=call.elapsed)
+
+    def __repr__(self):
+        return '<ShareRecord %s %s %s %s>' % (self.network, self.operation,
+                                              self.status, self.post_id)
+
+
+class ResultStore(object):
+    """Where ShareRecords are kept. Subclasses implement append,
+    for_content, for_account and for_posts."""
+
+    def append(self, records):
+        """Stores a list of ShareRecords."""
+        raise NotImplementedError
+
+    def for_content(self, digest):
+        """Returns the records for content with digest, oldest first."""
+        raise NotImplementedError
+
+    def for_account(self, network, consumer_token, since=None):
+        """Returns the records for an account, oldest first.
+
+        Parameters:
+        since -- only records created at or after this timestamp
+        """
+        raise NotImplementedError
+
+    def for_posts(self, post_ids):
+        """Returns the records for posts with any of post_ids, whatever
+        content they were for, oldest first."""
+        raise NotImplementedError
+
+    def posts(self, digest, accounts=None):
+        """Returns the posts of content with digest that haven't been
+        unshared, as dicts of network, account (its account_key) and
+        post_id.
+
+        Parameters:
+        accounts -- optional list of shares, like SocialShare.shares. Posts
+                    get their account's consumer_token and consumer_secret
+                    added, ready for SocialShare.do_bulk_unshare, and posts
+                    of accounts not in the list are left out.
+        """
+        # post: when it was shared
+        live = OrderedDict()
+        for record in self.for_content(digest):
+            if (record.operation == 'share' and record.post_id is not None
+                    and record.status == instrument.SUCCESS):
+                key = (record.network, record.account, record.post_id)
+                live[key] = record.created
+        # unshares are recorded with whatever content the caller had, so
+        # they're found by post ID
+        for record in self.for_posts(set(key[2] for key in live)):
+            key = (record.network, record.account, record.post_id)
+            if (record.operation == 'unshare' and key in live and
+                    record.status == instrument.SUCCESS and
+                    record.created >= live[key]):
+                del live[key]
+        shares = {}
+        for share in accounts or ():
+            shares[account_key(share['network'],
+                               share.get('consumer_token'))] = share
+        posts = []
+        for network, account, post_id in live:
+            post = {'network': network, 'account': account,
+                    'post_id': post_id}
+            if accounts is not None:
+                if account not in shares:
+                    continue
+                post['consumer_token'] = shares[account].get('consumer_token')
+                post['consumer_secret'] = shares[account].get(
+                    'consumer_secret')
+            posts.append(post)
+        return posts
+
+
+class SQLiteResultStore(ResultStore):
+    """Keeps records in an append only SQLite table, indexed by content and
+    by account.
+
+    Parameters:
+    path -- the database file
+    """
+
+    _columns = ('network', 'account', 'digest', 'operation',
+                'status', 'post_id', 'recipients', 'error', 'created',
+                'latency')
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute('CREATE TABLE IF NOT EXISTS results ('
+                     'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                     'network TEXT NOT NULL, '
+                     'account TEXT NOT NULL, '
+                     'digest TEXT, '
+                     'operation TEXT NOT NULL, '
+                     'status TEXT NOT NULL, '
+                     'post_id TEXT, '
+                     'recipients TEXT, '
+                     'error TEXT, '
+                     'created REAL NOT NULL, '
+                     'latency REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS results_digest '
+                     'ON results (digest)')
+        conn.execute('CREATE INDEX IF NOT EXISTS results_account '
+                     'ON results (network, account, created)')
+        conn.execute('CREATE INDEX IF NOT EXISTS results_post '
+                     'ON results (post_id)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def append(self, records):
+        rows = [(r.network, r.account, r.digest, r.operation,
+                 r.status, None if r.post_id is None else unicode(r.post_id),
+                 None if r.recipients is None else json.dumps(r.recipients),
+                 r.error, r.created, r.latency) for r in records]
+        conn = self._connection()
+        conn.execute('BEGIN')
+        try:
+            conn.executemany('INSERT INTO results (%s) VALUES (%s)' %
+                             (', '.join(self._columns),
+                              ', '.join('?' * len(self._columns))), rows)
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _select(self, where, params):
+        rows = self._connection().execute(
+            'SELECT %s FROM results WHERE %s ORDER BY created, id' %
+            (', '.join(self._columns), where), params)
+        records = []
+        for row in rows:
+            record = ShareRecord(*row)
+            if record.recipients is not None:
+                record.recipients = json.loads(record.recipients)
+            records.append(record)
+        return records
+
+    def for_content(self, digest):
+        return self._select('digest = ?', (digest,))
+
+    def for_account(self, network, consumer_token, since=None):
+        account = account_key(network, consumer_token)
+        if since is None:
+            return self._select('network = ? AND account = ?',
+                                (network, account))
+        return self._select('network = ? AND account = ? AND created >= ?',
+                            (network, account, since))
+
+    def for_posts(self, post_ids):
+        post_ids = [unicode(post_id) for post_id in post_ids]
+        records = []
+        # SQLite takes at most 999 parameters
+        for i in range(0, len(post_ids), 500):
+            chunk = post_ids[i:i + 500]
+            records.extend(self._select('post_id IN (%s)' %
+                                        ', '.join('?' * len(chunk)), chunk))
+        records.sort(key=lambda r: r.created)
+        return records
+
+
+class ResultRecorder(instrument.Hook):
+    """Buffers a ShareRecord per call and appends them to a store in
+    batches.
+
+    Parameters:
+    store -- ResultStore to write to
+    batch_size -- records that trigger a write
+    flush_interval -- most seconds a record waits in the buffer. Checked as
+                      calls finish, so an idle recorder needs flush().
+    clock -- optional time function, for testing
+    """
+
+    def __init__(self, store, batch_size=500, flush_interval=5.0,
+                 clock=time.time):
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self._buffer = []
+        self._oldest = None
+        self._lock = threading.Lock()
+
+    def after(self, call):
+        if call.outcome == instrument.CACHED:
+            return
+        record = ShareRecord.from_call(call)
+        with self._lock:
+            if not self._buffer:
+                self._oldest = self.clock()
+            self._buffer.append(record)
+            if (len(self._buffer) < self.batch_size and
+                    self.clock() - self._oldest < self.flush_interval):
+                return
+            batch, self._buffer = self._buffer, []
+        self._write(batch)
+
+    def flush(self):
+        """Writes out everything buffered."""
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            self.store.append(batch)
+        except Exception:
+            log.exception("Couldn't store %i share records.", len(batch))
@@ -0,0 +1,134 @@
+"""
+retry.py -- retries transient share failures and keeps a rerun of a share
+            from posting it twice.
+
+            RetryPolicy retries a call with jittered exponential backoff as
+            long as the backend says the error is retryable. A post that
+            timed out may still have gone through, and Facebook and LinkedIn
+            don't turn duplicates down, so a retry after a timeout can post
+            twice. Shares and messages sent without an idempotency key aren't
+            retried after a timeout for that reason.
+
+            A caller that may run the same logical share again names it with
+            a key:
+
+                backend.share(key=backend.idempotency_key(job_id))
+
+            SocialShare.do_bulk_share, share_job and share_stream always do.
+            Once a key has gone through, ShareLedger answers for it for ttl
+            seconds and the network isn't called again. The ledger lives in
+            one process, and a timed out attempt that did post isn't in it,
+            so keyed retries are at least once, not exactly once. Skipping
+            content an account already got is socialshare.dedup's job.
+"""
+import hashlib
+import random
+import threading
+import time
+from collections import OrderedDict
+
+
+def idempotency_key(network, consumer_token, *parts):
+    """Returns a stable hex key for sending parts to an account on network."""
+    digest = hashlib.sha1()
+    for part in (network, consumer_token) + parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        elif not isinstance(part, str):
+            part = repr(part)
+        digest.update(part)
+        digest.update('\0')
+    return digest.hexdigest()
+
+
+class RetryPolicy(object):
+    """Retries a call with jittered exponential backoff.
+
+    The wait before retry n is a random time between 0 and
+    min(max_delay, base_delay * 2 ** n) ("full jitter"), so many workers
+    retrying after the same outage don't hit the network in step.
+
+    Parameters:
+    max_attempts -- most calls made, including the first. 1 never retries.
+    base_delay -- seconds the backoff starts from
+    max_delay -- longest wait between attempts
+    sleep -- optional sleep function, for testing
+    """
+
+    def __init__(self, max_attempts=3, base_delay=1.0, max_delay=30.0,
+                 sleep=time.sleep):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+
+    def backoff(self, attempt):
+        """Seconds to wait after the given (0 based) failed attempt."""
+        return random.uniform(0, min(self.max_delay,
+                                     self.base_delay * 2 ** attempt))
+
+    def call(self, fn, is_retryable, *args, **kwargs):
+        """Calls fn until it succeeds, fails fatally or runs out of attempts.
+
+        Parameters:
+        fn -- the call to make
+        is_retryable -- fn(exception) returning True if it's worth retrying
+        """
+        attempt = 0
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except Exception, e:
+                attempt += 1
+                if attempt >= self.max_attempts or not is_retryable(e):
+                    raise
+            self.sleep(self.backoff(attempt - 1))
+
+
+class ShareLedger(object):
+    """Remembers the results of completed idempotency keys.
+
+    Parameters:
+    max_size -- most keys remembered; the oldest are forgotten first.
+    ttl -- seconds a key is remembered
+    clock -- optional time function, for testing
+    """
+
+    def __init__(self, max_size=10000, ttl=60 * 60, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._done = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns (True, result) if key has completed, else (False, None)."""
+        with self._lock:
+            entry = self._done.get(key)
+            if entry is None:
+                return False, None
+            result, expires = entry
+            if expires <= self.clock():
+                del self._done[key]
+                return False, None
+        return True, result
+
+    def record(self, key, result):
+        with self._lock:
+            self._done.pop(key, None)
+            self._done[key] = (result, self.clock() + self.ttl)
+            while len(self._done) > self.max_size:
+                self._done.popitem(last=False)
+
+    def forget(self, key):
+        with self._lock:
+            self._done.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._done.clear()
+
+
+# used by all backends
+retry_policy = RetryPolicy()
+ledger = ShareLedger()
@@ -0,0 +1,292 @@
+"""
+schedule.py -- shares that go out at a set time.
+
+               SocialShare.schedule(at, scheduler) stores a share to be done
+               at a time. A Scheduler (run with "socialshare scheduler")
+               hands each share to its handler once it is due: share_job to
+               share it right away, or a JobQueue's put to let workers do it.
+
+               Pending shares are kept in a ScheduleStore ordered by due
+               time, so adding one and taking the next due one are
+               O(log n) however many are waiting. MemoryScheduleStore is a
+               heap; SQLiteScheduleStore is an indexed table that survives
+               restarts.
+
+               Lots of shares set for the same time (the top of the hour)
+               would hit the networks all at once. spread moves each share a
+               fixed amount later within a window, picked from its content
+               and accounts so it doesn't change across restarts, and
+               max_rate caps how fast due shares are handed out.
+"""
+import calendar
+import datetime
+import heapq
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+
+from ratelimit import TokenBucket
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+def timestamp(at):
+    """Returns at as seconds since the epoch.
+
+    Parameters:
+    at -- seconds since the epoch, or a datetime. Naive datetimes are in
+          this machine's local time; give timezone aware ones (e.g. from
+          pytz) for times local to an account.
+    """
+    if isinstance(at, datetime.datetime):
+        if at.utcoffset() is not None:
+            seconds = calendar.timegm(at.utctimetuple())
+        else:
+            seconds = time.mktime(at.timetuple())
+        return seconds + at.microsecond / 1e6
+    return float(at)
+
+
+class ScheduleStore(object):
+    """Where pending shares are kept, ordered by due time."""
+
+    def add(self, due, payload):
+        """Stores a JSON serializable payload due at a timestamp. Returns
+        its id."""
+        raise NotImplementedError
+
+    def due(self, now, limit=100):
+        """Returns up to limit (id, due, payload) entries due by now,
+        soonest first."""
+        raise NotImplementedError
+
+    def remove(self, entry_id):
+        """Removes an entry once it's been handled, or to cancel it."""
+        raise NotImplementedError
+
+    def reschedule(self, entry_id, due):
+        """Moves an entry to a new due time, keeping its id."""
+        raise NotImplementedError
+
+    def next_due(self):
+        """Returns the soonest due time, or None if nothing is pending."""
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class MemoryScheduleStore(ScheduleStore):
+    """Keeps pending shares in a heap in this process.
+
+    An entry returned by due() isn't returned again unless rescheduled.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        # entry id: due time of its live heap item
+        self._due = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def add(self, due, payload):
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = payload
+            self._due[entry_id] = due
+            heapq.heappush(self._heap, (due, entry_id))
+        return entry_id
+
+    def _live(self, item):
+        # heap items of cancelled or rescheduled entries are left in place
+        return self._due.get(item[1]) == item[0]
+
+    def due(self, now, limit=100):
+        out = []
+        with self._lock:
+            while (self._heap and self._heap[0][0] <= now and
+                   len(out) < limit):
+                item = heapq.heappop(self._heap)
+                if self._live(item):
+                    due, entry_id = item
+                    del self._due[entry_id]
+                    out.append((entry_id, due, self._entries[entry_id]))
+        return out
+
+    def remove(self, entry_id):
+        with self._lock:
+            self._entries.pop(entry_id, None)
+            self._due.pop(entry_id, None)
+
+    def reschedule(self, entry_id, due):
+        with self._lock:
+            if entry_id in self._entries:
+                self._due[entry_id] = due
+                heapq.heappush(self._heap, (due, entry_id))
+
+    def next_due(self):
+        with self._lock:
+            while self._heap and not self._live(self._heap[0]):
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteScheduleStore(ScheduleStore):
+    """Keeps pending shares in a SQLite file.
+
+    Entries stay stored until removed, so shares that were being handled
+    when the scheduler stopped are handed out again when it restarts.
+
+    Parameters:
+    path -- the database file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute('CREATE TABLE IF NOT EXISTS schedule ('
+                     'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                     'due REAL NOT NULL, '
+                     'payload TEXT NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS schedule_due '
+                     'ON schedule (due)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def add(self, due, payload):
+        cursor = self._connection().execute(
+            'INSERT INTO schedule (due, payload) VALUES (?, ?)',
+            (due, json.dumps(payload)))
+        return cursor.lastrowid
+
+    def due(self, now, limit=100):
+        rows = self._connection().execute(
+            'SELECT id, due, payload FROM schedule WHERE due <= ? '
+            'ORDER BY due LIMIT ?', (now, limit))
+        return [(r[0], r[1], json.loads(r[2])) for r in rows]
+
+    def remove(self, entry_id):
+        self._connection().execute('DELETE FROM schedule WHERE id = ?',
+                                   (entry_id,))
+
+    def reschedule(self, entry_id, due):
+        self._connection().execute('UPDATE schedule SET due = ? WHERE id = ?',
+                                   (due, entry_id))
+
+    def next_due(self):
+        row = self._connection().execute(
+            'SELECT MIN(due) FROM schedule').fetchone()
+        return row[0]
+
+    def __len__(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM schedule').fetchone()[0]
+
+
+class Scheduler(object):
+    """Hands scheduled shares to a handler when they are due.
+
+    Parameters:
+    store -- ScheduleStore holding the pending shares
+    handler -- called with each due payload. A share whose handler raises
+               an exception with a retry_after attribute (like CircuitOpen
+               or RateLimited) is put off that many seconds. Other
+               exceptions are logged and the share is dropped, so hand
+               shares to a JobQueue to retry them. None for a scheduler
+               only used to add shares.
+    spread -- seconds over which shares set for the same time are spread
+    max_rate -- most shares handed out per second, None for no limit
+    poll_interval -- longest an idle scheduler sleeps before checking again
+    clock -- optional time function, for testing
+    sleep -- optional sleep function, for testing
+    """
+
+    def __init__(self, store, handler=None, spread=0, max_rate=None,
+                 poll_interval=1.0, clock=time.time, sleep=time.sleep):
+        self.store = store
+        self.handler = handler
+        self.spread = spread
+        self.poll_interval = poll_interval
+        self.clock = clock
+        self.sleep = sleep
+        self._bucket = None
+        if max_rate:
+            self._bucket = TokenBucket(max_rate, max_rate, clock=clock)
+        self._stop = threading.Event()
+
+    def offset(self, payload):
+        """Seconds payload is moved later within spread."""
+        if not self.spread:
+            return 0.0
+        key = json.dumps(payload, sort_keys=True)
+        return self.spread * (zlib.crc32(key) & 0xffffffff) / 2.0 ** 32
+
+    def add(self, at, payload):
+        """Schedules payload for at (a timestamp or datetime). Returns the
+        entry id."""
+        return self.store.add(timestamp(at) + self.offset(payload), payload)
+
+    def cancel(self, entry_id):
+        self.store.remove(entry_id)
+
+    def run_pending(self):
+        """Hands out every share that's due now. Returns how many."""
+        count = 0
+        while not self._stop.is_set():
+            entries = self.store.due(self.clock())
+            if not entries:
+                break
+            for entry_id, due, payload in entries:
+                if self._bucket is not None:
+                    self.sleep(self._bucket.reserve())
+                count += 1
+                try:
+                    self.handler(payload)
+                except Exception, e:
+                    retry_after = getattr(e, 'retry_after', None)
+                    if retry_after is not None:
+                        # at least a poll interval, so it isn't due again
+                        # within this run
+                        delay = max(retry_after, self.poll_interval)
+                        log.info("Scheduled share %s put off %ss: %s",
+                                 entry_id, delay, e)
+                        self.store.reschedule(entry_id, self.clock() + delay)
+                        continue
+                    log.exception("Scheduled share %s failed.", entry_id)
+                self.store.remove(entry_id)
+        return count
+
+    def run(self, stop_when_empty=False):
+        """Works until stop() is called, or nothing is pending if
+        stop_when_empty is True."""
+        self._stop.clear()
+        while not self._stop.is_set():
+            self.run_pending()
+            next_due = self.store.next_due()
+            if next_due is None:
+                if stop_when_empty:
+                    return
+                wait = self.poll_interval
+            else:
+                wait = min(self.poll_interval,
+                           max(0, next_due - self.clock()))
+            self._stop.wait(wait)
+
+    def stop(self):
+        self._stop.set()
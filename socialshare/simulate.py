@@ -0,0 +1,334 @@
+"""
+simulate.py -- backends that behave like a network without calling one,
+               for load testing the share pipeline offline.
+
+               simulated_backend builds a backend class with a latency
+               distribution and rates of errors, rate limit responses and
+               timeouts. Register it in place of a real network:
+
+                   register_share_backend('twitter', simulated_backend(
+                       'twitter', latency=lognormal(.2, .5), error_rate=.01,
+                       rate_limit_rate=.005, seed=1))
+
+               Real traffic can be recorded and played back. A CallRecorder
+               hook writes every call the backends make to a JSON lines
+               file, with each attempt's latency and outcome and a
+               fingerprint of the account instead of its consumer token. A
+               Replay registers backends that answer each attempt the way
+               the recording says, and run() makes the recorded calls again
+               at their recorded times, or speed times faster:
+
+                   recorder = CallRecorder('calls.jsonl')
+                   instrument.instrumentation.add_hook(recorder)
+                   ...
+                   replay = Replay('calls.jsonl', speed=10).install()
+                   results = replay.run()
+"""
+import itertools
+import json
+import math
+import random
+import socket
+import threading
+import time
+from collections import defaultdict, deque
+
+import instrument
+from backends import ShareBackend, register_share_backend, _http_status
+from backends import get_share_backend
+from errors import ShareError
+from pool import SharePool, timed_call
+from results import account_key
+from transport import HTTPError, Response
+
+
+def uniform(low, high):
+    """Latency spread evenly between low and high seconds."""
+    return lambda rng: rng.uniform(low, high)
+
+
+def exponential(mean):
+    """Latency with exponentially distributed seconds around mean."""
+    return lambda rng: rng.expovariate(1.0 / mean)
+
+
+def lognormal(median, sigma):
+    """Long tailed latency: median seconds, with sigma the spread of its
+    log."""
+    return lambda rng: rng.lognormvariate(math.log(median), sigma)
+
+
+def _http_error(status, reason):
+    return HTTPError(Response(status, reason, {},
+                              json.dumps({'error': 'simulated'})))
+
+
+class SimulatedBackend(ShareBackend):
+    """Backend answering like a network would, after a latency, with
+    errors at the configured rates. Use simulated_backend to configure one.
+
+    Shares, message batches and deletes succeed with a response like
+    {'id': 12, 'id_str': '12'}. Timeouts raise socket.timeout, rate limit
+    responses and errors raise transport.HTTPError with status 429 and 503,
+    so they're retried like the real thing.
+    """
+    network = 'simulated'
+    # seconds a call takes, or a function(random.Random) returning them
+    latency = 0.0
+    # fractions of calls answered with a 503, a 429 and a timeout
+    error_rate = 0.0
+    rate_limit_rate = 0.0
+    timeout_rate = 0.0
+    # seconds a call that times out takes
+    timeout = 10.0
+    random = random.Random()
+    sleep = staticmethod(time.sleep)
+    _ids = itertools.count(1)
+
+    def _share(self):
+        return self._respond('share')
+
+    def _send_batch(self, recipients):
+        return self._respond('message')
+
+    def _unshare(self, post_id):
+        return self._respond('unshare', post_id)
+
+    def _respond(self, operation, post_id=None):
+        rng = self.random
+        roll = rng.random()
+        if roll < self.timeout_rate:
+            self.sleep(self.timeout)
+            raise socket.timeout("timed out")
+        roll -= self.timeout_rate
+        latency = self.latency
+        if callable(latency):
+            latency = latency(rng)
+        if latency > 0:
+            self.sleep(latency)
+        if roll < self.rate_limit_rate:
+            raise _http_error(429, 'Too Many Requests')
+        roll -= self.rate_limit_rate
+        if roll < self.error_rate:
+            raise _http_error(503, 'Service Unavailable')
+        if post_id is None:
+            post_id = next(self._ids)
+        return {'id': post_id, 'id_str': str(post_id)}
+
+
+def simulated_backend(network, seed=None, base=SimulatedBackend, **settings):
+    """Returns a SimulatedBackend class for network, to register with
+    register_share_backend.
+
+    Parameters:
+    network -- the network it stands in for
+    seed -- optional random seed, for repeatable runs
+    base -- the class to subclass
+    settings -- class attributes to set: latency, error_rate,
+                rate_limit_rate, timeout_rate, timeout, sleep, or any
+                ShareBackend setting such as rate_limit
+    """
+    attrs = {'network': network, 'random': random.Random(seed),
+             '_ids': itertools.count(1)}
+    for name, value in settings.items():
+        if callable(value):
+            value = staticmethod(value)
+        attrs[name] = value
+    name = str('Simulated%sBackend' % network.title().replace('-', ''))
+    return type(name, (base,), attrs)
+
+
+class CallRecorder(instrument.Hook):
+    """Writes each call the backends make to a JSON lines file, to play back
+    with Replay.
+
+    Each line has the call's offset in seconds from the first one, network,
+    operation, account (results.account_key of the consumer token),
+    recipients, post_id, outcome, attempts, the average seconds per attempt
+    spent on the network (latency), and for failures the HTTP status or
+    'timeout' (status) and the error. tries has the latency, status and
+    error of every attempt in order. Shares answered from the idempotency
+    ledger aren't recorded.
+
+    Parameters:
+    path -- the file, appended to
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.started = None
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def after(self, call):
+        if call.outcome == instrument.CACHED:
+            return
+        latency = call.stages.get('api', 0.0) / max(call.attempts, 1)
+        entry = {'network': call.network, 'operation': call.operation,
+                 'account': account_key(call.network, call.consumer_token),
+                 'recipients': call.recipients, 'post_id': call.post_id,
+                 'outcome': call.outcome, 'attempts': call.attempts,
+                 'latency': latency}
+        entry.update(_failure(call.exception))
+        entry['tries'] = [dict(_failure(exc), latency=seconds)
+                          for seconds, exc in call.tries]
+        with self._lock:
+            if self.started is None:
+                self.started = call.started
+            entry['offset'] = max(0.0, call.started - self.started)
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def _failure(exc):
+    """Returns the status and error recorded for an exception, or None."""
+    if exc is None:
+        return {'status': None, 'error': None}
+    if isinstance(exc, socket.timeout):
+        status = 'timeout'
+    else:
+        status = _http_status(exc)
+    return {'status': status, 'error': repr(exc)}
+
+
+class ReplayBackend(SimulatedBackend):
+    """SimulatedBackend answering each attempt with the next recorded
+    attempt for its account and operation, see Replay. Falls back to the
+    simulated settings once the recording runs out."""
+    replay = None
+
+    def _respond(self, operation, post_id=None):
+        attempt = self.replay.response(self.network, self.consumer_token,
+                                       operation)
+        if attempt is None:
+            return super(ReplayBackend, self)._respond(operation, post_id)
+        if attempt['latency'] > 0:
+            self.sleep(attempt['latency'] / self.replay.speed)
+        if attempt['error'] is not None:
+            raise _replayed_error(attempt)
+        post_id = attempt['post_id'] or post_id or next(self._ids)
+        return {'id': post_id, 'id_str': unicode(post_id)}
+
+
+def _replayed_error(entry):
+    status = entry['status']
+    if status == 'timeout':
+        return socket.timeout("timed out")
+    if status:
+        return _http_error(status, 'Replayed')
+    return ShareError(entry['error'] or "Replayed failure.")
+
+
+class Replay(object):
+    """A recording made by CallRecorder, played back.
+
+    Attempts are answered in recorded order per account and operation, so
+    a call that failed twice and then went through does the same when
+    replayed with the same RetryPolicy. Backends match the recording by
+    their consumer token's account_key; run() makes its calls as the
+    recorded account fingerprints themselves.
+
+    Parameters:
+    path -- the recording
+    speed -- how many times faster than recorded to play calls and
+             latencies back
+    sleep -- optional sleep function, for testing
+    clock -- optional time function, for testing
+    """
+
+    def __init__(self, path, speed=1.0, sleep=time.sleep, clock=time.time):
+        self.speed = float(speed)
+        self.sleep = sleep
+        self.clock = clock
+        with open(path) as f:
+            self.calls = [json.loads(line) for line in f if line.strip()]
+        self.calls.sort(key=lambda entry: entry['offset'])
+        self.accounts = set(entry['account'] for entry in self.calls)
+        self._responses = defaultdict(deque)
+        for entry in self.calls:
+            # calls that never reached the network have no tries
+            for attempt in entry['tries']:
+                attempt = dict(attempt, post_id=None)
+                if attempt['error'] is None:
+                    attempt['post_id'] = entry['post_id']
+                self._responses[(entry['network'], entry['account'],
+                                 entry['operation'])].append(attempt)
+        self._lock = threading.Lock()
+
+    def response(self, network, consumer_token, operation):
+        """Returns the next recorded attempt for an account and operation,
+        as a dict of latency, status, error and post_id, or None if there
+        are no more.
+
+        Parameters:
+        consumer_token -- the account's consumer token, or its recorded
+                          account_key
+        """
+        if consumer_token not in self.accounts:
+            consumer_token = account_key(network, consumer_token)
+        with self._lock:
+            responses = self._responses.get((network, consumer_token,
+                                             operation))
+            return responses.popleft() if responses else None
+
+    def backend(self, network, **settings):
+        """Returns a ReplayBackend class for network."""
+        sleep = settings.pop('sleep', self.sleep)
+        return simulated_backend(network, base=ReplayBackend, replay=self,
+                                 sleep=sleep, **settings)
+
+    def install(self, **settings):
+        """Registers a ReplayBackend for every network in the recording.
+        settings are used once the recording runs out. Returns self."""
+        for network in set(entry['network'] for entry in self.calls):
+            register_share_backend(network, self.backend(network, **settings))
+        return self
+
+    def run(self, api_token='replay', api_secret='replay', pool=None,
+            max_workers=8):
+        """Makes the recorded calls again through the registered backends,
+        each at its recorded offset divided by speed.
+
+        Returns a ShareResult per call, in recorded order.
+
+        Parameters:
+        pool -- optional SharePool to run on
+        max_workers -- most calls running at once when there's no pool
+        """
+        own_pool = pool is None
+        if own_pool:
+            pool = SharePool(max_workers=max_workers)
+        try:
+            start = self.clock()
+            futures = []
+            for i, entry in enumerate(self.calls):
+                wait = start + entry['offset'] / self.speed - self.clock()
+                if wait > 0:
+                    self.sleep(wait)
+                backend = get_share_backend(entry['network'])(
+                    api_token, api_secret, consumer_token=entry['account'],
+                    headline=u'Replayed call %i' % i)
+                futures.append(pool.submit(entry['network'], timed_call,
+                                           entry['network'],
+                                           entry['account'],
+                                           self._call, backend, entry))
+            return [f.result() for f in futures]
+        finally:
+            if own_pool:
+                pool.shutdown()
+
+    def _call(self, backend, entry):
+        if entry['operation'] == 'message':
+            backend.to = entry['recipients'] or []
+            report = backend.send_message(skip_duplicates=False)
+            for recipient, result in report:
+                if not result.ok:
+                    raise result.exception
+            return report
+        if entry['operation'] == 'unshare':
+            return backend.unshare(entry['post_id'])
+        return backend.share()
@@ -0,0 +1,331 @@
+"""
+stream.py -- shares a stream of content records without loading it all.
+
+             share_stream reads records lazily from any iterable (a
+             generator, read_jsonl or read_csv), fans each one out to its
+             shares on a SharePool and yields ShareResults as they finish.
+             No more than max_in_flight shares are queued or running at
+             once, so memory stays flat however long the feed is.
+
+             A Checkpoint keeps how far through a feed a run got, so an
+             interrupted run picks up where it stopped:
+
+                 checkpoint = Checkpoint('backfill.db', 'postings.jsonl')
+                 records = checkpoint.resume(read_jsonl(path), shares)
+                 for result in share_stream(records, shares, ...):
+                     checkpoint.finished(result)
+                 checkpoint.save()
+"""
+import csv
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from Queue import Queue, Empty
+
+import dedup
+from backends import get_share_backend
+from content import ShareContent
+from pool import SharePool, ShareResult, FAILED, timed_call
+
+
+def share_stream(records, shares, api_token, api_secret, max_workers=8,
+                 max_in_flight=100, network_limits=None, skip_duplicates=True,
+                 mode='threads', pool=None):
+    """Shares every record with every share. Yields ShareResults.
+
+    Results come back in the order they finish. Each result's record
+    attribute is the record it belongs to, and its position attribute that
+    record's index in records.
+
+    Parameters:
+    records -- iterable of dicts of content fields (message, headline, url,
+               ...). A record's own 'shares' list is used instead of shares.
+               Other keys are ignored.
+    shares -- list of {'network', 'consumer_token', 'consumer_secret'} dicts
+    api_token -- your app's token
+    api_secret -- your app's secret
+    max_workers -- most shares running at once
+    max_in_flight -- most shares submitted but not yet yielded
+    network_limits -- optional dict of network: most shares running at once
+    skip_duplicates -- skip accounts that already got a record's content, see
+                       socialshare.dedup
+    mode -- 'threads' to share on a thread pool in this process, or
+            'process' to shard the shares over worker processes by account
+            (see socialshare.procpool). In process mode max_workers is the
+            number of threads per process and network_limits isn't used.
+    pool -- optional procpool.ProcessSharePool to use in process mode
+
+    Each record's shares are sent with an idempotency key made from the
+    stream and the record's position, see socialshare.retry.
+    """
+    run = uuid.uuid4().hex
+    if mode == 'process':
+        return _share_processes(records, shares, api_token, api_secret,
+                                max_workers, max_in_flight, skip_duplicates,
+                                pool, run)
+    if mode != 'threads':
+        raise ValueError("Unknown mode %s" % mode)
+    return _share_threads(records, shares, api_token, api_secret,
+                          max_workers, max_in_flight, network_limits,
+                          skip_duplicates, run)
+
+
+def _share_threads(records, shares, api_token, api_secret, max_workers,
+                   max_in_flight, network_limits, skip_duplicates, run):
+    done = Queue()
+    in_flight = 0
+    pool = SharePool(max_workers=max_workers, limits=network_limits)
+    finished = False
+    try:
+        for position, record in enumerate(records):
+            content = ShareContent.from_dict(record)
+            for share in record.get('shares') or shares:
+                while in_flight >= max_in_flight:
+                    yield _next_result(done)
+                    in_flight -= 1
+                future = pool.submit(share['network'], _share_record, record,
+                                     position, share, content, api_token,
+                                     api_secret, skip_duplicates,
+                                     '%s:%d' % (run, position))
+                future.add_done_callback(_put_result(done, record, position,
+                                                     share))
+                in_flight += 1
+                # hand back whatever has already finished
+                while True:
+                    try:
+                        result = done.get_nowait()
+                    except Empty:
+                        break
+                    in_flight -= 1
+                    yield result
+        while in_flight:
+            yield _next_result(done)
+            in_flight -= 1
+        finished = True
+    finally:
+        # when closed early or interrupted, drop the shares that haven't
+        # started and don't wait for the running ones
+        pool.shutdown(wait=finished, cancel=not finished)
+
+
+def _next_result(done):
+    # a Queue.get() with no timeout can't be interrupted by Ctrl-C in
+    # Python 2
+    while True:
+        try:
+            return done.get(timeout=1.0)
+        except Empty:
+            pass
+
+
+def _share_processes(records, shares, api_token, api_secret, threads,
+                     max_in_flight, skip_duplicates, pool, run):
+    from procpool import ProcessSharePool
+    own_pool = pool is None
+    if own_pool:
+        pool = ProcessSharePool(threads=threads)
+    # job number: (record, its position), until the job's result is yielded
+    sources = {}
+    def jobs():
+        number = 0
+        for position, record in enumerate(records):
+            content = ShareContent.from_dict(record)
+            for share in record.get('shares') or shares:
+                sources[number] = record, position
+                number += 1
+                yield (share, content, api_token, api_secret,
+                       skip_duplicates, '%s:%d' % (run, position))
+    try:
+        for number, result in pool.map(jobs(), max_in_flight):
+            result.record, result.position = sources.pop(number)
+            yield result
+    finally:
+        if own_pool:
+            pool.shutdown()
+
+
+def _put_result(done, record, position, share):
+    # a future that raised still has to count against in_flight
+    def callback(future):
+        try:
+            result = future.result()
+        except Exception, e:
+            result = _failed(record, position, share, e)
+        done.put(result)
+    return callback
+
+
+def _failed(record, position, share, exception):
+    result = ShareResult(share['network'], share.get('consumer_token') or '',
+                         FAILED, exception=exception)
+    result.record = record
+    result.position = position
+    return result
+
+
+def _share_record(record, position, share, content, api_token, api_secret,
+                  skip_duplicates, key):
+    try:
+        result = share_to(share, content, api_token, api_secret,
+                          skip_duplicates, key)
+    except Exception, e:
+        return _failed(record, position, share, e)
+    result.record = record
+    result.position = position
+    return result
+
+
+def share_to(share, content, api_token, api_secret, skip_duplicates=True,
+             key=None):
+    """Shares content with one share entry. Returns a ShareResult.
+
+    Parameters:
+    share -- {'network', 'consumer_token', 'consumer_secret'} dict
+    content -- ShareContent
+    skip_duplicates -- skip the share if the account already got content
+    key -- optional idempotency key naming this share, see socialshare.retry
+    """
+    consumer_token = share.get('consumer_token') or ''
+    if skip_duplicates:
+        return dedup.dedup_index.call(share['network'], consumer_token,
+                                      content, _do_share, share, content,
+                                      api_token, api_secret, key)
+    return timed_call(share['network'], consumer_token, _do_share, share,
+                      content, api_token, api_secret, key)
+
+
+def _do_share(share, content, api_token, api_secret, key=None):
+    class_ = get_share_backend(share['network'])
+    api = class_(api_token, api_secret,
+                 consumer_token=share.get('consumer_token') or '',
+                 consumer_secret=share.get('consumer_secret') or '',
+                 content=content)
+    return api.share(key=None if key is None else api.idempotency_key(key))
+
+
+def read_jsonl(path):
+    """Yields one record per line of a JSON lines file. Blank lines are
+    skipped."""
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_csv(path):
+    """Yields one record per row of a UTF-8 CSV file with a header row."""
+    with open(path, 'rb') as f:
+        for row in csv.DictReader(f):
+            yield dict((k.decode('utf-8'), v.decode('utf-8'))
+                       for k, v in row.items() if k is not None)
+
+
+class Checkpoint(object):
+    """How many records of a feed have had every share finish, kept in a
+    SQLite file.
+
+    Results finish out of order, so the checkpoint is the longest run of
+    finished records from the start. A record only finishes once every one
+    of its shares succeeded or was skipped, so the checkpoint stops at the
+    first record with a failed share. Records after it that finished before
+    an interruption are shared again on resume; keep the dedup index in the
+    same file (dedup.SQLiteDedupStore) to have them skipped instead.
+
+    Results are matched to records by their position attribute, so pass
+    what resume() yields straight to share_stream.
+
+    Parameters:
+    path -- the database file
+    name -- the feed, e.g. its file name. One file can hold several.
+    save_interval -- most seconds between saves while finishing results
+    clock -- optional time function, for testing
+    """
+
+    def __init__(self, path, name='default', save_interval=5.0,
+                 clock=time.time):
+        self.path = path
+        self.name = name
+        self.save_interval = save_interval
+        self.clock = clock
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS checkpoint '
+                           '(name TEXT PRIMARY KEY, position INTEGER)')
+        row = self._conn.execute('SELECT position FROM checkpoint '
+                                 'WHERE name = ?', (name,)).fetchone()
+        # records before position are done
+        self.position = row[0] if row else 0
+        self.saved = self.position
+        self._last_save = clock()
+        # position in the feed of the first record resume() yielded
+        self._start = self.position
+        # position in the feed: shares left
+        self._pending = {}
+        self._done = set()
+        self._lock = threading.Lock()
+
+    def resume(self, records, shares):
+        """Yields records after the checkpoint, keeping track of them.
+
+        Parameters:
+        records -- the whole feed, from the start
+        shares -- the shares records without their own are shared with
+        """
+        self._start = self.position
+        for position, record in enumerate(records):
+            if position < self._start:
+                continue
+            count = len(record.get('shares') or shares)
+            with self._lock:
+                if count:
+                    self._pending[position] = count
+                else:
+                    self._finish(position)
+            yield record
+
+    def finished(self, result):
+        """Counts a ShareResult from share_stream. Saves every
+        save_interval seconds."""
+        if result.position is None:
+            return
+        position = self._start + result.position
+        with self._lock:
+            if position not in self._pending:
+                return
+            if not result.ok:
+                # the record stays unfinished, so resuming shares it again
+                del self._pending[position]
+                return
+            self._pending[position] -= 1
+            if self._pending[position] == 0:
+                del self._pending[position]
+                self._finish(position)
+        if self.clock() - self._last_save >= self.save_interval:
+            self.save()
+
+    def _finish(self, position):
+        # callers hold self._lock
+        self._done.add(position)
+        while self.position in self._done:
+            self._done.remove(self.position)
+            self.position += 1
+
+    def save(self):
+        """Stores the checkpoint."""
+        with self._lock:
+            position = self.position
+            self._conn.execute('INSERT OR REPLACE INTO checkpoint '
+                               'VALUES (?, ?)', (self.name, position))
+            self.saved = position
+            self._last_save = self.clock()
+
+    def reset(self):
+        """Starts the feed over."""
+        with self._lock:
+            self._conn.execute('DELETE FROM checkpoint WHERE name = ?',
+                               (self.name,))
+            self.position = self.saved = 0
+            self._pending.clear()
+            self._done.clear()
@@ -1,7 +1,57 @@
-from backends import DebugBackend, ShareError
+import threading
+import time
+from backends import DebugBackend, ShareError, get_share_backend
 from __init__ import register_share_backend, available_backends, SocialShare
+from __init__ import AsyncSocialShare, share_job
+from jobs import SQLiteJobQueue, Worker
+from stream import share_stream
+from content import ShareContent
+import pickle
+from render import Renderer, tweet_length, render_tweet, TWEET_MAX_LENGTH
+from fakeserver import FakeSocialServer
+from transport import Transport, oauth1_header
+import transport
+import benchmarks
+from pool import SharePool, ShareResult
+from clients import ClientCache, client_cache
+from errors import RateLimited, ShareCancelled
+from ratelimit import (TokenBucket, RateLimiter, MemoryRateLimitStore,
+                       SQLiteRateLimitStore)
+import ratelimit
+from retry import RetryPolicy, ledger
+import retry
+from breaker import CircuitBreaker, breakers, CLOSED, OPEN, HALF_OPEN
+from errors import CircuitOpen
+import dedup
+from dedup import DedupIndex, SQLiteDedupStore
+from coalesce import Coalescer
+from procpool import ProcessSharePool
+from backends import TwitterBackend, FacebookBackend
+import media
+from schedule import (Scheduler, MemoryScheduleStore, SQLiteScheduleStore,
+                      timestamp)
+import datetime
+from instrument import instrumentation, StatsCollector, SpanHook
+from results import ResultRecorder, SQLiteResultStore, account_key
+from simulate import simulated_backend, uniform, CallRecorder, Replay
+import cli
+from stream import Checkpoint
+from StringIO import StringIO
+import json
+import sys
+import os
+import socket
+import tempfile
 import unittest2
 
+class _UTC(datetime.tzinfo):
+    def utcoffset(self, dt):
+        return datetime.timedelta(0)
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+
 class TestBackends(unittest2.TestCase):
     def setUp(self):
         self.api_token = "token"
@@ -21,11 +71,28 @@ class TestBackends(unittest2.TestCase):
         self.image_url_description = "lolcorgis > lolcats"
         self.to = ['1','2','3']
         register_share_backend('debug','DebugBackend')
+        ledger.clear()
+        breakers.reset()
+        dedup.dedup_index.clear()
+        self.default_transport = transport.default_transport
 
     def test_register_share_backend(self):
         """Register backend can register a backend"""
         register_share_backend('test','TestBackend')
         self.assertEqual(available_backends['test'], 'TestBackend')
+
+    def test_get_share_backend(self):
+        """Backends resolve from classes, names and dotted paths."""
+        register_share_backend('by-class', DebugBackend)
+        register_share_backend('by-path', 'backends.DebugBackend')
+        self.assertIs(get_share_backend('by-class'), DebugBackend)
+        self.assertIs(get_share_backend('by-path'), DebugBackend)
+        self.assertIs(get_share_backend('debug'), DebugBackend)
+        register_share_backend('by-path', 'backends.NoSuchBackend')
+        with self.assertRaises(ShareError):
+            get_share_backend('by-path')
+        with self.assertRaises(ShareError):
+            get_share_backend('never-registered')
         
     def test_debugbackend_share(self):
         """Tests that the debug backend works."""
@@ -65,7 +132,10 @@ class TestBackends(unittest2.TestCase):
                            image_url_title=self.url_title,
                            image_url_description=self.image_url_description)
         api.to = self.to
-        result = api.send_message()
+        report = api.send_message()
+        self.assertTrue(report.ok)
+        self.assertEqual(report.delivered, self.to)
+        result = report.get('1').result
         self.assertIn(self.api_token, result)
         self.assertIn(self.api_secret, result)
         self.assertIn(self.consumer_token, result)        
@@ -105,7 +175,11 @@ class TestBackends(unittest2.TestCase):
                       image_url_description=self.image_url_description,
                       shares = [{'network':'debug', 'consumer_token':'ticket', 
                                 'consumer_secret':'golden'}])
-        result = share.do_bulk_share()
+        results = share.do_bulk_share()
+        self.assertEqual(len(results), 1)
+        self.assertTrue(results[0].ok)
+        self.assertEqual(results[0].network, 'debug')
+        result = results[0].result
         self.assertIn(self.api_token, result)
         self.assertIn(self.api_secret, result)
         self.assertIn(self.consumer_token, result)        
@@ -114,6 +188,1417 @@ class TestBackends(unittest2.TestCase):
         self.assertIn(self.excerpt, result)        
         self.assertIn(self.tweet, result)     
 
+    def test_bulk_share_isolates_failures(self):
+        """One failing network doesn't stop the rest of a bulk share."""
+        register_share_backend('broken', 'ShareBackend')
+        share = SocialShare(self.api_token, self.api_secret,
+                            headline=self.headline,
+                            shares=[{'network':'debug', 'consumer_token':'a',
+                                     'consumer_secret':'b'},
+                                    {'network':'nope', 'consumer_token':'c',
+                                     'consumer_secret':'d'},
+                                    {'network':'debug', 'consumer_token':'e',
+                                     'consumer_secret':'f'}])
+        results = share.do_bulk_share(max_workers=2)
+        self.assertEqual([r.status for r in results],
+                         ['success', 'failed', 'success'])
+        self.assertEqual(results[2].consumer_token, 'e')
+        self.assertIsInstance(results[1].exception, ShareError)
+        self.assertTrue(all(r.latency is not None for r in results))
+
+    def test_share_pool_limits(self):
+        """SharePool never runs more than the per-key limit at once."""
+        lock = threading.Lock()
+        running = {'now': 0, 'most': 0}
+        def job(n):
+            with lock:
+                running['now'] += 1
+                running['most'] = max(running['most'], running['now'])
+            time.sleep(0.01)
+            with lock:
+                running['now'] -= 1
+            return n
+        with SharePool(max_workers=4, limits={'slow': 1}) as pool:
+            futures = pool.map('slow', job, range(5))
+            self.assertEqual([f.result() for f in futures], range(5))
+        self.assertEqual(running['most'], 1)
+
+    def test_share_pool_cancel(self):
+        """Shutting down with cancel drops the jobs that haven't started."""
+        started = threading.Event()
+        release = threading.Event()
+        ran = []
+        def job(n):
+            started.set()
+            release.wait(5)
+            ran.append(n)
+            return n
+        pool = SharePool(max_workers=1, limits={'slow': 1})
+        # job 3 waits in its key's line, the others in the queue
+        futures = [pool.submit('fast', job, 0), pool.submit('fast', job, 1),
+                   pool.submit('slow', job, 2), pool.submit('slow', job, 3)]
+        started.wait(5)
+        pool.shutdown(wait=False, cancel=True)
+        release.set()
+        self.assertEqual(futures[0].result(timeout=5), 0)
+        for future in futures[1:]:
+            self.assertTrue(future.cancelled())
+            with self.assertRaises(ShareCancelled):
+                future.result(timeout=5)
+        self.assertFalse(futures[0].cancel())
+        self.assertEqual(ran, [0])
+
+    def test_debugbackend_ashare(self):
+        """ashare runs the share off the calling thread."""
+        api = DebugBackend(self.api_token, self.api_secret,
+                           consumer_token=self.consumer_token,
+                           consumer_secret=self.consumer_secret,
+                           headline=self.headline)
+        api.to = self.to
+        done = []
+        future = api.ashare()
+        future.add_done_callback(done.append)
+        self.assertIn(self.headline, future.result(timeout=5))
+        self.assertEqual(done, [future])
+        report = api.asend_message().result(timeout=5)
+        self.assertEqual(report.delivered, self.to)
+
+    def test_async_bulk_share(self):
+        """AsyncSocialShare returns futures of ShareResults."""
+        share = AsyncSocialShare(self.api_token, self.api_secret,
+                                 headline=self.headline,
+                                 shares=[{'network':'debug',
+                                          'consumer_token':'a',
+                                          'consumer_secret':'b'}])
+        futures = share.do_bulk_share()
+        result = futures[0].result(timeout=5)
+        self.assertTrue(result.ok)
+        self.assertIn(self.headline, result.result)
+
+    def test_client_cache_lru(self):
+        """ClientCache reuses clients and drops the least recently used."""
+        cache = ClientCache(max_size=2)
+        built = []
+        def factory(name):
+            return lambda: built.append(name) or name
+        self.assertEqual(cache.get('a', factory('a')), 'a')
+        cache.get('b', factory('b'))
+        cache.get('a', factory('a2'))
+        cache.get('c', factory('c'))
+        self.assertEqual(built, ['a', 'b', 'c'])
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+
+    def test_backend_reuses_client(self):
+        """Backends for the same account share one API client."""
+        built = []
+        class ClientBackend(DebugBackend):
+            network = 'client-test'
+            def __init__(self, *args, **kwargs):
+                super(ClientBackend, self).__init__(*args, **kwargs)
+                self.api = self._get_api()
+            def _create_api(self):
+                built.append(self.consumer_token)
+                return object()
+        one = ClientBackend(self.api_token, self.api_secret, consumer_token='a')
+        two = ClientBackend(self.api_token, self.api_secret, consumer_token='a')
+        three = ClientBackend(self.api_token, self.api_secret, consumer_token='b')
+        self.assertIs(one.api, two.api)
+        self.assertIsNot(one.api, three.api)
+        self.assertEqual(built, ['a', 'b'])
+        client_cache.clear()
+
+    def test_send_message_batches(self):
+        """send_message splits recipients into batches and reports each."""
+        class BatchBackend(DebugBackend):
+            message_batch_size = 2
+            def _send_batch(self, recipients):
+                if '3' in recipients:
+                    raise ShareError('batch failed')
+                return super(BatchBackend, self)._send_batch(recipients)
+        api = BatchBackend(self.api_token, self.api_secret)
+        api.to = ['1', '2', '3', '4', '5']
+        report = api.send_message()
+        self.assertEqual(len(report), 5)
+        self.assertEqual(report.delivered, ['1', '2', '5'])
+        self.assertEqual(report.failed, ['3', '4'])
+        self.assertEqual(report.get('4').exception.msg, 'batch failed')
+        self.assertIn(['1', '2'], report.get('1').result)
+
+    def test_token_bucket(self):
+        """Token buckets allow a burst and then pace calls."""
+        now = [0.0]
+        bucket = TokenBucket(rate=2, capacity=2, clock=lambda: now[0])
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0.5)
+        self.assertEqual(bucket.reserve(), 1.0)
+        self.assertIsNone(bucket.reserve(max_wait=1.0))
+        now[0] = 10.0
+        self.assertEqual(bucket.reserve(), 0)
+
+    def test_rate_limiter(self):
+        """RateLimiter sleeps per key and gives up past max_wait."""
+        now = [0.0]
+        slept = []
+        limiter = RateLimiter(MemoryRateLimitStore(clock=lambda: now[0]),
+                              max_wait=5, sleep=slept.append)
+        limit = (1, 2)
+        limiter.wait(('twitter', 'a'), limit)
+        limiter.wait(('twitter', 'b'), limit)
+        limiter.wait(('twitter', 'a'), limit)
+        self.assertEqual(slept, [2.0])
+        limiter.wait(('twitter', 'a'), limit)
+        with self.assertRaises(RateLimited):
+            limiter.wait(('twitter', 'a'), limit)
+        self.assertEqual(limiter.wait(('debug', 'a'), None), 0)
+
+    def test_sqlite_rate_limit_store(self):
+        """SQLite buckets are shared by every store on the same file."""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            now = [0.0]
+            one = SQLiteRateLimitStore(path, clock=lambda: now[0])
+            two = SQLiteRateLimitStore(path, clock=lambda: now[0])
+            self.assertEqual(one.reserve(('twitter', 'a'), 1, 1), 0)
+            self.assertEqual(two.reserve(('twitter', 'a'), 1, 1), 1.0)
+            self.assertIsNone(two.reserve(('twitter', 'a'), 1, 1, max_wait=1))
+        finally:
+            os.remove(path)
+
+    def test_retry_policy(self):
+        """RetryPolicy retries transient errors with growing backoff."""
+        slept = []
+        policy = RetryPolicy(max_attempts=3, base_delay=1, max_delay=10,
+                             sleep=slept.append)
+        calls = []
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise socket.error('reset')
+            return 'ok'
+        retryable = lambda e: isinstance(e, socket.error)
+        self.assertEqual(policy.call(flaky, retryable), 'ok')
+        self.assertEqual(len(slept), 2)
+        self.assertTrue(0 <= slept[0] <= 1 and 0 <= slept[1] <= 2)
+        def fatal():
+            calls.append(1)
+            raise ShareError('nope')
+        del calls[:]
+        with self.assertRaises(ShareError):
+            policy.call(fatal, retryable)
+        self.assertEqual(len(calls), 1)
+
+    def test_share_is_idempotent(self):
+        """A share that went through with a key isn't sent again."""
+        calls = []
+        class CountingBackend(DebugBackend):
+            def _share(self):
+                calls.append(self.consumer_token)
+                return len(calls)
+        one = CountingBackend(self.api_token, self.api_secret,
+                              consumer_token='a', headline=self.headline)
+        again = CountingBackend(self.api_token, self.api_secret,
+                                consumer_token='a', headline=self.headline)
+        other = CountingBackend(self.api_token, self.api_secret,
+                                consumer_token='b', headline=self.headline)
+        key = one.idempotency_key('job-1')
+        self.assertEqual(one.share(key=key), 1)
+        self.assertEqual(again.share(key=key), 1)
+        self.assertEqual(other.share(key=other.idempotency_key('job-1')), 2)
+        self.assertNotEqual(one.idempotency_key(), other.idempotency_key())
+        self.assertEqual(calls, ['a', 'b'])
+        # without a key every call is a new share
+        self.assertEqual(again.share(), 3)
+        # and keys are only remembered for the ledger's ttl
+        now = [0]
+        retry.ledger = retry.ShareLedger(ttl=60, clock=lambda: now[0])
+        try:
+            self.assertEqual(one.share(key=key), 4)
+            self.assertEqual(one.share(key=key), 4)
+            now[0] = 60
+            self.assertEqual(one.share(key=key), 5)
+        finally:
+            retry.ledger = ledger
+
+    def test_timeouts_retried_only_with_key(self):
+        """A share that timed out is only retried when it has a key."""
+        calls = []
+        class TimingOutBackend(DebugBackend):
+            def _share(self):
+                calls.append(1)
+                if len(calls) == 1:
+                    raise socket.timeout('timed out')
+                return len(calls)
+        api = TimingOutBackend(self.api_token, self.api_secret,
+                               consumer_token='a', headline=self.headline)
+        policy = retry.retry_policy
+        retry.retry_policy = RetryPolicy(sleep=lambda seconds: None)
+        try:
+            with self.assertRaises(socket.timeout):
+                api.share()
+            self.assertEqual(len(calls), 1)
+            del calls[:]
+            self.assertEqual(api.share(key=api.idempotency_key('job')), 2)
+            # share jobs name their shares, so their timeouts are retried
+            del calls[:]
+            register_share_backend('timing-out', TimingOutBackend)
+            share = SocialShare(self.api_token, self.api_secret,
+                                headline=self.headline,
+                                shares=[{'network':'timing-out',
+                                         'consumer_token':'a',
+                                         'consumer_secret':'b'}])
+            fd, path = tempfile.mkstemp()
+            os.close(fd)
+            try:
+                queue = SQLiteJobQueue(path)
+                share.enqueue(queue)
+                job = queue.reserve(timeout=60)
+                self.assertIn('key', job.payload)
+                self.assertTrue(share_job(job.payload)[0].ok)
+                self.assertEqual(len(calls), 2)
+            finally:
+                os.remove(path)
+        finally:
+            retry.retry_policy = policy
+
+    def test_job_queue(self):
+        """Enqueued shares are done by workers, failures are dead lettered."""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            queue = SQLiteJobQueue(path)
+            share = SocialShare(self.api_token, self.api_secret,
+                                headline=self.headline,
+                                shares=[{'network':'debug',
+                                         'consumer_token':'a',
+                                         'consumer_secret':'b'}])
+            share.enqueue(queue)
+            share.shares = [{'network':'missing', 'consumer_token':'a',
+                             'consumer_secret':'b'}]
+            bad_id = share.enqueue(queue)
+            self.assertEqual(len(queue), 2)
+            job = queue.reserve(timeout=60)
+            self.assertEqual(job.payload['headline'], self.headline)
+            self.assertEqual([j.id for j in queue.in_flight()], [job.id])
+            queue.ack(job.id)
+            Worker(queue, share_job, workers=2).run(stop_when_empty=True)
+            self.assertEqual(len(queue), 0)
+            dead = queue.dead()
+            self.assertEqual([j.id for j, error in dead], [bad_id])
+            self.assertIn('missing', dead[0][1])
+        finally:
+            os.remove(path)
+
+    def test_worker_renews_reservations(self):
+        """A job that runs past its reservation isn't handed out again."""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            queue = SQLiteJobQueue(path)
+            job_id = queue.put({'n': 1})
+            runs = []
+            def slow(payload):
+                runs.append(payload)
+                time.sleep(1.0)
+            worker = Worker(queue, slow, workers=2, timeout=0.3,
+                            poll_interval=0.05)
+            # the idle worker keeps polling while the other runs the job
+            running = threading.Thread(target=worker.run)
+            running.start()
+            time.sleep(1.2)
+            worker.stop()
+            running.join()
+            self.assertEqual(runs, [{'n': 1}])
+            self.assertEqual(len(queue), 0)
+            self.assertEqual(queue.dead(), [])
+            # without renewal the reservation runs out mid-job
+            job_id = queue.put({'n': 2})
+            queue.reserve(timeout=0.3)
+            time.sleep(0.4)
+            self.assertEqual(queue.reserve(timeout=0.3).id, job_id)
+            queue.extend(job_id, 60)
+            self.assertIsNone(queue.reserve(timeout=0.3))
+        finally:
+            os.remove(path)
+
+    def test_share_stream(self):
+        """share_stream reads records lazily and yields every result."""
+        read = []
+        def records():
+            for i in range(20):
+                read.append(i)
+                yield {'headline': 'posting %i' % i, 'id': i}
+        shares = [{'network':'debug', 'consumer_token':'a',
+                   'consumer_secret':'b'},
+                  {'network':'debug', 'consumer_token':'c',
+                   'consumer_secret':'d'}]
+        stream = share_stream(records(), shares, self.api_token,
+                              self.api_secret, max_workers=2, max_in_flight=4)
+        first = next(stream)
+        self.assertTrue(first.ok)
+        self.assertLess(len(read), 20)
+        results = [first] + list(stream)
+        self.assertEqual(len(results), 40)
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(sorted(set(r.record['id'] for r in results)),
+                         range(20))
+        self.assertTrue(all(r.position == r.record['id'] for r in results))
+        self.assertIn('posting 3', [r for r in results
+                                    if r.record['id'] == 3][0].result)
+        # a share that raises outside the backend still yields a result
+        class BrokenIndex(object):
+            def call(self, *args):
+                raise IOError("dedup store is down")
+        index, dedup.dedup_index = dedup.dedup_index, BrokenIndex()
+        try:
+            results = list(share_stream(records(), shares, self.api_token,
+                                        self.api_secret, max_in_flight=4))
+        finally:
+            dedup.dedup_index = index
+        self.assertEqual(len(results), 40)
+        self.assertTrue(all(r.status == 'failed' for r in results))
+        self.assertIsInstance(results[0].exception, IOError)
+        self.assertIsNotNone(results[0].record)
+
+    def test_share_content(self):
+        """ShareContent is normalized once, immutable and shared."""
+        content = ShareContent(message='  hi  ', headline='x' * 200,
+                               url=' http://a ')
+        self.assertEqual(content.message, 'hi')
+        self.assertEqual(len(content.headline), 128)
+        self.assertEqual(content.excerpt, content.headline)
+        self.assertEqual(content.url, u'http://a')
+        with self.assertRaises(AttributeError):
+            content.message = 'changed'
+        with self.assertRaises(AttributeError):
+            content.other = 1
+        self.assertEqual(pickle.loads(pickle.dumps(content)), content)
+        self.assertEqual(content.digest, ShareContent.from_dict(
+            content.to_dict()).digest)
+        one = DebugBackend(self.api_token, self.api_secret, content=content)
+        two = DebugBackend(self.api_token, self.api_secret, content=content)
+        self.assertIs(one.content, two.content)
+        one.tweet = 'just for one'
+        self.assertEqual(one.tweet, 'just for one')
+        self.assertEqual(two.tweet, content.tweet)
+
+    def test_bulk_share_content(self):
+        """SocialShare takes a ShareContent and builds it once per share."""
+        content = ShareContent(headline=self.headline)
+        share = SocialShare(self.api_token, self.api_secret, content=content,
+                            shares=[{'network':'debug', 'consumer_token':'a',
+                                     'consumer_secret':'b'}])
+        self.assertIs(share.get_content(), content)
+        self.assertIn(self.headline, share.do_bulk_share()[0].result)
+        share.headline = 'changed'
+        self.assertEqual(share.get_content().headline, 'changed')
+
+    def test_tweet_rendering(self):
+        """Tweets are fit to Twitter's weighted length with their link."""
+        self.assertEqual(tweet_length(u'abc'), 3)
+        self.assertEqual(tweet_length(u'\u65e5\u672c'), 4)
+        self.assertEqual(tweet_length(u'see http://example.com/a/long/path'),
+                         4 + 23)
+        self.assertEqual(tweet_length(u'see http://x.co', url_length=None), 15)
+        content = ShareContent(tweet=u'\u65e5' * 150,
+                               url='http://example.com/jobs/1')
+        tweet = render_tweet(content)
+        self.assertTrue(tweet.endswith(' http://example.com/jobs/1'))
+        self.assertLessEqual(tweet_length(tweet), TWEET_MAX_LENGTH)
+        self.assertGreater(tweet_length(tweet), TWEET_MAX_LENGTH - 2)
+        self.assertEqual(render_tweet(ShareContent(tweet='short')), 'short')
+        # links in the text are never cut in half
+        url = 'http://example.com/jobs/2'
+        tweet = render_tweet(ShareContent(tweet=u'\u65e5' * 130 + ' ' + url,
+                                          url=url))
+        self.assertEqual(tweet, u'\u65e5' * 128 + ' ' + url)
+        tweet = render_tweet(ShareContent(
+            tweet=u'\u65e5' * 135 + ' http://example.com/other'))
+        self.assertEqual(tweet, u'\u65e5' * 135)
+
+    def test_renderer_cache(self):
+        """Renderer renders each content once per network and options."""
+        calls = []
+        renderer = Renderer(max_size=2)
+        renderer.register('debug', lambda c, **o: calls.append(c) or c.tweet)
+        one = ShareContent(tweet='one')
+        for i in range(3):
+            self.assertEqual(renderer.render('debug', one), 'one')
+        renderer.render('debug', ShareContent(tweet='one'))
+        self.assertEqual(len(calls), 1)
+        renderer.render('debug', one, upper=True)
+        renderer.render('debug', ShareContent(tweet='two'))
+        renderer.render('debug', one)
+        self.assertEqual(len(calls), 4)
+        with self.assertRaises(ShareError):
+            renderer.render('nowhere', one)
+        # a backend under its own network name renders like its base class
+        class RegionalTwitter(TwitterBackend):
+            network = 'twitter-eu'
+        api = RegionalTwitter(self.api_token, self.api_secret,
+                              consumer_token='a', consumer_secret='b',
+                              tweet=self.tweet, url=self.url)
+        self.assertEqual(api.payload(), render_tweet(api.content))
+
+    def test_transport_fake_server(self):
+        """Backends share through the transport and reuse connections."""
+        with FakeSocialServer() as server:
+            transport.default_transport = Transport(base_urls=server.base_urls,
+                                                    pool_size=2)
+            try:
+                share = SocialShare(self.api_token, self.api_secret,
+                                    headline=self.headline, url=self.url,
+                                    shares=[{'network': n,
+                                             'consumer_token': 'ct%i' % i,
+                                             'consumer_secret': 'cs'}
+                                            for n in ('twitter', 'facebook',
+                                                      'linkedin')
+                                            for i in range(3)])
+                results = share.do_bulk_share()
+                self.assertTrue(all(r.ok for r in results), results)
+                self.assertEqual(len(server.requests), 9)
+                tweets = [r for r in server.requests if r.network == 'twitter']
+                self.assertEqual(tweets[0].params['status'],
+                                 '%s %s' % (self.headline, self.url))
+                self.assertTrue(tweets[0].headers['authorization']
+                                .startswith('OAuth '))
+                pools = transport.default_transport._pools.values()
+                self.assertLessEqual(sum(p.created for p in pools), 6)
+            finally:
+                transport.default_transport.close()
+                transport.default_transport = self.default_transport
+                client_cache.clear()
+
+    def test_media_upload(self):
+        """Images are uploaded once per account and attached to posts."""
+        fd, path = tempfile.mkstemp(suffix='.png')
+        os.write(fd, os.urandom(5 * 1024 * 1024 // 2))
+        os.close(fd)
+        TwitterBackend.attach_media = FacebookBackend.attach_media = True
+        media.media_root = os.path.dirname(path)
+        try:
+            with FakeSocialServer() as server:
+                transport.default_transport = Transport(
+                    base_urls=server.base_urls)
+                share = SocialShare(self.api_token, self.api_secret,
+                                    headline=self.headline,
+                                    image_url='file://' + path,
+                                    shares=[{'network': n,
+                                             'consumer_token': 'ct%i' % i,
+                                             'consumer_secret': 'cs'}
+                                            for n in ('twitter', 'facebook')
+                                            for i in range(2)])
+                self.assertTrue(all(r.ok for r in share.do_bulk_share()))
+                share.headline = self.title
+                self.assertTrue(all(r.ok for r in share.do_bulk_share()))
+                self.assertEqual(sorted(len(v) for v in server.media.values()),
+                                 [os.path.getsize(path)] * 4)
+                appends = [r for r in server.requests
+                           if r.params.get('command') == 'APPEND']
+                self.assertEqual(len(appends), 6)
+                tweets = [r for r in server.requests
+                          if r.path == '/1.1/statuses/update.json']
+                self.assertEqual(len(tweets), 4)
+                self.assertTrue(all(r.params['media_ids'] in server.media
+                                    for r in tweets))
+                posts = [r for r in server.requests if r.path == '/me/feed']
+                self.assertIn('media_fbid', posts[0].params['attached_media'])
+                self.assertNotIn('picture', posts[0].params)
+        finally:
+            TwitterBackend.attach_media = FacebookBackend.attach_media = False
+            media.media_root = None
+            transport.default_transport.close()
+            transport.default_transport = self.default_transport
+            client_cache.clear()
+            media.media_cache.clear()
+            os.remove(path)
+
+    def test_multipart_body(self):
+        """MultipartBody streams fields and files and can start over."""
+        fd, path = tempfile.mkstemp()
+        os.write(fd, 'corgi' * 1000)
+        os.close(fd)
+        try:
+            source = media.MediaSource('file://' + path, chunk_size=64,
+                                       root=os.path.dirname(path)).fetch()
+            self.assertEqual(source.size, 5000)
+            self.assertEqual(len(list(source.chunks())), 79)
+            body = media.MultipartBody([('a', u'b')],
+                                       [('f', 'x.txt', 'text/plain', source)])
+            data = body.read(100) + body.read()
+            self.assertEqual(len(data), len(body))
+            self.assertIn('corgi' * 1000, data)
+            body.seek(0)
+            self.assertEqual(body.read(), data)
+        finally:
+            os.remove(path)
+
+    def test_media_sources(self):
+        """Media is only read from allowed places, and cached files stay
+        until their last user is done."""
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'corgi.png')
+        with open(path, 'wb') as f:
+            f.write('corgi' * 100)
+        try:
+            for location in (path, 'file://' + path, 'file:///etc/passwd',
+                             'ftp://example.com/corgi.png'):
+                with self.assertRaises(ShareError):
+                    media.MediaSource(location).fetch()
+            source = media.MediaSource('file://' + path, root=tmp).fetch()
+            self.assertEqual(source.size, 500)
+            with self.assertRaises(ShareError):
+                media.MediaSource('file://' + path, root=tmp,
+                                  max_size=499).fetch()
+            source = media.MediaSource('file://' + path, root=tmp).fetch()
+            source._temporary = True
+            source.acquire()
+            source.close()
+            self.assertTrue(os.path.exists(path))
+            source.release()
+            self.assertFalse(os.path.exists(path))
+        finally:
+            for name in os.listdir(tmp):
+                os.remove(os.path.join(tmp, name))
+            os.rmdir(tmp)
+
+    def test_media_hosts(self):
+        """Images aren't downloaded from private addresses, redirects
+        included, unless media_hosts lists the host."""
+        for location in ('http://127.0.0.1/corgi.png',
+                         'http://localhost:8080/corgi.png',
+                         'https://10.1.2.3/corgi.png',
+                         'http://169.254.169.254/latest/meta-data/',
+                         'http://[::1]/corgi.png',
+                         'http://[::ffff:192.168.0.1]/corgi.png'):
+            with self.assertRaises(ShareError):
+                media.MediaSource(location).fetch()
+        self.assertFalse(media._blocked_address(socket.AF_INET,
+                                                '93.184.216.34'))
+        self.assertFalse(media._blocked_address(socket.AF_INET6,
+                                                '2606:2800:220:1::'))
+        import BaseHTTPServer
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/moved':
+                    self.send_response(302)
+                    self.send_header('Location', 'http://localhost:%i/'
+                                     'corgi.png' % self.server.server_port)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.end_headers()
+                self.wfile.write('corgi' * 100)
+            def log_message(self, *args):
+                pass
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        media.media_hosts = ['127.0.0.1']
+        try:
+            base = 'http://127.0.0.1:%i' % server.server_port
+            source = media.MediaSource(base + '/corgi.png').fetch()
+            self.assertEqual(source.size, 500)
+            source.close()
+            with self.assertRaises(ShareError):
+                media.MediaSource(base + '/moved').fetch()
+        finally:
+            media.media_hosts = None
+            server.shutdown()
+            server.server_close()
+
+    def test_media_cache_bytes(self):
+        """The media cache drops the oldest sources to stay under
+        max_bytes."""
+        tmp = tempfile.mkdtemp()
+        media.media_root = tmp
+        try:
+            cache = media.MediaCache(max_bytes=1000)
+            sources = []
+            for i in range(3):
+                path = os.path.join(tmp, 'corgi%i.png' % i)
+                with open(path, 'wb') as f:
+                    f.write('corgi' * 80)
+                with cache.source('file://' + path) as source:
+                    sources.append(source)
+            self.assertIsNone(sources[0].digest)
+            self.assertIsNotNone(sources[1].digest)
+            self.assertIsNotNone(sources[2].digest)
+            cache.clear()
+            self.assertIsNone(sources[2].digest)
+        finally:
+            media.media_root = None
+            for name in os.listdir(tmp):
+                os.remove(os.path.join(tmp, name))
+            os.rmdir(tmp)
+
+    def test_transport_timeout(self):
+        """Slow networks time out instead of hanging."""
+        with FakeSocialServer(latency=0.5) as server:
+            t = Transport(base_urls=server.base_urls,
+                          timeouts={'facebook': (1, 0.05)})
+            with self.assertRaises(socket.timeout):
+                t.request('facebook', 'POST',
+                          'https://graph.facebook.com/me/feed',
+                          params={'access_token': 'a'})
+            t.close()
+
+    def test_transport_resend(self):
+        """Only requests a stale keep-alive connection never sent are sent
+        again."""
+        import httplib
+        class Conn(object):
+            status, reason, will_close = 200, 'OK', False
+            def getheaders(self):
+                return []
+            def close(self):
+                pass
+        class Pool(transport.ConnectionPool):
+            def _new(self):
+                return Conn()
+            def _send(self, conn, method, path, body, headers):
+                sent.append(conn)
+                error = errors.pop(0)
+                if error is not None:
+                    raise error
+                return conn, 'ok'
+        pool = Pool('http', 'example.com')
+        pool._idle.append(Conn())
+        sent, errors = [], [httplib.BadStatusLine("''"), None]
+        self.assertEqual(pool.request('POST', '/').body, 'ok')
+        self.assertEqual(len(sent), 2)
+        pool._idle.append(Conn())
+        sent, errors = [], [httplib.IncompleteRead('partial'), None]
+        with self.assertRaises(httplib.IncompleteRead):
+            pool.request('POST', '/')
+        self.assertEqual(len(sent), 1)
+
+    def test_oauth1_header(self):
+        """OAuth 1.0a signatures match Twitter's documented example."""
+        header = oauth1_header(
+            'POST', 'https://api.twitter.com/1.1/statuses/update.json',
+            {'status': 'Hello Ladies + Gentlemen, a signed OAuth request!',
+             'include_entities': 'true'},
+            'xvz1evFS4wEEPTGEFPHBog',
+            'kAcSOqF21Fu85e7zjz7ZN2U4ZRhfV3WpwPAoE3Z7kBw',
+            '370773112-GmHxMAgYyLbNEtIKZeRNFsMKPR9EyMZeS9weJAEb',
+            'LswwdoUaIvS8ltyTt5jkRh4J50vUPVVHtR2YPi5kE',
+            nonce='kYjzVBB8Y0ZFabxSWbWovY3uYSQ2pTgmZeNu2VS4cg',
+            timestamp=1318622958)
+        self.assertIn('oauth_signature="hCtSmYh%2BiHYCEqBWrE7C7hYmtUk%3D"',
+                      header)
+
+    def test_instrumentation(self):
+        """Hooks see every share with its outcome and stage timings."""
+        class FailingBackend(DebugBackend):
+            def _share(self):
+                raise ShareError("refused")
+        class Span(object):
+            def __init__(self, name):
+                self.name = name
+                self.attributes = {}
+                self.ended = False
+            def set_attribute(self, key, value):
+                self.attributes[key] = value
+            def end(self):
+                self.ended = True
+        class Tracer(object):
+            spans = []
+            def start_span(self, name):
+                self.spans.append(Span(name))
+                return self.spans[-1]
+        stats = StatsCollector()
+        tracer = Tracer()
+        spans = SpanHook(tracer)
+        instrumentation.add_hook(stats)
+        instrumentation.add_hook(spans)
+        try:
+            backend = DebugBackend(self.api_token, self.api_secret,
+                                   consumer_token='a', headline=self.headline)
+            backend.share(key='k')
+            backend.share(key='k')
+            backend.to = ['x', 'y']
+            backend.send_message()
+            failing = FailingBackend(self.api_token, self.api_secret,
+                                     consumer_token='b',
+                                     headline=self.headline)
+            self.assertRaises(ShareError, failing.share)
+        finally:
+            instrumentation.remove_hook(stats)
+            instrumentation.remove_hook(spans)
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['counters'],
+                         {'debug.share.success': 1,
+                          'debug.share.cached': 1,
+                          'debug.message.success': 1,
+                          'debug.share.failed': 1})
+        self.assertEqual(snapshot['timings']['debug.share.api']['count'], 2)
+        self.assertEqual(snapshot['timings']['debug.share.total']['count'], 3)
+        self.assertEqual([s.name for s in tracer.spans],
+                         ['socialshare.share'] * 2 +
+                         ['socialshare.message', 'socialshare.share'])
+        self.assertTrue(all(s.ended for s in tracer.spans))
+        self.assertEqual(tracer.spans[-1].attributes['socialshare.outcome'],
+                         'failed')
+        self.assertEqual(instrumentation.hooks, ())
+
+    def test_circuit_breaker(self):
+        """A breaker opens on failures, then lets a trial call through."""
+        now = [0]
+        circuit = CircuitBreaker('down', failure_threshold=2,
+                                 reset_timeout=10, clock=lambda: now[0])
+        circuit.before_call()
+        circuit.record_failure()
+        self.assertEqual(circuit.state, CLOSED)
+        circuit.record_failure()
+        self.assertEqual(circuit.state, OPEN)
+        with self.assertRaises(CircuitOpen) as cm:
+            circuit.before_call()
+        self.assertEqual(cm.exception.retry_after, 10)
+        now[0] = 10
+        self.assertEqual(circuit.state, HALF_OPEN)
+        circuit.before_call()
+        self.assertRaises(CircuitOpen, circuit.before_call)
+        circuit.record_failure()
+        self.assertEqual(circuit.state, OPEN)
+        now[0] = 20
+        circuit.before_call()
+        circuit.record_success()
+        self.assertEqual(circuit.state, CLOSED)
+
+    def test_open_circuit_fails_fast(self):
+        """Shares to a network with an open breaker fail without calling it
+        while other networks keep going, and queued jobs are put off."""
+        calls = []
+        class DownBackend(DebugBackend):
+            network = 'down'
+            def _share(self):
+                calls.append(self.consumer_token)
+                raise socket.error('connection refused')
+        register_share_backend('down', DownBackend)
+        breakers.configure('down', failure_threshold=2, reset_timeout=60)
+        policy, retry.retry_policy = retry.retry_policy, RetryPolicy(1)
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            shares = [{'network': network, 'consumer_token': str(i),
+                       'consumer_secret': 's'}
+                      for i in range(4) for network in ('down', 'debug')]
+            share = SocialShare(self.api_token, self.api_secret,
+                                headline=self.headline, shares=shares)
+            results = share.do_bulk_share(max_workers=1)
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(breakers.states()['down'], OPEN)
+            self.assertTrue(all(r.ok for r in results
+                                if r.network == 'debug'))
+            self.assertEqual(
+                [type(r.exception) for r in results if r.network == 'down'],
+                [socket.error, socket.error, CircuitOpen, CircuitOpen])
+            queue = SQLiteJobQueue(path)
+            share.shares = shares[:1]
+            job_id = share.enqueue(queue)
+            Worker(queue, share_job).run(stop_when_empty=True)
+            self.assertEqual(queue.dead(), [])
+            self.assertEqual(queue.in_flight(), [])
+            self.assertEqual([j.id for j in queue.deferred()], [job_id])
+            self.assertEqual(len(queue), 1)
+            self.assertEqual(len(calls), 2)
+        finally:
+            retry.retry_policy = policy
+            os.remove(path)
+
+    def test_rate_limits_dont_open_circuit(self):
+        """One account's 429s don't open the network's breaker."""
+        class Response(object):
+            status = 429
+        class OverQuota(IOError):
+            response = Response()
+        class BusyBackend(DebugBackend):
+            network = 'busy'
+            def _share(self):
+                if self.consumer_token == 'busy':
+                    raise OverQuota('too many requests')
+                return self.consumer_token
+        breakers.configure('busy', failure_threshold=2, reset_timeout=60)
+        policy, retry.retry_policy = retry.retry_policy, RetryPolicy(1)
+        try:
+            for i in range(3):
+                api = BusyBackend(self.api_token, self.api_secret,
+                                  consumer_token='busy',
+                                  headline=self.headline)
+                self.assertRaises(OverQuota, api.share)
+            self.assertEqual(breakers.states()['busy'], CLOSED)
+            api = BusyBackend(self.api_token, self.api_secret,
+                              consumer_token='quiet', headline=self.headline)
+            self.assertEqual(api.share(), 'quiet')
+            facebook = FacebookBackend.__new__(FacebookBackend)
+            error = ShareError('page request limit reached')
+            error.code = 32
+            self.assertTrue(facebook.is_rate_limited(error))
+            error.code = 2
+            self.assertFalse(facebook.is_rate_limited(error))
+        finally:
+            retry.retry_policy = policy
+
+    def test_dedup_skips_shared_content(self):
+        """Content an account already got isn't sent to it again."""
+        calls = []
+        class CountingBackend(DebugBackend):
+            def _share(self):
+                calls.append(self.consumer_token)
+            def _send_batch(self, recipients):
+                calls.extend(recipients)
+        register_share_backend('counting', CountingBackend)
+        shares = [{'network': 'counting', 'consumer_token': token,
+                   'consumer_secret': 's'} for token in ('a', 'b')]
+        share = SocialShare(self.api_token, self.api_secret,
+                            headline=self.headline, shares=shares)
+        share.do_bulk_share()
+        share.headline = '  %s ' % self.headline
+        share.shares = shares + [{'network': 'counting',
+                                  'consumer_token': 'c'}]
+        results = share.do_bulk_share()
+        self.assertEqual([r.status for r in results],
+                         ['skipped', 'skipped', 'success'])
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(calls, ['a', 'b', 'c'])
+        # earlier successes don't stand in for calls made again on purpose
+        results = share.do_bulk_share(skip_duplicates=False)
+        self.assertEqual([r.status for r in results], ['success'] * 3)
+        self.assertEqual(calls, ['a', 'b', 'c'] * 2)
+        backend = CountingBackend(self.api_token, self.api_secret,
+                                  headline=self.headline)
+        backend.to = ['1', '2']
+        backend.send_message()
+        backend.to = ['1', '2', '3']
+        report = backend.send_message()
+        self.assertEqual([r.status for _, r in report],
+                         ['skipped', 'skipped', 'success'])
+        self.assertEqual(calls[6:], ['1', '2', '3'])
+
+    def test_sqlite_dedup_store(self):
+        """Dedup keys are kept in SQLite until their ttl runs out."""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            now = [0]
+            index = DedupIndex(SQLiteDedupStore(path), ttl=10,
+                               clock=lambda: now[0])
+            key = index.key('debug', 'a', ShareContent(headline='x'))
+            self.assertFalse(index.seen(key))
+            index.add(key)
+            other = DedupIndex(SQLiteDedupStore(path), ttl=10,
+                               clock=lambda: now[0])
+            self.assertTrue(other.seen(key))
+            now[0] = 10
+            self.assertFalse(other.seen(key))
+        finally:
+            os.remove(path)
+
+    def test_coalescer(self):
+        """Shares to a busy account go out as one digest post."""
+        posted = []
+        class PostingBackend(DebugBackend):
+            def _share(self):
+                posted.append((self.consumer_token, self.content))
+                return len(posted)
+        register_share_backend('posting', PostingBackend)
+        now = [0]
+        coalescer = Coalescer(window=60, max_items=3,
+                              landing_url='http://example.com/{network}/'
+                                          '{account}',
+                              clock=lambda: now[0])
+        share = SocialShare(self.api_token, self.api_secret,
+                            shares=[{'network': 'posting',
+                                     'consumer_token': 'busy'}])
+        for i in range(4):
+            share.headline = 'Corgi wrangler %i' % i
+            results = share.do_bulk_share(coalescer=coalescer)
+        self.assertEqual(len(posted), 1)
+        content = posted[0][1]
+        self.assertEqual(content.headline, '3 new postings')
+        self.assertEqual(content.url, 'http://example.com/posting/' +
+                         account_key('posting', 'busy'))
+        self.assertNotIn('busy', content.url)
+        self.assertIn('- Corgi wrangler 2', content.message)
+        self.assertEqual(results[0].status, 'pending')
+        self.assertEqual(coalescer.pending(), {('posting', 'busy'): 1})
+        self.assertEqual(coalescer.flush_due(), [])
+        share.headline = 'Corgi wrangler 0'
+        self.assertEqual(share.do_bulk_share(coalescer=coalescer)[0].status,
+                         'skipped')
+        now[0] = 60
+        results = coalescer.flush_due()
+        self.assertEqual([r.result for r in results], [2])
+        self.assertEqual(posted[1][1].headline, 'Corgi wrangler 3')
+        self.assertEqual(coalescer.pending(), {})
+        # do_bulk_share's skip_duplicates wins over the coalescer's
+        coalescer.skip_duplicates = False
+        self.assertEqual(share.do_bulk_share(coalescer=coalescer)[0].status,
+                         'skipped')
+        self.assertEqual(share.do_bulk_share(coalescer=coalescer,
+                                             skip_duplicates=False)[0].status,
+                         'pending')
+
+    def test_process_mode(self):
+        """Process mode shards shares over processes by account."""
+        class PidBackend(DebugBackend):
+            def _share(self):
+                return os.getpid(), self.consumer_token, self.headline
+        register_share_backend('pid', PidBackend)
+        shares = [{'network': 'pid', 'consumer_token': str(i)}
+                  for i in range(20)]
+        with ProcessSharePool(processes=3, threads=2) as pool:
+            share = SocialShare(self.api_token, self.api_secret,
+                                headline=self.headline, shares=shares)
+            results = share.do_bulk_share(mode='process', pool=pool)
+            self.assertTrue(all(r.ok for r in results))
+            self.assertEqual([r.result[1] for r in results],
+                             [str(i) for i in range(20)])
+            pids = dict((r.result[1], r.result[0]) for r in results)
+            self.assertNotIn(os.getpid(), pids.values())
+            records = [{'headline': 'Corgi %i' % i} for i in range(3)]
+            streamed = list(share_stream(records, shares[:4], 'token',
+                                         'secret', mode='process',
+                                         pool=pool))
+        self.assertEqual(len(streamed), 12)
+        for r in streamed:
+            self.assertEqual(r.result[2], r.record['headline'])
+            self.assertEqual(r.result[0], pids[r.result[1]])
+        self.assertTrue(len(set(pids.values())) > 1)
+        # a share that raises in a worker process comes back failed
+        class BrokenIndex(object):
+            def call(self, *args):
+                raise IOError("dedup store is down")
+        index, dedup.dedup_index = dedup.dedup_index, BrokenIndex()
+        try:
+            with ProcessSharePool(processes=2, threads=2) as pool:
+                results = share.do_bulk_share(mode='process', pool=pool)
+        finally:
+            dedup.dedup_index = index
+        self.assertEqual([r.status for r in results], ['failed'] * 20)
+        self.assertIsInstance(results[0].exception, IOError)
+
+    def test_scheduler(self):
+        """Scheduled shares are handed out in due order once they're due."""
+        now = [1000.0]
+        handled = []
+        store = MemoryScheduleStore()
+        scheduler = Scheduler(store, handled.append, clock=lambda: now[0])
+        for at in (1030, 1010, 1020, 1040):
+            scheduler.add(at, {'at': at})
+        scheduler.cancel(scheduler.add(1015, {'at': 1015}))
+        self.assertEqual(len(store), 4)
+        self.assertEqual(scheduler.run_pending(), 0)
+        now[0] = 1030
+        self.assertEqual(scheduler.run_pending(), 3)
+        self.assertEqual(handled, [{'at': 1010}, {'at': 1020}, {'at': 1030}])
+        self.assertEqual(store.next_due(), 1040)
+        slept = []
+        spread = Scheduler(MemoryScheduleStore(), handled.append, spread=60,
+                           max_rate=10, clock=lambda: now[0],
+                           sleep=slept.append)
+        offsets = [spread.offset({'shares': [{'consumer_token': str(i)}]})
+                   for i in range(100)]
+        self.assertTrue(all(0 <= o < 60 for o in offsets))
+        self.assertTrue(max(offsets) - min(offsets) > 30)
+        for i in range(30):
+            spread.add(now[0] - 60, {'n': i})
+        spread.run_pending()
+        self.assertAlmostEqual(max(slept), 2.0)
+        aware = datetime.datetime(2012, 1, 25, 9, 0, tzinfo=_UTC())
+        self.assertEqual(timestamp(aware), 1327482000)
+        # shares a network can't take yet are put off, not dropped
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            for store in (MemoryScheduleStore(), SQLiteScheduleStore(path)):
+                handled = []
+                def handler(payload):
+                    if not handled:
+                        handled.append(payload)
+                        raise CircuitOpen("down", retry_after=30)
+                    handled.append(payload)
+                scheduler = Scheduler(store, handler, clock=lambda: now[0])
+                scheduler.add(now[0], {'n': 1})
+                self.assertEqual(scheduler.run_pending(), 1)
+                self.assertEqual(store.next_due(), now[0] + 30)
+                self.assertEqual(len(store), 1)
+                now[0] += 30
+                self.assertEqual(scheduler.run_pending(), 1)
+                self.assertEqual(handled, [{'n': 1}] * 2)
+                self.assertEqual(len(store), 0)
+        finally:
+            os.remove(path)
+
+    def test_scheduled_share(self):
+        """SocialShare.schedule persists the share until it is due."""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            shares = [{'network': 'debug', 'consumer_token': 'a',
+                       'consumer_secret': 'b'}]
+            share = SocialShare(self.api_token, self.api_secret,
+                                headline=self.headline, shares=shares)
+            scheduler = Scheduler(SQLiteScheduleStore(path))
+            share.schedule(time.time() - 1, scheduler)
+            share.schedule(time.time() + 3600, scheduler)
+            handled = []
+            def handler(payload):
+                handled.extend(share_job(payload))
+            restarted = Scheduler(SQLiteScheduleStore(path), handler)
+            restarted.run_pending()
+            self.assertEqual([r.status for r in handled], ['success'])
+            self.assertEqual(handled[0].result[4], self.headline)
+            self.assertEqual(len(restarted.store), 1)
+        finally:
+            os.remove(path)
+
+    def test_result_store(self):
+        """Shares and sends are recorded with their post IDs in batches."""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        store = SQLiteResultStore(path)
+        recorder = ResultRecorder(store, batch_size=3)
+        instrumentation.add_hook(recorder)
+        try:
+            with FakeSocialServer() as server:
+                transport.default_transport = Transport(
+                    base_urls=server.base_urls)
+                share = SocialShare(self.api_token, self.api_secret,
+                                    headline=self.headline, url=self.url,
+                                    shares=[{'network': n,
+                                             'consumer_token': 'ct',
+                                             'consumer_secret': 'cs'}
+                                            for n in ('twitter', 'facebook',
+                                                      'linkedin')])
+                self.assertTrue(all(r.ok for r in share.do_bulk_share()))
+                # a full batch was written
+                digest = share.get_content().digest
+                records = store.for_content(digest)
+                self.assertEqual(len(records), 3)
+                backend = DebugBackend(self.api_token, self.api_secret,
+                                       consumer_token='ct',
+                                       headline=self.headline)
+                backend.to = ['x']
+                backend.send_message()
+                self.assertEqual(len(store.for_content(digest)), 3)
+                recorder.flush()
+        finally:
+            instrumentation.remove_hook(recorder)
+            transport.default_transport.close()
+            transport.default_transport = self.default_transport
+            client_cache.clear()
+        try:
+            post_ids = dict((r.network, r.post_id) for r in records)
+            self.assertTrue(post_ids['twitter'].isdigit())
+            self.assertTrue(post_ids['facebook'].startswith('me_'))
+            self.assertTrue(post_ids['linkedin'].startswith('UPDATE-'))
+            self.assertTrue(all(r.status == 'success' and r.latency >= 0
+                                for r in records))
+            # the consumer token itself isn't kept
+            self.assertEqual(records[0].account,
+                             account_key(records[0].network, 'ct'))
+            accounts = [row[0] for row in store._connection().execute(
+                'SELECT account FROM results')]
+            self.assertNotIn('ct', accounts)
+            sent = store.for_account('debug', 'ct')
+            self.assertEqual([(r.operation, r.recipients) for r in sent],
+                             [('message', ['x'])])
+            self.assertEqual(store.for_account('debug', 'ct',
+                                               since=time.time() + 60), [])
+        finally:
+            os.remove(path)
+
+    def test_bulk_unshare(self):
+        """Posts recorded for a content are deleted from every network."""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        store = SQLiteResultStore(path)
+        recorder = ResultRecorder(store)
+        instrumentation.add_hook(recorder)
+        try:
+            with FakeSocialServer() as server:
+                transport.default_transport = Transport(
+                    base_urls=server.base_urls)
+                # the fake takes a tweet posted with the same app token
+                # as a duplicate, so there's one Twitter account
+                shares = [{'network': n, 'consumer_token': 'ct%i' % i,
+                           'consumer_secret': 'cs'}
+                          for n in ('facebook', 'linkedin') for i in range(3)]
+                shares.append({'network': 'twitter', 'consumer_token': 'ct0',
+                               'consumer_secret': 'cs'})
+                share = SocialShare(self.api_token, self.api_secret,
+                                    headline=self.headline, url=self.url,
+                                    shares=shares)
+                self.assertTrue(all(r.ok for r in share.do_bulk_share()))
+                self.assertEqual(len(server.posts), 7)
+                recorder.flush()
+                digest = share.get_content().digest
+                self.assertEqual(len(store.posts(digest)), 7)
+                posts = store.posts(digest, shares)
+                self.assertEqual(len(posts), 7)
+                self.assertEqual(len(store.posts(digest, shares[:2])), 2)
+                # unshared by whoever has the post IDs, whatever content
+                # they have
+                closer = SocialShare(self.api_token, self.api_secret)
+                results = closer.do_bulk_unshare(posts,
+                                                 network_limits={'linkedin': 1})
+                self.assertTrue(all(r.ok for r in results), results)
+                self.assertEqual(server.posts, set())
+                recorder.flush()
+                self.assertEqual(store.posts(digest), [])
+                # already gone
+                backend = TwitterBackend(self.api_token, self.api_secret,
+                                         consumer_token='ct0',
+                                         consumer_secret='cs')
+                report = backend.unshare_many(['404', '405'])
+                self.assertTrue(report.ok)
+                self.assertEqual(len(report), 2)
+        finally:
+            instrumentation.remove_hook(recorder)
+            transport.default_transport.close()
+            transport.default_transport = self.default_transport
+            client_cache.clear()
+            os.remove(path)
+
+    def test_simulated_backend(self):
+        """Simulated backends inject errors repeatably for a seed."""
+        breakers.configure('sim', failure_threshold=10 ** 6)
+        policy, retry.retry_policy = retry.retry_policy, RetryPolicy(1)
+        def run(seed):
+            slept = []
+            register_share_backend('sim', simulated_backend(
+                'sim', latency=uniform(.1, .2), error_rate=.3,
+                rate_limit_rate=.1, timeout_rate=.1, timeout=5, seed=seed,
+                sleep=slept.append))
+            dedup.dedup_index.clear()
+            share = SocialShare(self.api_token, self.api_secret,
+                                headline=self.headline,
+                                shares=[{'network': 'sim',
+                                         'consumer_token': str(i)}
+                                        for i in range(200)])
+            results = share.do_bulk_share(max_workers=1)
+            return [r.ok or transport.HTTPError in type(r.exception).__mro__
+                    and r.exception.response.status or
+                    type(r.exception).__name__ for r in results], slept
+        try:
+            outcomes, slept = run(7)
+            self.assertEqual(run(7), (outcomes, slept))
+            self.assertNotEqual(run(8)[0], outcomes)
+        finally:
+            retry.retry_policy = policy
+        counts = dict((o, outcomes.count(o)) for o in set(outcomes))
+        self.assertEqual(sorted(counts), sorted([True, 429, 503, 'timeout']))
+        self.assertTrue(80 < counts[True] < 120, counts)
+        self.assertEqual(slept.count(5), counts['timeout'])
+        self.assertTrue(all(.1 <= s <= .2 for s in slept if s != 5))
+
+    def test_record_replay(self):
+        """Recorded calls play back attempt by attempt, sped up."""
+        breakers.configure('sim', failure_threshold=10 ** 6)
+        policy = retry.retry_policy
+        retry.retry_policy = RetryPolicy(3, sleep=lambda seconds: None)
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        fd, replayed_path = tempfile.mkstemp()
+        os.close(fd)
+        def record(path, fn):
+            recorder = CallRecorder(path)
+            instrumentation.add_hook(recorder)
+            try:
+                return fn()
+            finally:
+                instrumentation.remove_hook(recorder)
+                recorder.close()
+        def read(path):
+            with open(path) as f:
+                return [json.loads(line) for line in f]
+        try:
+            register_share_backend('sim', simulated_backend(
+                'sim', latency=.01, error_rate=.5, seed=1))
+            share = SocialShare(self.api_token, self.api_secret,
+                                headline=self.headline,
+                                shares=[{'network': 'sim',
+                                         'consumer_token': 'token%i' % i}
+                                        for i in range(20)])
+            recorded = record(path,
+                              lambda: share.do_bulk_share(max_workers=1))
+            self.assertNotIn('token1', open(path).read())
+            slept = []
+            replay = Replay(path, speed=10, sleep=slept.append).install()
+            self.assertEqual(len(replay.calls), 20)
+            self.assertTrue(any(len(c['tries']) > 1 and c['outcome'] ==
+                                'success' for c in replay.calls))
+            replayed = record(replayed_path,
+                              lambda: replay.run(max_workers=1))
+            self.assertEqual([r.ok for r in replayed],
+                             [r.ok for r in recorded])
+            self.assertEqual([r.result['id_str'] for r in replayed if r.ok],
+                             [r.result['id_str'] for r in recorded if r.ok])
+            tries = lambda calls: [[t['status'] for t in c['tries']]
+                                   for c in calls]
+            self.assertEqual(tries(read(replayed_path)), tries(replay.calls))
+            # latencies and gaps between calls are played back 10x faster
+            latencies = [t['latency'] / 10 for c in replay.calls
+                         for t in c['tries']]
+            self.assertTrue(all(.001 <= l < .002 for l in latencies))
+            self.assertTrue(all(l in slept for l in latencies))
+            waits = [s for s in slept if s not in latencies]
+            self.assertLessEqual(max(waits), replay.calls[-1]['offset'] / 10)
+        finally:
+            retry.retry_policy = policy
+            os.remove(path)
+            os.remove(replayed_path)
+
+    def test_scheduler_rate_wait(self):
+        """With a bounded rate limit wait, the scheduler puts off a share
+        that would wait instead of holding up the others."""
+        calls = []
+        class RationedBackend(DebugBackend):
+            rate_limit = (1, 60 * 60)
+            def _share(self):
+                calls.append(self.headline)
+        register_share_backend('rationed', RationedBackend)
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        limiter = ratelimit.rate_limiter
+        args = cli.get_parser().parse_args(['scheduler', '--db', path])
+        ratelimit.rate_limiter = RateLimiter(max_wait=args.max_rate_wait,
+                                             sleep=self.fail)
+        try:
+            store = SQLiteScheduleStore(path)
+            scheduler = Scheduler(store, share_job)
+            for headline in ('First', 'Second'):
+                SocialShare(self.api_token, self.api_secret,
+                            headline=headline,
+                            shares=[{'network': 'rationed',
+                                     'consumer_token': 'a',
+                                     'consumer_secret': 'b'}]
+                            ).schedule(time.time(), scheduler)
+            self.assertEqual(scheduler.run_pending(), 2)
+            self.assertEqual(calls, ['First'])
+            self.assertEqual(len(store), 1)
+            self.assertGreater(store.next_due(), time.time() + 60)
+        finally:
+            ratelimit.rate_limiter = limiter
+            os.remove(path)
+
+    def test_cli_share(self):
+        """socialshare share prints progress and resumes from a checkpoint."""
+        calls = []
+        class CountingBackend(DebugBackend):
+            def _share(self):
+                calls.append((self.consumer_token, self.headline))
+        register_share_backend('cli-test', CountingBackend)
+        tmp = tempfile.mkdtemp()
+        content = os.path.join(tmp, 'postings.jsonl')
+        accounts = os.path.join(tmp, 'accounts.csv')
+        db = os.path.join(tmp, 'backfill.db')
+        def write_content(count):
+            with open(content, 'w') as f:
+                for i in range(count):
+                    f.write(json.dumps({'headline': 'Posting %i' % i}) + '\n')
+        with open(accounts, 'w') as f:
+            f.write('network,consumer_token,consumer_secret\n'
+                    'cli-test,a,s\ncli-test,b,s\n')
+        def run(*argv):
+            out, sys.stderr = sys.stderr, StringIO()
+            try:
+                args = cli.get_parser().parse_args(
+                    ['share', content, '--accounts', accounts,
+                     '--progress', '0'] + list(argv))
+                return args.func(args), sys.stderr.getvalue()
+            finally:
+                sys.stderr = out
+        index = dedup.dedup_index
+        try:
+            write_content(4)
+            code, output = run('--checkpoint', db)
+            self.assertEqual(code, 0)
+            self.assertEqual(len(calls), 8)
+            self.assertIn('8 shares', output)
+            write_content(6)
+            code, output = run('--checkpoint', db)
+            self.assertEqual(len(calls), 12)
+            self.assertEqual(sorted(calls[8:]),
+                             [('a', 'Posting 4'), ('a', 'Posting 5'),
+                              ('b', 'Posting 4'), ('b', 'Posting 5')])
+            code, output = run('--dry-run', '--share-duplicates')
+            self.assertEqual(len(calls), 12)
+            self.assertIn('12 shares', output)
+            self.assertIn('0 failed, 0 skipped', output)
+            self.assertIs(get_share_backend('cli-test'), DebugBackend)
+        finally:
+            dedup.dedup_index = index
+            for name in os.listdir(tmp):
+                os.remove(os.path.join(tmp, name))
+            os.rmdir(tmp)
+        # results finishing out of order only move the checkpoint past
+        # records with every share done
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            checkpoint = Checkpoint(path)
+            # the same record twice is still two records
+            record = {'headline': 'same'}
+            records = [record, record, {'headline': 'other'}]
+            def finish(checkpoint, position, status='success'):
+                result = ShareResult('debug', status=status)
+                result.position = position
+                checkpoint.finished(result)
+            list(checkpoint.resume(records, [{}, {}]))
+            for i in (1, 1, 0, 2):
+                finish(checkpoint, i)
+            self.assertEqual(checkpoint.position, 0)
+            finish(checkpoint, 0)
+            self.assertEqual(checkpoint.position, 2)
+            checkpoint.save()
+            resumed = Checkpoint(path)
+            self.assertEqual(resumed.position, 2)
+            # positions count from the first record resume() yields
+            self.assertEqual(list(resumed.resume(records, [{}])),
+                             records[2:])
+            finish(resumed, 0)
+            self.assertEqual(resumed.position, 3)
+            # a record with a failed share isn't finished
+            failing = Checkpoint(path, name='failing')
+            list(failing.resume(records, [{}, {}]))
+            finish(failing, 0)
+            finish(failing, 0, 'failed')
+            finish(failing, 1, 'skipped')
+            finish(failing, 1)
+            self.assertEqual(failing.position, 0)
+        finally:
+            os.remove(path)
+
+    def test_benchmarks(self):
+        """The benchmark suite runs and compares against a baseline."""
+        results = benchmarks.run(widths=(1, 5), modes=('stream',),
+                                 sizes=('short',), latency=0, out=None)
+        self.assertEqual(results['fanout/stream/short/5']['failed'], 0)
+        self.assertIn('p99_ms', results['fanout/stream/short/1'])
+        self.assertIn('content_per_sec', results['construct/short'])
+        # a baseline twice as fast
+        faster = dict((k, dict((m, v * 2 if m.endswith('_per_sec') else
+                                   v / 2.0 if m.endswith('_seconds') else v)
+                               for m, v in r.items()))
+                      for k, r in results.items())
+        self.assertEqual(benchmarks.compare(results, results, out=None), [])
+        self.assertIn('construct/short', benchmarks.compare(
+            results, faster, min_delta=0, out=None))
+        # but a run only a millisecond slower than the baseline is noise
+        name = 'fanout/stream/short/1'
+        seconds = results[name]['shares_seconds']
+        faster[name]['shares_seconds'] = seconds - 0.001
+        self.assertIn(name, benchmarks.compare(results, faster, min_delta=0,
+                                               out=None))
+        self.assertNotIn(name, benchmarks.compare(results, faster, out=None))
+
 if __name__ == '__main__':
     unittest2.main()
         
\ No newline at end of file
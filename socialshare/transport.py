@@ -0,0 +1,417 @@
+"""
+transport.py -- HTTP transport shared by all backends.
+
+                The SDKs each bring their own HTTP stack with no timeouts and
+                no control over connection reuse, so backends talk to the
+                networks' REST APIs through a Transport instead: one
+                keep-alive connection pool per host, a cap on connections per
+                host, and connect/read timeouts per network. A default one is
+                installed; replace it to change the settings, or set it to
+                None to go back to the SDKs.
+
+                    transport.default_transport = transport.Transport(
+                        timeouts={'linkedin': (5, 60)}, pool_size=20)
+
+                base_urls points networks somewhere else, e.g. at a
+                fakeserver.FakeSocialServer for tests and load testing.
+"""
+import base64
+import errno
+import hashlib
+import hmac
+import httplib
+import json
+import socket
+import threading
+import time
+import urllib
+import uuid
+from urlparse import urlsplit
+
+from errors import ShareError
+from media import MultipartBody
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (5.0, 30.0)
+DEFAULT_TIMEOUTS = {'twitter': (5.0, 30.0),
+                    'facebook': (5.0, 30.0),
+                    'linkedin': (5.0, 60.0)}
+
+
+class HTTPError(ShareError):
+    """Raised for non 2xx responses. response is the Response."""
+    def __init__(self, response):
+        super(HTTPError, self).__init__("HTTP %s %s: %s" % (
+            response.status, response.reason, response.body[:500]))
+        self.response = response
+
+
+class Response(object):
+    """A read HTTP response."""
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body) if self.body else None
+
+
+class ConnectionPool(object):
+    """Keep-alive connections to one host.
+
+    Parameters:
+    scheme -- 'http' or 'https'
+    host -- host name
+    port -- port, or None for the scheme's default
+    maxsize -- most connections open at once. Requests over it wait.
+    timeout -- (connect, read) timeouts in seconds
+    """
+
+    def __init__(self, scheme, host, port=None, maxsize=10,
+                 timeout=DEFAULT_TIMEOUT):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        self.connect_timeout, self.read_timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxsize)
+        self.created = 0
+
+    def _new(self):
+        if self.scheme == 'https':
+            class_ = httplib.HTTPSConnection
+        else:
+            class_ = httplib.HTTPConnection
+        conn = class_(self.host, self.port, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        with self._lock:
+            self.created += 1
+        return conn
+
+    def _send(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers)
+        resp = conn.getresponse()
+        body = resp.read()
+        return resp, body
+
+    def request(self, method, path, body=None, headers=None):
+        """Sends a request and returns a Response."""
+        headers = headers or {}
+        self._slots.acquire()
+        try:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            reused = conn is not None
+            if conn is None:
+                conn = self._new()
+            try:
+                resp, data = self._send(conn, method, path, body, headers)
+            except socket.timeout:
+                conn.close()
+                raise
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                if not reused or not _unsent(e):
+                    raise
+                # the server dropped an idle keep-alive connection before
+                # reading the request, so sending it again is safe. Anything
+                # else may have gone through and is left to the RetryPolicy.
+                if hasattr(body, 'seek'):
+                    body.seek(0)
+                conn = self._new()
+                resp, data = self._send(conn, method, path, body, headers)
+            if resp.will_close:
+                conn.close()
+            else:
+                with self._lock:
+                    self._idle.append(conn)
+            return Response(resp.status, resp.reason,
+                            dict(resp.getheaders()), data)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+def _unsent(exc):
+    # how a request on a keep-alive connection the server had already closed
+    # fails: the connection is reset, or closes without a byte of response
+    if isinstance(exc, httplib.BadStatusLine):
+        return exc.line in ('', "''") or exc.line.startswith('No status line')
+    return getattr(exc, 'errno', None) in (errno.ECONNRESET, errno.EPIPE)
+
+
+class Transport(object):
+    """Pooled HTTP for all networks.
+
+    Parameters:
+    timeouts -- dict of network: (connect, read) seconds. Networks not
+                listed use DEFAULT_TIMEOUTS, then DEFAULT_TIMEOUT.
+    pool_size -- most connections open at once per network and host
+    base_urls -- optional dict of network: base URL that replaces the
+                 scheme and host of that network's API URLs.
+    """
+
+    def __init__(self, timeouts=None, pool_size=10, base_urls=None):
+        self.timeouts = dict(DEFAULT_TIMEOUTS)
+        self.timeouts.update(timeouts or {})
+        self.pool_size = pool_size
+        self.base_urls = dict(base_urls or {})
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def pool(self, network, scheme, host, port=None):
+        key = (network, scheme, host, port)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(scheme, host, port,
+                                      maxsize=self.pool_size,
+                                      timeout=self.timeouts.get(
+                                          network, DEFAULT_TIMEOUT))
+                self._pools[key] = pool
+        return pool
+
+    def request(self, network, method, url, params=None, body=None,
+                headers=None):
+        """Sends a request for network and returns the Response.
+
+        Raises HTTPError for non 2xx responses and socket.timeout when the
+        network is too slow.
+
+        Parameters:
+        params -- dict sent form encoded in the body (POST) or query (GET)
+        body -- raw request body, used instead of params. Either a string or
+                a file-like object with read() and len(), such as a
+                media.MultipartBody, which is sent a block at a time.
+        """
+        headers = dict(headers or {})
+        if params:
+            encoded = urllib.urlencode(_utf8(params))
+            if method == 'GET':
+                url = '%s%s%s' % (url, '&' if '?' in url else '?', encoded)
+            else:
+                body = encoded
+                headers.setdefault('Content-Type',
+                                   'application/x-www-form-urlencoded')
+        if network in self.base_urls:
+            parts = urlsplit(url)
+            url = self.base_urls[network].rstrip('/') + parts.path
+            if parts.query:
+                url += '?' + parts.query
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        pool = self.pool(network, parts.scheme, parts.hostname, parts.port)
+        response = pool.request(method, path, body, headers)
+        if not 200 <= response.status < 300:
+            raise HTTPError(response)
+        return response
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = self._pools.values(), {}
+        for pool in pools:
+            pool.close()
+
+
+def _utf8(params):
+    return dict((k, v.encode('utf-8') if isinstance(v, unicode) else v)
+                for k, v in params.items() if v is not None)
+
+
+def _quote(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return urllib.quote(str(value), safe='~')
+
+
+def oauth1_header(method, url, params, consumer_key, consumer_secret, token,
+                  token_secret, nonce=None, timestamp=None):
+    """Returns an OAuth 1.0a HMAC-SHA1 Authorization header.
+
+    Parameters:
+    url -- the request URL without its query string
+    params -- form or query parameters that are part of the signature
+    """
+    oauth = {'oauth_consumer_key': consumer_key,
+             'oauth_nonce': nonce or uuid.uuid4().hex,
+             'oauth_signature_method': 'HMAC-SHA1',
+             'oauth_timestamp': str(timestamp or int(time.time())),
+             'oauth_token': token,
+             'oauth_version': '1.0'}
+    signed = [(_quote(k), _quote(v)) for k, v in
+              list((params or {}).items()) + list(oauth.items())
+              if v is not None]
+    param_string = '&'.join('%s=%s' % kv for kv in sorted(signed))
+    base = '&'.join([method.upper(), _quote(url), _quote(param_string)])
+    key = '%s&%s' % (_quote(consumer_secret), _quote(token_secret))
+    oauth['oauth_signature'] = base64.b64encode(
+        hmac.new(key, base, hashlib.sha1).digest())
+    return 'OAuth ' + ', '.join('%s="%s"' % (_quote(k), _quote(v))
+                                for k, v in sorted(oauth.items()))
+
+
+class TwitterClient(object):
+    """Twitter REST client with the tweepy methods TwitterBackend uses."""
+    api_url = 'https://api.twitter.com/1.1'
+
+    def __init__(self, transport, consumer_key, consumer_secret, token,
+                 token_secret):
+        self.transport = transport
+        self.credentials = (consumer_key, consumer_secret, token,
+                            token_secret)
+
+    upload_url = 'https://upload.twitter.com/1.1/media/upload.json'
+
+    def _post(self, path, params):
+        return self._post_url(self.api_url + path, params)
+
+    def _post_url(self, url, params=None, body=None):
+        # multipart bodies aren't part of the OAuth signature
+        auth = oauth1_header('POST', url, _utf8(params or {}),
+                             *self.credentials)
+        headers = {'Authorization': auth}
+        if body is not None:
+            headers['Content-Type'] = body.content_type
+        return self.transport.request('twitter', 'POST', url, params=params,
+                                      body=body, headers=headers).json()
+
+    def update_status(self, status, media_ids=None):
+        params = {'status': status}
+        if media_ids:
+            params['media_ids'] = ','.join(str(i) for i in media_ids)
+        return self._post('/statuses/update.json', params)
+
+    def upload_media(self, source):
+        """Uploads a fetched media.MediaSource with the chunked upload API,
+        a chunk at a time. Returns the media ID."""
+        init = self._post_url(self.upload_url, {
+            'command': 'INIT', 'total_bytes': source.size,
+            'media_type': source.media_type})
+        media_id = init['media_id_string']
+        for index, chunk in enumerate(source.chunks()):
+            body = MultipartBody(
+                [('command', 'APPEND'), ('media_id', media_id),
+                 ('segment_index', index)],
+                [('media', source.filename, 'application/octet-stream',
+                  chunk)])
+            self._post_url(self.upload_url, body=body)
+        self._post_url(self.upload_url, {'command': 'FINALIZE',
+                                         'media_id': media_id})
+        return media_id
+
+    def destroy_status(self, id):
+        return self._post('/statuses/destroy/%s.json' % _quote(id), {})
+
+    def send_direct_message(self, user, text):
+        if str(user).isdigit():
+            params = {'user_id': user, 'text': text}
+        else:
+            params = {'screen_name': user, 'text': text}
+        return self._post('/direct_messages/new.json', params)
+
+
+class FacebookClient(object):
+    """Graph API client with the facepy method FacebookBackend uses."""
+    api_url = 'https://graph.facebook.com'
+
+    def __init__(self, transport, oauth_token):
+        self.transport = transport
+        self.oauth_token = oauth_token
+
+    def post(self, path, **fields):
+        fields['access_token'] = self.oauth_token
+        url = '%s/%s' % (self.api_url, path.lstrip('/'))
+        return self.transport.request('facebook', 'POST', url,
+                                      params=fields).json()
+
+    def delete(self, path):
+        url = '%s/%s?%s' % (self.api_url, _quote(path.lstrip('/')),
+                            urllib.urlencode({'access_token':
+                                              self.oauth_token}))
+        return self.transport.request('facebook', 'DELETE', url).json()
+
+    def upload_photo(self, source):
+        """Uploads a fetched media.MediaSource as an unpublished photo,
+        streamed from disk. Returns the photo ID."""
+        body = MultipartBody(
+            [('access_token', self.oauth_token), ('published', 'false')],
+            [('source', source.filename, source.media_type, source)])
+        url = '%s/me/photos' % self.api_url
+        return self.transport.request(
+            'facebook', 'POST', url, body=body,
+            headers={'Content-Type': body.content_type}).json()['id']
+
+
+class LinkedInClient(object):
+    """LinkedIn REST client with the python-linkedin methods LinkedInBackend
+    uses."""
+    api_url = 'https://api.linkedin.com/v1'
+
+    def __init__(self, transport, api_key, api_secret, token, token_secret):
+        self.transport = transport
+        self.credentials = (api_key, api_secret, token, token_secret)
+        self._error = None
+
+    def _post(self, path, data):
+        return self._request('POST', path, json.dumps(data))
+
+    def _request(self, method, path, body=None):
+        url = self.api_url + path
+        auth = oauth1_header(method, url, {}, *self.credentials)
+        headers = {'Authorization': auth, 'x-li-format': 'json'}
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+        try:
+            response = self.transport.request('linkedin', method, url,
+                                              body=body, headers=headers)
+        except HTTPError, e:
+            self._error = str(e)
+            raise
+        return response.json() or True
+
+    def share_update(self, comment=None, title=None, submitted_url=None,
+                     submitted_image_url=None, description=None,
+                     visibility='connections-only'):
+        if visibility == 'everyone':
+            visibility = 'anyone'
+        data = {'visibility': {'code': visibility}}
+        if comment:
+            data['comment'] = comment
+        if submitted_url:
+            data['content'] = {'title': title,
+                               'submitted-url': submitted_url,
+                               'description': description}
+            if submitted_image_url:
+                data['content']['submitted-image-url'] = submitted_image_url
+        return self._post('/people/~/shares', data)
+
+    def send_message(self, subject, message, ids):
+        people = [{'person': {'_path': '/people/%s' % i}} for i in ids]
+        return self._post('/people/~/mailbox',
+                          {'recipients': {'values': people},
+                           'subject': subject, 'body': message})
+
+    def delete_share(self, update_key):
+        return self._request('DELETE', '/people/~/shares/%s' %
+                             _quote(update_key))
+
+    def get_error(self):
+        return self._error
+
+
+# the Transport backends without their own use. Set it to None to use the
+# networks' SDKs, which have no timeouts.
+default_transport = Transport()